@@ -0,0 +1,161 @@
+'''
+Generates farms of synthetic repositories for the benchmarks.
+
+The repositories contain only the files revisioncask looks at: the files
+required for a valid repository, the access record and the native permission
+files.
+They are written directly, without the VCS binaries, so that farms of
+100k repositories can be generated in reasonable time.
+
+usage: python -m benchmarks.farm <git|hg|svn> <count> <target dir>
+'''
+
+import os
+import sys
+import time
+import random
+from StringIO import StringIO
+from ConfigParser import SafeConfigParser
+
+from revisioncask import git, hg, svn
+from revisioncask.abstractrepo import encode_access_record
+from revisioncask.permstore import PermissionStore
+
+
+# Directories and files making a valid repository of each VCS
+SKELETONS = {
+    "git": (("objects", "hooks", "refs"), ("config", "HEAD", "description")),
+    "hg":  ((".hg", ".hg/store"), (".hg/requires",)),
+    "svn": (("conf", "db", "locks"), ("conf/svnserve.conf", "format")),
+}
+
+MANAGERS = { "git": git.GitManager,
+             "hg":  hg.MercurialManager,
+             "svn": svn.SubversionManager }
+
+USER_COUNT = 1000
+
+
+def username(i):
+    return "user%04d" % i
+
+
+def random_access(rnd):
+    """
+    Returns (owners, permissions) of one repository. Permissions is a list of
+    (username, permissions) tuples.
+    """
+    owners = rnd.sample(xrange(USER_COUNT), rnd.randint(1, 3))
+    members = rnd.sample(xrange(USER_COUNT), rnd.randint(0, 10))
+
+    permissions = [(username(i), "rw") for i in owners]
+    permissions += [(username(i), rnd.choice(("r", "rw")))
+                    for i in members if i not in owners]
+    if rnd.random() < 0.3:
+        permissions.append(("*", "r"))
+
+    return [username(i) for i in owners], permissions
+
+
+def write_repository(klass, vcs, repo_path, owners, permissions,
+                     legacy=False):
+    dirs, files = SKELETONS[vcs]
+    for d in dirs:
+        os.makedirs(os.path.join(repo_path, d))
+    for f in files:
+        open(os.path.join(repo_path, f), "w").close()
+
+    written = []
+    if legacy or klass.permdb_name not in klass.legacy_files:
+        # Old repositories and the native permission files of hg and svn
+        write_permdb(klass, repo_path, owners, permissions)
+        written.append(klass.permdb_name)
+
+    if legacy:
+        if klass.owner_filename != klass.permdb_name:
+            write_file(os.path.join(repo_path, klass.owner_filename),
+                       "".join(owner + "\n" for owner in owners))
+            written.append(klass.owner_filename)
+    else:
+        write_file(os.path.join(repo_path, klass.access_record_name),
+                   encode_access_record(owners, dict(permissions)))
+        written.append(klass.access_record_name)
+
+    age_files(repo_path, *written)
+
+
+def write_permdb(klass, repo_path, owners, permissions):
+    permdb = SafeConfigParser()
+    permdb.add_section(klass._permissions_section)
+    for user, perms in permissions:
+        permdb.set(klass._permissions_section, user, perms)
+
+    if klass.owner_filename == klass.permdb_name:
+        # Mercurial keeps owners in the hgrc
+        permdb.add_section("web")
+        permdb.set("web", "contact", klass.owner_sep.join(owners))
+
+    out = StringIO()
+    permdb.write(out)
+    write_file(os.path.join(repo_path, klass.permdb_name), out.getvalue())
+
+
+def write_file(path, data):
+    f = open(path, "w")
+    f.write(data)
+    f.close()
+
+
+def age_files(directory, *filenames):
+    """
+    Makes the files look like they were written an hour ago. Freshly written
+    files are never served from the caches.
+    """
+    hour_ago = time.time() - 3600
+    for filename in filenames:
+        os.utime(os.path.join(directory, filename), (hour_ago, hour_ago))
+
+
+def generate(vcs, count, target, seed=0, legacy=False,
+             permission_store_path=None):
+    """
+    Generates count repositories to target directory. Returns the manager
+    of the farm.
+
+    If legacy is True the repositories have the permission and owner files
+    used before the access record. If permission_store_path is given the
+    permissions are written also to the permission store there.
+    """
+    manager_class = MANAGERS[vcs]
+    klass = manager_class.klass
+    rnd = random.Random(seed)
+    store = None
+    if permission_store_path:
+        store = PermissionStore(permission_store_path)
+
+    if not os.path.exists(target):
+        os.makedirs(target)
+
+    for i in xrange(count):
+        repo_path = os.path.join(target,
+                                 klass.prefix + "repo%06d" % i + klass.suffix)
+        owners, permissions = random_access(rnd)
+        name_on_fs = os.path.basename(repo_path)
+        if store is not None and name_on_fs not in store:
+            store.save(name_on_fs, "repo%06d" % i, owners, dict(permissions))
+        if os.path.exists(repo_path):
+            # Farms can be grown incrementally
+            continue
+        write_repository(klass, vcs, repo_path, owners, permissions,
+                         legacy=legacy)
+
+    if store is not None:
+        store.mark_imported()
+
+    age_files(target, "")
+    return manager_class(target, permission_store_path=permission_store_path)
+
+
+if __name__ == "__main__":
+    vcs, count, target = sys.argv[1:4]
+    generate(vcs, int(count), target)
@@ -0,0 +1,88 @@
+'''
+Compares forking by plain shutil.copytree against VCS.copy_files which hard
+links the immutable files.
+
+usage: python benchmarks/fork.py [git|hg|svn] [size in MB]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from revisioncask import git, hg, svn
+
+
+managers = { "git": git.GitManager,
+             "hg":  hg.MercurialManager,
+             "svn": svn.SubversionManager }
+
+
+class UserRequest(object):
+    def __init__(self, **kwargs):
+        self.__dict__ = kwargs
+
+
+def populate(repo, size_mb, file_size_mb=8):
+    """
+    Fills the immutable directories of the repository with random data to
+    simulate a big repository.
+    """
+    immutable_dir = os.path.join(repo.repo_path, repo.immutable_dirs[0])
+    if not os.path.exists(immutable_dir):
+        os.makedirs(immutable_dir)
+
+    chunk = os.urandom(1024 * 1024)
+    for i in range(max(1, size_mb / file_size_mb)):
+        f = open(os.path.join(immutable_dir, "data%d" % i), "wb")
+        for _ in range(min(size_mb, file_size_mb)):
+            f.write(chunk)
+        f.close()
+
+
+def bytes_written(src, dst):
+    """
+    Size of the files in dst which do not share the inode with src
+    """
+    src_inodes = set()
+    for dirpath, dirnames, filenames in os.walk(src):
+        for filename in filenames:
+            src_inodes.add(os.lstat(os.path.join(dirpath, filename)).st_ino)
+
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(dst):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            if st.st_ino not in src_inodes:
+                total += st.st_size
+    return total
+
+
+def measure(name, copy, src, dst):
+    started = time.time()
+    copy(src, dst)
+    elapsed = time.time() - started
+    print "%-10s %8.3f s %12d bytes written" % (name, elapsed,
+                                                bytes_written(src, dst))
+
+
+def main(vcs="git", size_mb="256"):
+    tempdir = tempfile.mkdtemp(prefix="revisioncask_bench_")
+    try:
+        manager = managers[vcs](os.path.join(tempdir, "repos"))
+        manager.create_repository(manager.real_path("original"), "bench")
+        repo = manager.get_repo_object("bench", "original")
+        populate(repo, int(size_mb))
+
+        measure("copytree", shutil.copytree, repo.repo_path,
+                os.path.join(tempdir, "copytree"))
+        measure("copy_files",
+                lambda src, dst: repo.copy_files(dst),
+                repo.repo_path, os.path.join(tempdir, "copy_files"))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
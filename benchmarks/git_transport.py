@@ -0,0 +1,112 @@
+'''
+Compares clone throughput of handle_git running git through "git shell -c"
+against exec'ing git directly on the inherited stdio.
+
+A repository with incompressible content is cloned through handle_git
+using --upload-pack. Results are printed as JSON lines.
+
+usage: python -m benchmarks.git_transport [size in MB] [rounds]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+
+from revisioncask import git
+
+
+UPLOAD_PACK = """#!/bin/sh
+exec %(python)s -c '
+import sys
+from revisioncask import git
+class User(object):
+    username = "bench"
+    cmd = "git-upload-pack"
+git.config.REPOSITORIES = "%(repos)s"
+git.config.EXEC_TRANSPORT = "%(exec_transport)s"
+sys.exit(git.handle_git(User(), "git/bench"))
+'
+"""
+
+
+def create_repository(repos, size_mb):
+    manager = git.GitManager(repos)
+    manager.create_repository(manager.real_path("bench"), "bench")
+
+    work = tempfile.mkdtemp(prefix="revisioncask_work_")
+    try:
+        subprocess.check_call(["git", "init", "-q", work])
+        for i in range(size_mb):
+            f = open(os.path.join(work, "blob%d" % i), "wb")
+            f.write(os.urandom(1024 * 1024))
+            f.close()
+        subprocess.check_call(["git", "-C", work, "add", "."])
+        subprocess.check_call(["git", "-C", work, "-c", "user.name=bench",
+                               "-c", "user.email=bench@localhost",
+                               "commit", "-q", "-m", "bench"])
+        subprocess.check_call(["git", "-C", work, "push", "-q",
+                               manager.real_path("bench"), "HEAD:master"])
+    finally:
+        shutil.rmtree(work)
+
+
+def directory_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.lstat(os.path.join(dirpath, filename)).st_size
+    return total
+
+
+def clone(tempdir, exec_transport):
+    upload_pack = os.path.join(tempdir, "upload-pack-%s" % exec_transport)
+    f = open(upload_pack, "w")
+    f.write(UPLOAD_PACK % {"python": sys.executable,
+                           "repos": os.path.join(tempdir, "repos"),
+                           "exec_transport": exec_transport})
+    f.close()
+    os.chmod(upload_pack, 0700)
+
+    target = os.path.join(tempdir, "clone")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.time()
+    # file:// forces the pack protocol instead of a local copy
+    subprocess.check_call(["git", "clone", "-q", "--bare",
+                           "--upload-pack=" + upload_pack,
+                           "file://" + tempdir, target], env=env)
+    elapsed = time.time() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    received = directory_size(os.path.join(target, "objects"))
+    shutil.rmtree(target)
+
+    return {"exec_transport": exec_transport,
+            "seconds": elapsed,
+            "bytes": received,
+            "bytes_per_second": received / elapsed,
+            "cpu_user": after.ru_utime - before.ru_utime,
+            "cpu_sys": after.ru_stime - before.ru_stime}
+
+
+def main(size_mb="64", rounds="3"):
+    tempdir = tempfile.mkdtemp(prefix="revisioncask_bench_")
+    try:
+        create_repository(os.path.join(tempdir, "repos"), int(size_mb))
+        for _ in range(int(rounds)):
+            for exec_transport in ("false", "true"):
+                print json.dumps(clone(tempdir, exec_transport),
+                                 sort_keys=True)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
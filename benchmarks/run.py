@@ -0,0 +1,186 @@
+'''
+Runs the RepoManager command and authorization benchmarks over synthetic
+repository farms.
+
+Results are written as JSON lines, one line per (vcs, farm size,
+benchmark), so that results of different commits can be compared.
+
+usage: python -m benchmarks.run [options]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import subprocess
+from optparse import OptionParser
+
+from subssh import config
+
+from revisioncask.authz import Authorizer
+from benchmarks import farm
+
+
+class UserRequest(object):
+    def __init__(self, **kwargs):
+        self.__dict__ = kwargs
+
+
+class silenced(object):
+    """
+    Sends the output of the subssh commands to /dev/null
+    """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def bench_ls(manager, repo):
+    with silenced():
+        manager.ls(UserRequest(username=repo.get_owners()[0]))
+
+def bench_ls_mine(manager, repo):
+    with silenced():
+        manager.ls(UserRequest(username=repo.get_owners()[0]), "mine")
+
+def bench_info(manager, repo):
+    with silenced():
+        manager.info(UserRequest(username=repo.get_owners()[0]), repo.name)
+
+def bench_bulk_info(manager, repo):
+    with silenced():
+        manager.bulk_info(UserRequest(username=repo.get_owners()[0]),
+                          "owner:" + repo.get_owners()[0])
+
+def bench_set_permissions(manager, repo):
+    manager.set_permissions(UserRequest(username=repo.get_owners()[0]),
+                            "benchuser", "rw", repo.name)
+
+def bench_fork(manager, repo):
+    fork_path = manager.real_path("benchfork")
+    try:
+        with silenced():
+            manager.fork(UserRequest(username=repo.get_owners()[0]),
+                         repo.name, "benchfork")
+    finally:
+        shutil.rmtree(fork_path, ignore_errors=True)
+
+def bench_authorize(manager, repo):
+    Authorizer(manager.klass, store=manager.store).has_permissions(
+        repo.repo_path, "user0001", "r")
+
+def bench_authorize_vcs_object(manager, repo):
+    # The way handle_git used to authorize
+    manager.open_repository(repo.repo_path, config.ADMIN).has_permissions(
+        "user0001", "r")
+
+BENCHMARKS = { "ls":                    bench_ls,
+               "ls_mine":               bench_ls_mine,
+               "info":                  bench_info,
+               "bulk_info":             bench_bulk_info,
+               "set_permissions":       bench_set_permissions,
+               "fork":                  bench_fork,
+               "authorize":             bench_authorize,
+               "authorize_vcs_object":  bench_authorize_vcs_object }
+
+
+def commit_id():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(vcs, count, farm_dir, names, rounds, seed=0, legacy=False,
+        store=False):
+    """
+    Yields result dicts of the benchmarks
+    """
+    target = os.path.join(farm_dir, "%s-%d-%s" % (
+        vcs, count, "legacy" if legacy else "record"))
+    permission_store_path = None
+    if store:
+        # Outside of the farm so that the file backend runs are unaffected
+        permission_store_path = target + ".permissions.sqlite"
+
+    started = time.time()
+    manager = farm.generate(vcs, count, target, seed=seed, legacy=legacy,
+                            permission_store_path=permission_store_path)
+    generated = time.time() - started
+
+    # The first listing builds the index. Measure it separately.
+    started = time.time()
+    manager.index.repositories()
+    index_build = time.time() - started
+
+    yield {"benchmark": "index_build", "seconds": [index_build],
+           "generate_seconds": generated}
+
+    rnd = random.Random(seed)
+    repos = manager.index.repositories()
+    for name in names:
+        timings = []
+        for _ in range(rounds):
+            repo = rnd.choice(repos)
+            started = time.time()
+            BENCHMARKS[name](manager, repo)
+            timings.append(time.time() - started)
+        yield {"benchmark": name, "seconds": timings}
+
+
+def main(args=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--vcs", default="git,hg,svn",
+                      help="Comma separated list of VCSs")
+    parser.add_option("--sizes", default="1000,10000,100000",
+                      help="Comma separated list of farm sizes")
+    parser.add_option("--benchmarks", default=",".join(sorted(BENCHMARKS)),
+                      help="Comma separated list of benchmarks")
+    parser.add_option("--rounds", type="int", default=5)
+    parser.add_option("--farm-dir", default="/tmp/revisioncask-farms",
+                      help="Farms are generated here and reused")
+    parser.add_option("--output", help="Append results to this file")
+    parser.add_option("--legacy", action="store_true",
+                      help="Use repositories without the access record")
+    parser.add_option("--store", action="store_true",
+                      help="Read permissions from the permission store")
+    options, _ = parser.parse_args(args)
+
+    common = {"commit": commit_id(),
+              "python": platform.python_version(),
+              "time": int(time.time())}
+
+    out = open(options.output, "a") if options.output else sys.stdout
+    try:
+        for vcs in options.vcs.split(","):
+            for count in options.sizes.split(","):
+                for result in run(vcs, int(count), options.farm_dir,
+                                  options.benchmarks.split(","),
+                                  options.rounds, legacy=options.legacy,
+                                  store=options.store):
+                    seconds = sorted(result["seconds"])
+                    result.update(common)
+                    result.update({"vcs": vcs,
+                                   "legacy": bool(options.legacy),
+                                   "store": bool(options.store),
+                                   "repos": int(count),
+                                   "min": seconds[0],
+                                   "median": seconds[len(seconds) / 2]})
+                    out.write(json.dumps(result, sort_keys=True) + "\n")
+                    out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+'''
+Measures import and initialization cost of the revisioncask entry points.
+
+Every entry point is measured in a fresh interpreter, like an ssh
+connection would see it. Results are printed as JSON lines.
+
+usage: python benchmarks/startup.py [rounds]
+'''
+
+import os
+import sys
+import json
+import subprocess
+
+
+# name -> (module to import, initialization code run after the import)
+ENTRY_POINTS = {
+    "zygote-client": ("revisioncask.zygote", ""),
+    "plugins":       ("revisioncask.plugins", ""),
+    "git":           ("revisioncask.git", ""),
+    "git-manager":   ("revisioncask.plugins",
+                      "revisioncask.plugins.get_manager('git')"),
+    "hg":            ("revisioncask.hg", ""),
+    "svn":           ("revisioncask.svn", ""),
+}
+
+PROBE = """
+import sys, time
+modules_before = set(sys.modules)
+started = time.time()
+import %(module)s
+imported = time.time()
+%(init)s
+done = time.time()
+import json
+print json.dumps({"import": imported - started,
+                  "init": done - imported,
+                  "modules": sorted(set(sys.modules) - modules_before)})
+"""
+
+
+def measure(module, init=""):
+    """
+    Returns dict with import and init times in seconds and the list of
+    modules loaded by the import.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    output = subprocess.check_output([sys.executable, "-c",
+                                      PROBE % {"module": module,
+                                               "init": init}],
+                                     env=env)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(rounds="5"):
+    for name, (module, init) in sorted(ENTRY_POINTS.items()):
+        results = [measure(module, init) for _ in range(int(rounds))]
+        print json.dumps({
+            "entry_point": name,
+            "import_min": min(r["import"] for r in results),
+            "init_min": min(r["init"] for r in results),
+            "modules": len(results[0]["modules"]),
+        })
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
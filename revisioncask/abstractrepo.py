@@ -20,12 +20,20 @@ License along with Subssh.  If not, see
 """
 
 import os
+import json
+import errno
 import shutil
-from ConfigParser import SafeConfigParser, NoOptionError
+from contextlib import contextmanager
+from ConfigParser import SafeConfigParser
 
 import subssh
 from subssh.dirtools import create_required_directories_or_die
 
+from fstools import copytree_linked, atomic_write, file_lock
+from reaper import move_to_trash
+import metrics
+import groups
+
 
 class InvalidRepository(IOError, subssh.UserException):
     pass
@@ -38,6 +46,86 @@ class InvalidPermissions(subssh.UserException):
     pass
 
 
+def match_permissions(granted, username, permissions,
+                      permission_groups=None):
+    """
+    Checks required permissions against a dict of username/permission
+    string pairs as read from the permission database.
+
+    Permissions of '*' are given to every user and permissions of '@group'
+    to the members of the group in permission_groups.
+    """
+    permissions_got = set()
+
+    # First get general permissions and user specific permissions. Usernames
+    # are lower cased by the ConfigParser.
+    permissions_got.update(granted.get("*", ""))
+    permissions_got.update(granted.get(username.lower(), ""))
+    # Membership is precompiled. Only the groups of the user are looked up.
+    for group in groups.member_of(permission_groups, username):
+        permissions_got.update(granted.get(group, ""))
+
+    # Iterate through required permissions
+    for perm in permissions:
+        # If even one is missing bail out!
+        if perm not in permissions_got:
+            return False
+
+    # Everything was found
+    return True
+
+
+ACCESS_RECORD_VERSION = 1
+
+
+def encode_access_record(owners, permissions):
+    """
+    Returns the access record of owners and username/permissions dict
+    """
+    return json.dumps({"version": ACCESS_RECORD_VERSION,
+                       "owners": sorted(owners),
+                       "permissions": permissions},
+                      sort_keys=True, separators=(",", ":"))
+
+
+def read_access_record(path):
+    """
+    Returns (owners, permissions dict) from the access record or None if the
+    repository does not have one yet
+    """
+    try:
+        f = open(path)
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    try:
+        record = json.loads(data)
+    except ValueError:
+        raise BrokenRepository("Broken access record %s" % path)
+    if record.get("version") != ACCESS_RECORD_VERSION:
+        raise BrokenRepository("Unknown version of access record %s" % path)
+    return record["owners"], record["permissions"]
+
+
+class lazy_setting(object):
+    """
+    Config value which is computed when it's read instead of when the module
+    is imported. Subssh config can still override it with a plain value.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __get__(self, obj, cls):
+        return self.function()
+
+
 def vcs_init(config):
     create_required_directories_or_die((config.REPOSITORIES, config.HOOKS_DIR))
 
@@ -53,12 +141,38 @@ class VCS(object):
 
     _permissions_section = "permissions"
 
+    # Owners and permissions of the repository. Native permission files of
+    # the VCS are generated from it.
+    access_record_name = "subssh_access.json"
+
+    # Permission and owner files of the repositories created before the
+    # access record. They are read if the access record is missing.
     permdb_name="subssh_permissions"
 
     owner_filename="subssh_owners"
 
+    # Files removed when the access record is written. Native files the VCS
+    # reads itself are not listed here.
+    legacy_files = (permdb_name, owner_filename)
+
+    lock_filename="subssh.lock"
+
     known_permissions = "rw"
 
+    # Directories containing files that the VCS never modifies in place.
+    # Forks can share these files using hard links.
+    immutable_dirs = ()
+
+    # Files and directories whose mtimes change on every push or commit and
+    # additionally the ones changing when the size changes otherwise, eg.
+    # on repack. Paths ending with a slash are checked with all their
+    # subdirectories.
+    push_markers = ()
+    size_markers = ()
+
+    # groups.Groups of the VCS set by groups.enable_from. None if disabled.
+    permission_groups = None
+
 
     admin_name = "admin"
 
@@ -67,9 +181,14 @@ class VCS(object):
     suffix = ""
 
 
-    def __init__(self, repo_path, requester, create=False):
+    def __init__(self, repo_path, requester, create=False, store=None,
+                 templates=None):
         self.requester = requester
         self.repo_path = repo_path
+        # Optional PermissionStore. The files are used when it's None.
+        self.store = store
+        # Optional RepoTemplates used for creating the repository files
+        self.templates = templates
         self._owners = set()
 
         if create:
@@ -85,7 +204,12 @@ class VCS(object):
         Sets initial permissions.
         """
         self._init_repository_location()
-        self._create_repository_files()
+        if self.templates is not None and self.templates.copy_to(self):
+            self._fix_template_copy()
+        else:
+            self._create_repository_files()
+            if self.templates is not None:
+                self.templates.save(self)
         self._load_permissions()
         # When creating new repository the requester is always the owner
         self.add_owner(self.requester)
@@ -101,6 +225,7 @@ class VCS(object):
         self._load_permissions()
         self._assert_can_manage()
 
+    @metrics.timed(metrics.PHASE, phase="validate")
     def _assert_valid_repository(self):
         """
         Lets do some assertions that this really is repository directory that
@@ -125,6 +250,20 @@ class VCS(object):
     def _create_repository_files(self):
         raise NotImplementedError
 
+    @classmethod
+    def template_key(cls):
+        """
+        Returns a string identifying the files _create_repository_files
+        creates, eg. the version of the VCS. Templates of new repositories
+        are rebuilt when it changes.
+        """
+        raise NotImplementedError
+
+    def _fix_template_copy(self):
+        """
+        Makes the files copied from a template unique to this repository
+        """
+
 
 
     def _init_repository_location(self):
@@ -143,18 +282,51 @@ class VCS(object):
 
 
 
+    @metrics.timed(metrics.PHASE, phase="load_permissions")
     def _load_permissions(self):
+        self._set_filepaths()
+
+        record = None
+        if self.store is not None:
+            record = self.store.load(self.name_on_fs)
+        if record is None:
+            record = read_access_record(self.record_filepath)
+        if record is None:
+            owners, permissions = self._read_legacy_access()
+        else:
+            owners, permissions = record
 
+        self._owners.update(owners)
+        self._permissions = dict(permissions)
+
+    def _set_filepaths(self):
+        self.record_filepath = os.path.join(self.repo_path,
+                                            self.access_record_name)
         self.permdb_filepath = os.path.join(self.repo_path, self.permdb_name)
         self.owner_filepath = os.path.join(self.repo_path, self.owner_filename)
 
-        self.permdb = SafeConfigParser()
-        self.permdb.read(self.permdb_filepath)
+    def _read_legacy_access(self):
+        """
+        Returns (owners, permissions dict) from the files used before the
+        access record
+        """
+        permdb = SafeConfigParser()
+        permdb.read(self.permdb_filepath)
+
+        permissions = {}
+        if permdb.has_section(self._permissions_section):
+            permissions = dict(permdb.items(self._permissions_section))
 
-        if not self.permdb.has_section(self._permissions_section):
-            self.permdb.add_section(self._permissions_section)
+        return self._read_legacy_owners(permdb), permissions
 
-        self._read_owners()
+    def _read_legacy_owners(self, permdb):
+        owners = []
+        if os.path.exists(self.owner_filepath):
+            f = open(self.owner_filepath, "r")
+            for owner in f:
+                owners.append(owner.strip())
+            f.close()
+        return owners
 
 
 
@@ -163,14 +335,6 @@ class VCS(object):
 
 
 
-    def _read_owners(self):
-        if os.path.exists(self.owner_filepath):
-            f = open(self.owner_filepath, "r")
-            for owner in f:
-                self._owners.add(owner.strip())
-            f.close()
-
-
     @property
     def name(self):
         name = os.path.basename(self.repo_path)
@@ -203,26 +367,64 @@ class VCS(object):
 
 
 
-    def delete(self):
+    def delete(self, trash_path=None):
         """
         Deletes whole repository
-        Cannot be undone!
+
+        If trash_path is given the repository is just moved there and a reaper
+        will delete it later. Otherwise this cannot be undone!
         """
         # TODO: Should this in the repository manager?
-        shutil.rmtree(self.repo_path)
+        if trash_path is None:
+            shutil.rmtree(self.repo_path)
+            return
+
+        # Rename is atomic and fast as long as the trash is on the same
+        # filesystem.
+        move_to_trash(self.repo_path, trash_path, self.name_on_fs)
+
+
+    def _is_immutable(self, relpath):
+        for immutable_dir in self.immutable_dirs:
+            if relpath.startswith(immutable_dir + "/"):
+                return True
+        return False
+
+    def copy_files(self, target_path):
+        """
+        Copies repository files to target_path. Files in immutable_dirs are
+        hard linked when possible.
+        """
+        copytree_linked(self.repo_path, target_path, self._is_immutable)
 
 
     def rename(self, new_repo_name):
         repo_dir = os.path.dirname(self.repo_path)
-        new_path = os.path.join(repo_dir, new_repo_name.strip("/ "))
+        self.move_to(os.path.join(repo_dir, new_repo_name.strip("/ ")))
+
+    def move_to(self, new_path):
+        """
+        Moves the repository to new_path. Parent directories are created.
+        """
+        parent = os.path.dirname(new_path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
 
         shutil.move(self.repo_path, new_path)
 
+        old_name_on_fs = self.name_on_fs
         self.repo_path = new_path
+        self._set_filepaths()
+
+        if self.store is not None and old_name_on_fs != self.name_on_fs:
+            self.store.rename(old_name_on_fs, self.name_on_fs, self.name)
 
 
     def remove_owner(self, username):
-        if len(self._owners) == 1 and self.is_owner(username):
+        if not self.is_owner(username):
+            raise InvalidPermissions("%s is not owner of %s"
+                                     % (username, self))
+        if len(self._owners) == 1:
             raise InvalidPermissions("Cannot remove last owner %s" % username)
         self._owners.remove(username)
 
@@ -264,18 +466,24 @@ class VCS(object):
 
 
 
+        if (current_permissions and groups.is_group(username)
+            and not groups.exists(self.permission_groups, username)):
+            # svnserve would refuse the whole authz file
+            raise InvalidPermissions("Group %s is not defined" % username)
+
         # Remove user name from the permissions file if user has no permissions
         if not current_permissions:
             self.remove_permissions(username)
         else:
-            self.permdb.set(self._permissions_section, username,
-                            "".join(current_permissions))
+            # Usernames are case insensitive like they were in the INI files
+            self._permissions[username.lower()] = "".join(
+                p for p in self.known_permissions if p in current_permissions)
 
 
 
     def get_all_permissions(self):
         """Return a list of tuples with (username, permissions)"""
-        return sorted(self.permdb.items(self._permissions_section))
+        return sorted(self._permissions.items())
 
     # TODO: make private
     def remove_all_permissions(self):
@@ -292,63 +500,87 @@ class VCS(object):
 
 
 
+    @metrics.timed(metrics.PHASE, phase="has_permissions")
     def has_permissions(self, username, permissions):
         self.assert_permissions(permissions)
-        permissions_got = set()
-
-        try: # First get general permissions
-            for p in self.permdb.get(self._permissions_section, "*"):
-                permissions_got.add(p)
-        except NoOptionError:
-            pass
-
-        try: # and user specific permissions
-            for p in self.permdb.get(self._permissions_section, username):
-                permissions_got.add(p)
-        except NoOptionError:
-            pass
-
-        # Iterate through required permissions
-        for perm in permissions:
-            # If even one is missing bail out!
-            if perm not in permissions_got:
-                return False
-
-        # Everything was found
-        return True
+        return match_permissions(dict(self.get_all_permissions()),
+                                 username, permissions,
+                                 self.permission_groups)
 
     def get_permissions(self, username):
         try:
-            return self.permdb.get(self._permissions_section,
-                                   username)
-        except NoOptionError:
+            return self._permissions[username.lower()]
+        except KeyError:
             raise InvalidPermissions("No such user %s" % username)
 
 
 
     def remove_permissions(self, username):
         try:
-            self.permdb.remove_option(self._permissions_section, username)
-        except NoOptionError:
+            del self._permissions[username.lower()]
+        except KeyError:
             raise InvalidPermissions("No such user %s" % username)
 
 
 
-    def write_owners(self):
-        f = open(self.owner_filepath, "w")
-        for owner in self._owners:
-            f.write(owner + "\n")
-        f.close()
+    def write_access_record(self):
+        atomic_write(self.record_filepath,
+                     encode_access_record(self._owners, self._permissions))
 
-    def write_permissions(self):
-        f = open(self.permdb_filepath, "w")
-        self.permdb.write(f)
-        f.close()
+    def write_native_access(self):
+        """
+        Generates the permission files the VCS reads itself from the owners
+        and permissions
+        """
+
+    def _remove_legacy_files(self):
+        for filename in self.legacy_files:
+            try:
+                os.remove(os.path.join(self.repo_path, filename))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds exclusive lock of the repository while in the with block.
+
+        Permissions and owners are reloaded after the lock is acquired so
+        that modifications are made on top of the latest saved state. Readers
+        never take the lock. They see either the old or the new files
+        because save() replaces them atomically.
+        """
+        with file_lock(os.path.join(self.repo_path, self.lock_filename)):
+            self._owners = set()
+            self._load_permissions()
+            self._assert_can_manage()
+            yield self
 
     def save(self):
-        self.write_owners()
-        self.write_permissions()
+        if self.store is not None:
+            self.store.save(self.name_on_fs, self.name, self._owners,
+                            self._permissions)
+        # The record is written also with the store. It goes to the trash
+        # with the repository and keeps working if the store is disabled.
+        self.write_access_record()
+        self.write_native_access()
+        self._remove_legacy_files()
 
     def set_hooks(self, hooks):
         raise NotImplementedError
 
+    def install_push_hook(self, queue_path):
+        """
+        Installs hook queuing the repository for maintenance after pushes
+        """
+        raise NotImplementedError
+
+    def maintenance_commands(self, upgrade_storage=False):
+        """
+        Returns commands run in the repository by the maintenance scheduler.
+        Commands rewriting the storage format are included only if
+        upgrade_storage is True.
+        """
+        return ()
+
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+
+Accounting of the transport sessions.
+
+The transport process is run with its stdin and stdout relayed through pipes
+so that the bytes in both directions can be counted. The wall time and the
+rusage of the process are recorded with the bytes per (user, repository,
+command) to an append-only log of JSON lines.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import atexit
+import threading
+
+
+LOG_NAME = "accounting.log"
+
+CHUNK_SIZE = 64 * 1024
+
+# The log is rotated to <log>.1 when it grows over this
+MAX_LOG_SIZE = 64 * 1024 * 1024
+
+# Summary fields and the record fields they are summed from
+SUMMARY_FIELDS = ("sessions", "cpu", "wall", "bytes_in", "bytes_out")
+
+
+class AccountingLog(object):
+    """
+    Buffers the records and appends them to the log in batches
+    """
+
+    batch_size = 100
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.path = os.path.join(log_dir, LOG_NAME)
+        self.buffer = []
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(record)
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        from metrics import append_line
+
+        with self.lock:
+            records, self.buffer = self.buffer, []
+        if not records:
+            return
+
+        data = "".join(json.dumps(record, sort_keys=True) + "\n"
+                       for record in records)
+        try:
+            if not os.path.exists(self.log_dir):
+                os.makedirs(self.log_dir)
+            self._rotate()
+            append_line(self.path, data)
+        except (IOError, OSError), e:
+            # Accounting must never break the commands
+            sys.stderr.write("Failed to write accounting log: %s\n" % e)
+
+    def _rotate(self):
+        try:
+            if os.stat(self.path).st_size > MAX_LOG_SIZE:
+                os.rename(self.path, self.path + ".1")
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+
+def read_records(log_dir, since=0):
+    """
+    Yields records of the log written after since
+    """
+    log_path = os.path.join(log_dir, LOG_NAME)
+    for path in (log_path + ".1", log_path):
+        try:
+            f = open(path)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partially written line
+                    continue
+                if record["time"] >= since:
+                    yield record
+        finally:
+            f.close()
+
+
+def _copy(source, target, counter):
+    """
+    Copies from source fd to target fd until EOF. Adds the bytes to
+    counter[0].
+    """
+    try:
+        while True:
+            data = os.read(source, CHUNK_SIZE)
+            if not data:
+                break
+            counter[0] += len(data)
+            while data:
+                written = os.write(target, data)
+                data = data[written:]
+    except OSError, e:
+        # The other end is gone
+        if e.errno != errno.EPIPE:
+            raise
+
+
+class Session(object):
+    """
+    Accounting of one transport session
+    """
+
+    def __init__(self, log, vcs, username, repo, command):
+        self.log = log
+        self.record = {"vcs": vcs,
+                       "user": username,
+                       "repo": repo,
+                       "command": command}
+
+    def call(self, argv, stdin=0, stdout=1):
+        """
+        Runs argv relaying stdin and stdout. Returns the exit code.
+        """
+        import subprocess
+
+        sys.stdout.flush()
+        started = time.time()
+        process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, close_fds=True)
+
+        bytes_in = [0]
+        bytes_out = [0]
+
+        def feed():
+            try:
+                _copy(stdin, process.stdin.fileno(), bytes_in)
+            finally:
+                process.stdin.close()
+
+        # The client may never close its end, so this thread is not waited
+        # for after the process has exited
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        _copy(process.stdout.fileno(), stdout, bytes_out)
+        # Process writing to a client which went away gets EPIPE
+        process.stdout.close()
+
+        pid, status, rusage = os.wait4(process.pid, 0)
+        # Keep Popen from waiting for it again
+        process.returncode = code = (os.WEXITSTATUS(status)
+                                     if os.WIFEXITED(status)
+                                     else 128 + os.WTERMSIG(status))
+
+        self.record.update({"time": started,
+                            "wall": time.time() - started,
+                            "bytes_in": bytes_in[0],
+                            "bytes_out": bytes_out[0],
+                            "utime": rusage.ru_utime,
+                            "stime": rusage.ru_stime,
+                            "maxrss": rusage.ru_maxrss,
+                            "exit": code})
+        self.log.write(self.record)
+        return code
+
+
+def summarize(records, group_by=("user", "repo", "command"), order_by="cpu",
+              limit=20):
+    """
+    Sums the records by group_by fields. Returns list of (group, totals)
+    tuples of the top consumers ordered by order_by.
+    """
+    totals = {}
+    for record in records:
+        group = tuple(record.get(field) for field in group_by)
+        if group not in totals:
+            totals[group] = dict.fromkeys(SUMMARY_FIELDS, 0)
+        total = totals[group]
+        total["sessions"] += 1
+        total["cpu"] += record["utime"] + record["stime"]
+        total["wall"] += record["wall"]
+        total["bytes_in"] += record["bytes_in"]
+        total["bytes_out"] += record["bytes_out"]
+
+    top = sorted(totals.items(), key=lambda item: item[1][order_by],
+                 reverse=True)
+    return top[:limit]
+
+
+_logs = {}
+
+def session(config, vcs, username, repo, command):
+    """
+    Returns Session if ACCOUNTING is enabled in the config of the VCS,
+    otherwise None
+    """
+    import subssh
+    if not subssh.to_bool(config.ACCOUNTING):
+        return None
+    log_dir = config.ACCOUNTING_DIR
+    if log_dir not in _logs:
+        _logs[log_dir] = AccountingLog(log_dir)
+    return Session(_logs[log_dir], vcs, username, repo, command)
+
+
+def flush():
+    """
+    Writes the buffered records of all logs
+    """
+    for log in _logs.values():
+        log.flush()
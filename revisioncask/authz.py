@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+from ConfigParser import SafeConfigParser
+
+from abstractrepo import InvalidRepository, InvalidPermissions
+from abstractrepo import match_permissions, read_access_record
+import metrics
+
+
+# Permission files modified more recently than this are not cached. They
+# might be rewritten within the same mtime tick without the stat changing.
+FRESHNESS_WINDOW = 2
+
+
+class Authorizer(object):
+    """
+    Read-only permission checker for the transport commands.
+
+    Answers whether user may read or write a repository without building
+    the VCS object. Parsed access records are cached by their inode,
+    mtime and size. Repositories without the access record are served from
+    their old permission files.
+
+    With a PermissionStore the permissions are read from the store and the
+    files are used only for the repositories missing from it.
+    """
+
+    def __init__(self, klass, store=None):
+        self.klass = klass
+        self.store = store
+        self._cache = {}
+
+    def _parse(self, path):
+        if path.endswith(self.klass.access_record_name):
+            return read_access_record(path)[1]
+        return self._parse_legacy(path)
+
+    def _parse_legacy(self, permdb_path):
+        permdb = SafeConfigParser()
+        permdb.read(permdb_path)
+
+        section = self.klass._permissions_section
+        if not permdb.has_section(section):
+            return {}
+        return dict(permdb.items(section))
+
+    def get_all_permissions(self, repo_path):
+        """
+        Returns a dict of username/permissions pairs of the repository
+        """
+        if os.path.basename(repo_path).startswith("."):
+            raise InvalidRepository("Repository '%s' does not exists!" %
+                                    os.path.basename(repo_path))
+
+        if self.store is not None:
+            permissions = self.store.get_all_permissions(
+                os.path.basename(repo_path))
+            if permissions is not None:
+                return permissions
+
+        for name in (self.klass.access_record_name, self.klass.permdb_name):
+            path = os.path.join(repo_path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            break
+        else:
+            if not os.path.isdir(repo_path):
+                raise InvalidRepository("Repository '%s' does not exists!" %
+                                        os.path.basename(repo_path))
+            # No permission file means no permissions
+            return {}
+
+        key = (st.st_ino, st.st_mtime, st.st_size)
+
+        try:
+            cached_key, permissions = self._cache[path]
+        except KeyError:
+            pass
+        else:
+            if cached_key == key:
+                return permissions
+
+        permissions = self._parse(path)
+
+        if time.time() - st.st_mtime > FRESHNESS_WINDOW:
+            self._cache[path] = (key, permissions)
+        else:
+            self._cache.pop(path, None)
+
+        return permissions
+
+    @metrics.timed(metrics.PHASE, phase="has_permissions")
+    def has_permissions(self, repo_path, username, permissions):
+        for p in permissions:
+            if p not in self.klass.known_permissions:
+                raise InvalidPermissions("Unknown permission %s" % p)
+
+        return match_permissions(self.get_all_permissions(repo_path),
+                                 username, permissions,
+                                 self.klass.permission_groups)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import os
+import stat
+import fcntl
+import errno
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+# Errors meaning that hard links cannot be used for this copy
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP)
+
+
+def copytree_linked(src, dst, is_immutable=lambda relpath: False):
+    """
+    Copies directory tree like shutil.copytree, but hard links the files for
+    which is_immutable(relpath) returns True. Such files must never be
+    modified in place.
+
+    Falls back to copying if hard links cannot be created, eg. when src and
+    dst are on different filesystems.
+    """
+    can_link = True
+    copied_dirs = []
+
+    for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+        reldir = os.path.relpath(dirpath, src)
+        if reldir == os.curdir:
+            reldir = ""
+
+        target_dir = os.path.join(dst, reldir)
+        os.makedirs(target_dir)
+
+        for filename in filenames:
+            relpath = os.path.join(reldir, filename)
+            source = os.path.join(src, relpath)
+            target = os.path.join(dst, relpath)
+
+            if can_link and is_immutable(relpath):
+                try:
+                    os.link(os.path.realpath(source), target)
+                    continue
+                except OSError, e:
+                    if e.errno not in LINK_ERRORS:
+                        raise
+                    can_link = False
+
+            shutil.copy2(source, target)
+
+        copied_dirs.append((dirpath, target_dir))
+
+    # Set directory times after all files have been created like copytree
+    for dirpath, target_dir in reversed(copied_dirs):
+        shutil.copystat(dirpath, target_dir)
+
+
+def directory_size(path):
+    """
+    Returns the total size of the files in the directory tree
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError, e:
+                # Removed while walking
+                if e.errno != errno.ENOENT:
+                    raise
+    return total
+
+
+def atomic_write(path, data):
+    """
+    Replaces file contents atomically. Readers see either the old or the new
+    file, never a partially written one.
+    """
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + filename + ".",
+                                    dir=directory or os.curdir)
+    try:
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            mode = 0644
+        os.fchmod(fd, mode)
+
+        f = os.fdopen(fd, "w")
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """
+    Holds an exclusive advisory lock on path while in the with block.
+
+    If blocking is False and the lock is held by someone else IOError with
+    errno EAGAIN or EACCES is raised.
+    """
+    lock_file = open(path, "a")
+    try:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        fcntl.flock(lock_file.fileno(), flags)
+        yield
+    finally:
+        # Closing releases the lock
+        lock_file.close()
@@ -20,6 +20,7 @@ License along with Subssh.  If not, see
 """
 
 import os
+import sys
 import re
 
 
@@ -27,23 +28,183 @@ import subssh
 
 from abstractrepo import VCS
 from abstractrepo import InvalidPermissions
-from abstractrepo import vcs_init
+from abstractrepo import lazy_setting
 from repomanager import RepoManager
+import metrics
+import groups
+import accounting
+from authz import Authorizer
+import permstore
+import repolayout
+from fstools import atomic_write
+from repotemplate import binary_stamp
+from maintenance import install_hook_script
 
 
 class config:
     GIT_BIN = "git"
 
-    REPOSITORIES = os.path.join(subssh.config.SUBSSH_HOME, "vcs", "git", "repos")
-    HOOKS_DIR = os.path.join(subssh.config.SUBSSH_HOME, "vcs", "git", "hooks")
+    REPOSITORIES = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                     "vcs", "git", "repos"))
+    HOOKS_DIR = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                  "vcs", "git", "hooks"))
 
     MANAGER_TOOLS = "true"
 
+    # Replace the subssh process with git after the permission check instead
+    # of running it through "git shell -c"
+    EXEC_TRANSPORT = "false"
+
+    # Server side settings written to the config of new repositories. Space
+    # separated key=value pairs. Keys must be in SERVER_OPTION_KEYS.
+    # uploadpack.allowAnySHA1InWant=true is opt-in: it lets every reader
+    # fetch unreachable objects, eg. force pushed away or deleted secrets.
+    SERVER_OPTIONS = "uploadpack.allowFilter=true"
+
+    # Size limit of the pack cache in megabytes. Packs sent to cloning
+    # clients are cached and reused for identical clones. 0 disables.
+    PACK_CACHE_SIZE = "0"
+    PACK_CACHE_DIR = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "git", "packcache"))
+
+    # Queue pushed repositories for maintenance run by
+    # "python -m revisioncask.maintenance"
+    MAINTENANCE = "false"
+    MAINTENANCE_DIR = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "git", "maintenance"))
+    MAINTENANCE_WORKERS = "1"
+    # Minimum seconds between maintenance runs of a repository
+    MAINTENANCE_INTERVAL = "3600"
+
+    # Write latency histograms to METRICS_DIR. Exported in Prometheus format
+    # with "python -m revisioncask.metrics <METRICS_DIR>"
+    METRICS = "false"
+    METRICS_DIR = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                    "metrics"))
+
+    # Record bytes, wall time and CPU of the transport sessions to
+    # ACCOUNTING_DIR. The transport process is run with relayed stdio.
+    ACCOUNTING = "false"
+    ACCOUNTING_DIR = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "accounting"))
+
+    # Keep owners and permissions in a SQLite database instead of reading
+    # them from the repositories. Run import_permission_store after enabling.
+    PERMISSION_STORE = "false"
+    PERMISSION_STORE_PATH = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "git", "permissions.sqlite"))
+
+    # Allow giving permissions to the groups of PERMISSION_GROUPS_FILE with
+    # '@group'. The file is shared by all VCSs.
+    PERMISSION_GROUPS = "false"
+    PERMISSION_GROUPS_FILE = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "permission_groups"))
+
+    # Spread the repositories to hashed subdirectories. Existing
+    # repositories are moved with shard_repositories.
+    SHARDED_LAYOUT = "false"
+
+    # Copy new repositories from a pre-built empty repository instead of
+    # running the VCS. The template is rebuilt when the VCS is upgraded.
+    REPOSITORY_TEMPLATES = "false"
+
+    # Keep the gitweb list of the web enabled repositories in
+    # WEB_PROJECT_LIST_PATH so that it does not need to scan WEB_DIR
+    WEB_PROJECT_LIST = "false"
+    WEB_PROJECT_LIST_PATH = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "git", "projects_list"))
+
+    # Seconds deleted repositories can be restored with undelete. With a
+    # grace period nothing is removed unless a cron job runs
+    # "python -m revisioncask.reaper --grace <seconds> <REPOSITORIES>/.trash"
+    DELETE_GRACE_PERIOD = "0"
+    REAPER_WORKERS = "1"
+    # Maximum number of files removed per second. 0 is unlimited.
+    REAPER_FILES_PER_SECOND = "1000"
+
     URL_RW =  "ssh://$hostusername@$hostname/git/$name_on_fs"
     URL_HTTP_CLONE =  "http://$hostname/repo/$name_on_fs"
     URL_WEB_VIEW =  "http://$hostname/viewgit/?a=summary&p=$name_on_fs"
 
-    WEB_DIR = os.path.join( os.environ["HOME"], "repos", "webgit" )
+    WEB_DIR = lazy_setting(lambda: os.path.join(os.environ["HOME"],
+                                                "repos", "webgit"))
+
+
+# Server side settings repository owners may change. All are booleans. Other
+# keys like core.hooksPath would allow running arbitrary commands.
+SERVER_OPTION_KEYS = ("uploadpack.allowfilter",
+                      "uploadpack.allowanysha1inwant",
+                      "uploadpack.allowreachablesha1inwant",
+                      "uploadpack.allowtipsha1inwant",
+                      "uploadpack.allowrefinwant",
+                      "uploadpack.allowsidebandall",
+                      "receive.advertisepushoptions")
+
+# Value of GIT_PROTOCOL is colon separated list of key or key=value items,
+# for example "version=2"
+valid_git_protocol = re.compile(r"^[a-zA-Z0-9.=:\-]+$")
+
+
+def parse_server_options(options):
+    """
+    Parses space separated key=value pairs to list of (key, value) tuples
+    """
+    parsed = []
+    for option in options.split():
+        key, sep, value = option.partition("=")
+        if not sep:
+            raise subssh.InvalidArguments("Bad server option '%s'" % option)
+        parsed.append(validate_server_option(key, value))
+    return parsed
+
+
+def validate_server_option(key, value):
+    if key.lower() not in SERVER_OPTION_KEYS:
+        raise subssh.InvalidArguments("Unknown server option '%s'" % key)
+    if value.lower() not in ("true", "false"):
+        raise subssh.InvalidArguments("Value of %s must be true or false"
+                                      % key)
+    return key, value.lower()
+
+
+def clean_protocol_env():
+    """
+    Keeps GIT_PROTOCOL from the client only if it looks like one. It is
+    passed to git so that clients can ask for protocol v2.
+    """
+    protocol = os.environ.get("GIT_PROTOCOL")
+    if protocol is not None and not valid_git_protocol.match(protocol):
+        del os.environ["GIT_PROTOCOL"]
+
+
+def run_git_command(repo_path, cmd, git_bin="git", exec_transport=False,
+                    session=None):
+    """
+    Runs transport command on the repository. Permissions must be checked
+    before calling this.
+
+    If exec_transport is True this process is replaced with the git command
+    running directly on the inherited stdio, and this never returns.
+    Otherwise the command is accounted to the accounting session if given.
+    """
+    clean_protocol_env()
+
+    if exec_transport:
+        # git-upload-pack -> git upload-pack. No shell, no quoting.
+        argv = (git_bin, cmd[len("git-"):], repo_path)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Nothing is written after exec
+        metrics.flush()
+        os.execvp(git_bin, argv)
+
+    shell_cmd = cmd + " '%s'" %  repo_path
+
+    argv = (git_bin, "shell", "-c", shell_cmd)
+    with metrics.timer(metrics.PHASE, phase="git_process"):
+        if session is not None:
+            return session.call(argv)
+        return subssh.call(argv)
 
 
 class Git(VCS):
@@ -52,6 +213,16 @@ class Git(VCS):
                                "objects",
                                "hooks")
 
+    # Packs and loose objects are never modified, only created and removed
+    immutable_dirs = (("objects/pack",) +
+                      tuple("objects/%02x" % i for i in range(256)))
+
+    # Refs are written through lock files in their directories and
+    # objects either to new packs or to the fan-out directories
+    push_markers = ("packed-refs", "refs/")
+    size_markers = (("objects", "objects/pack") +
+                    tuple("objects/%02x" % i for i in range(256)))
+
     permissions_required = { "git-upload-pack":    "r",
                              "git-upload-archive": "r",
                              "git-receive-pack":   "rw" }
@@ -63,14 +234,31 @@ class Git(VCS):
             raise InvalidPermissions("%s has no permissions to run %s on %s" %
                                      (username, cmd, self.name))
 
-        shell_cmd = cmd + " '%s'" %  self.repo_path
-
-        return subssh.call((git_bin, "shell", "-c", shell_cmd))
+        return run_git_command(self.repo_path, cmd, git_bin=git_bin)
 
     def set_description(self, description):
-        f = open(os.path.join(self.repo_path, "description"), 'w')
-        f.write(description)
-        f.close()
+        atomic_write(os.path.join(self.repo_path, "description"), description)
+
+    def set_server_option(self, key, value):
+        key, value = validate_server_option(key, value)
+        subssh.check_call((config.GIT_BIN, "config", "--file",
+                           os.path.join(self.repo_path, "config"),
+                           key, value))
+
+    def get_server_options(self):
+        """
+        Returns list of (key, value) tuples of the server options set to the
+        repository
+        """
+        import subprocess
+        pattern = "^(%s)$" % "|".join(k.replace(".", "\\.")
+                                      for k in SERVER_OPTION_KEYS)
+        process = subprocess.Popen((config.GIT_BIN, "config", "--file",
+                                    os.path.join(self.repo_path, "config"),
+                                    "--get-regexp", pattern),
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        return [tuple(line.split(" ", 1)) for line in output.splitlines()]
 
     def set_hooks(self, hooks):
         """
@@ -95,9 +283,26 @@ class Git(VCS):
                 os.symlink(hook, hook_name)
 
 
+    def install_push_hook(self, queue_path):
+        # Hooks of bare repositories are run in the repository
+        hook = os.path.join(self.repo_path, "hooks", "post-receive")
+        install_hook_script(hook, queue_path)
+
+    def maintenance_commands(self, upgrade_storage=False):
+        return ((config.GIT_BIN, "pack-refs", "--all"),
+                (config.GIT_BIN, "repack", "-a", "-d", "-q",
+                 "--write-bitmap-index"),
+                (config.GIT_BIN, "commit-graph", "write", "--reachable"))
+
     def _create_repository_files(self):
-        os.chdir(self.repo_path)
-        subssh.check_call((config.GIT_BIN, "--bare", "init" ))
+        # No chdir. Repositories can be created in parallel threads.
+        subssh.check_call((config.GIT_BIN, "--bare", "init", self.repo_path))
+        for key, value in parse_server_options(config.SERVER_OPTIONS):
+            self.set_server_option(key, value)
+
+    @classmethod
+    def template_key(cls):
+        return "%s %s" % (binary_stamp(config.GIT_BIN), config.SERVER_OPTIONS)
 
     def copy_common_hooks(self, user, repo_name):
         ""
@@ -106,7 +311,10 @@ class Git(VCS):
 class GitManager(RepoManager):
     klass = Git
 
+    web_list_format = "gitweb"
+
     @subssh.exposable_as()
+    @metrics.timed_command
     def set_description(self, user, repo_name, *description):
         """
         Set description for web interface.
@@ -115,9 +323,45 @@ class GitManager(RepoManager):
 
         """
         repo = self.get_repo_object(user.username, repo_name)
-        repo.set_description(" ".join(description))
-        repo.save()
+        with repo.locked():
+            repo.set_description(" ".join(description))
+            repo.save()
+        self._update_web_projects([repo])
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def set_server_option(self, user, repo_name, key, value):
+        """
+        Set server side option of the repository. Options are true or false.
+
+        usage: $cmd <repo name> <option> <true|false>
+
+        Options: uploadpack.allowFilter enables partial clones
+        (--filter=blob:none). uploadpack.allowAnySHA1InWant lets readers
+        fetch any object by its id, also unreachable ones like force pushed
+        away commits, so it is not set by default.
+
+        """
+        repo = self.get_repo_object(user.username, repo_name)
+        with repo.locked():
+            repo.set_server_option(key, value)
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def server_options(self, user, repo_name):
+        """
+        Show server side options of the repository.
+
+        usage: $cmd <repo name>
 
+        """
+        repo = self.get_repo_object(user.username, repo_name)
+        if not repo.has_permissions(user.username, "r"):
+            raise InvalidPermissions("%s has no permissions to read %s" %
+                                     (user.username, repo.name))
+        for key, value in repo.get_server_options():
+            subssh.writeln("%s = %s" % (key, value))
 
     def copy_common_hooks(self, user, repo_name):
         print "TODO: implement this"
@@ -127,10 +371,15 @@ class GitManager(RepoManager):
 
 valid_repo = re.compile(r"^/?git/[%s]+$" % subssh.safe_chars)
 
+authorizer = Authorizer(Git)
+
 @subssh.no_interactive
 @subssh.expose_as("git-upload-pack", "git-receive-pack", "git-upload-archive")
+@metrics.timed_transport
 def handle_git(user, request_repo):
     """Used internally by Git"""
+    metrics.enable_from(config)
+    groups.enable_from(config, Git)
 
 
     if not valid_repo.match(request_repo):
@@ -140,12 +389,54 @@ def handle_git(user, request_repo):
     repo_name = os.path.basename(request_repo.lstrip("/"))
 
     # Transform virtual root
-    real_repository_path = os.path.join(config.REPOSITORIES, repo_name)
-
-    repo = Git(real_repository_path, subssh.config.ADMIN)
+    real_repository_path = repolayout.from_config(config).path(repo_name)
+
+    # Only permissions are needed here. Building the Git object would parse
+    # much more than that.
+    if authorizer.store is None:
+        authorizer.store = permstore.store_from(config)
+    if not authorizer.has_permissions(real_repository_path, user.username,
+                                      Git.permissions_required[user.cmd]):
+        raise InvalidPermissions("%s has no permissions to run %s on %s" %
+                                 (user.username, user.cmd, repo_name))
+
+    exec_transport = subssh.to_bool(config.EXEC_TRANSPORT)
+
+    cache = pack_cache()
+    if cache is not None:
+        if user.cmd == "git-upload-pack":
+            cache.enable()
+        elif user.cmd == "git-receive-pack":
+            # The cache is invalidated after git has updated the refs
+            exec_transport = False
+
+    session = accounting.session(config, "git", user.username, repo_name,
+                                 user.cmd)
+    if session is not None:
+        # Exec would leave nobody to count the bytes
+        exec_transport = False
 
     # run requested command on the repository
-    return repo.execute(user.username, user.cmd, git_bin=config.GIT_BIN)
+    code = run_git_command(real_repository_path, user.cmd,
+                           git_bin=config.GIT_BIN,
+                           exec_transport=exec_transport,
+                           session=session)
+
+    if cache is not None and user.cmd == "git-receive-pack":
+        cache.invalidate(real_repository_path)
+
+    return code
+
+
+def pack_cache():
+    """
+    Returns PackCache or None if it is disabled
+    """
+    max_size = int(config.PACK_CACHE_SIZE) * 1024 * 1024
+    if not max_size:
+        return None
+    from packcache import PackCache
+    return PackCache(config.PACK_CACHE_DIR, max_size)
 
 
 
@@ -155,6 +446,9 @@ def install_default_global_hooks(hooks_dir):
     if os.path.exists(hook):
         return
 
+    if not os.path.isdir(config.HOOKS_DIR):
+        os.makedirs(config.HOOKS_DIR)
+
     f = open(hook, "w")
     f.write("""#!/bin/sh
 #
@@ -170,16 +464,50 @@ exec git-update-server-info
     os.chmod(hook, 0700)
 
 
-def appinit():
-
-
-    if subssh.to_bool(config.MANAGER_TOOLS):
+def create_manager(**overrides):
+    """
+    Returns GitManager set up from the config. Keyword arguments override
+    the arguments taken from the config.
+    """
+    options = dict(repos_path=config.REPOSITORIES,
+                   web_repos_path=config.WEB_DIR,
+                   urls={'rw': config.URL_RW,
+                         'anonymous_read': config.URL_HTTP_CLONE,
+                         'webview': config.URL_WEB_VIEW},
+                   delete_grace_period=int(config.DELETE_GRACE_PERIOD),
+                   reaper_workers=int(config.REAPER_WORKERS),
+                   reaper_files_per_second=int(
+                       config.REAPER_FILES_PER_SECOND),
+                   maintenance_path=(config.MAINTENANCE_DIR if
+                                     subssh.to_bool(config.MAINTENANCE)
+                                     else None),
+                   accounting_path=(config.ACCOUNTING_DIR if
+                                    subssh.to_bool(config.ACCOUNTING)
+                                    else None),
+                   permission_store_path=(
+                       config.PERMISSION_STORE_PATH if
+                       subssh.to_bool(config.PERMISSION_STORE)
+                       else None),
+                   sharded=subssh.to_bool(config.SHARDED_LAYOUT),
+                   templates=subssh.to_bool(config.REPOSITORY_TEMPLATES),
+                   web_project_list_path=(
+                       config.WEB_PROJECT_LIST_PATH if
+                       subssh.to_bool(config.WEB_PROJECT_LIST)
+                       else None), )
+    options.update(overrides)
+    return GitManager(**options)
+
+
+def configure():
+    """
+    Enables the settings of the config used also by the transport commands
+    """
+    metrics.enable_from(config)
+    groups.enable_from(config, Git)
 
-        manager = GitManager(config.REPOSITORIES,
-                             web_repos_path=config.WEB_DIR,
-                             urls={'rw': config.URL_RW,
-                                   'anonymous_read': config.URL_HTTP_CLONE,
-                                   'webview': config.URL_WEB_VIEW}, )
 
-        subssh.expose_instance(manager, prefix="git-")
+def appinit():
+    configure()
 
+    if subssh.to_bool(config.MANAGER_TOOLS):
+        subssh.expose_instance(create_manager(), prefix="git-")
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+
+Permission groups shared by all repositories.
+
+Groups are defined in one file in the format of the groups-db of svnserve:
+
+    [groups]
+    team = alice, bob
+    everybody = @team, carol
+
+Permissions are given to a group with its name prefixed with '@'. The file is
+compiled once per process to a username to groups table so that checking a
+user against a repository does not depend on the number of groups or
+members.
+"""
+
+import os
+import time
+
+
+# Group files modified more recently than this are compiled again on every
+# use. Same as in authz.
+FRESHNESS_WINDOW = 2
+
+GROUP_PREFIX = "@"
+
+GROUPS_SECTION = "groups"
+
+
+def is_group(name):
+    return name.startswith(GROUP_PREFIX)
+
+
+def read_definitions(path):
+    """
+    Returns a dict of group name/member list pairs from the group file.
+    Members are usernames or other groups prefixed with '@'.
+    """
+    from ConfigParser import SafeConfigParser
+
+    parser = SafeConfigParser()
+    parser.read(path)
+    if not parser.has_section(GROUPS_SECTION):
+        return {}
+
+    definitions = {}
+    for group, members in parser.items(GROUPS_SECTION):
+        definitions[group.lower()] = [member.strip().lower() for member
+                                      in members.split(",")
+                                      if member.strip()]
+    return definitions
+
+
+def compile_membership(definitions):
+    """
+    Returns a dict of username and frozenset of '@group' keys pairs.
+    Nested groups are resolved. Cycles and unknown groups are ignored.
+    """
+    def members(group, visiting):
+        users = set()
+        for member in definitions.get(group, ()):
+            if not is_group(member):
+                users.add(member)
+            elif member[1:] not in visiting:
+                users.update(members(member[1:], visiting | set([group])))
+        return users
+
+    member_of = {}
+    for group in definitions:
+        for username in members(group, frozenset()):
+            member_of.setdefault(username, set()).add(GROUP_PREFIX + group)
+
+    return dict((username, frozenset(groups))
+                for username, groups in member_of.items())
+
+
+class Groups(object):
+    """
+    Compiled membership of the group file. Compiled again only when the
+    stat of the file changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+        self._names = frozenset()
+        self._member_of = {}
+
+    def _compiled(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # No file means no groups
+            st = None
+        else:
+            st = (st.st_ino, st.st_mtime, st.st_size)
+
+        if st != self._stat:
+            definitions = {}
+            if st is not None:
+                definitions = read_definitions(self.path)
+            self._names = frozenset(GROUP_PREFIX + group
+                                    for group in definitions)
+            self._member_of = compile_membership(definitions)
+            if st is not None and time.time() - st[1] <= FRESHNESS_WINDOW:
+                # The file might be rewritten within the same mtime tick.
+                # Compile it again next time.
+                st = False
+            self._stat = st
+
+        return self._member_of
+
+    def member_of(self, username):
+        """
+        Returns the '@group' keys of the groups of the user
+        """
+        return self._compiled().get(username.lower(), frozenset())
+
+    def exists(self, group):
+        self._compiled()
+        return group.lower() in self._names
+
+
+def enable(klass, path):
+    """
+    Enables groups of the file for the repositories of the VCS class
+    """
+    if klass.permission_groups is None or \
+       klass.permission_groups.path != path:
+        klass.permission_groups = Groups(path)
+
+
+def disable(klass):
+    klass.permission_groups = None
+
+
+def enable_from(config, klass):
+    """
+    Enables or disables groups of the VCS class as set by PERMISSION_GROUPS
+    in the config of the VCS. Each VCS has its own setting.
+    """
+    import subssh
+    if subssh.to_bool(config.PERMISSION_GROUPS):
+        enable(klass, config.PERMISSION_GROUPS_FILE)
+    else:
+        disable(klass)
+
+
+def member_of(permission_groups, username):
+    """
+    Returns the '@group' keys of the groups of the user. permission_groups
+    is a Groups object or None if groups are disabled.
+    """
+    if permission_groups is None:
+        return frozenset()
+    return permission_groups.member_of(username)
+
+
+def exists(permission_groups, group):
+    return permission_groups is not None and permission_groups.exists(group)
@@ -10,6 +10,7 @@ Created on Apr 6, 2010
 import os
 import sys
 import re
+from StringIO import StringIO
 from ConfigParser import SafeConfigParser
 from optparse import OptionParser
 
@@ -17,29 +18,104 @@ import subssh
 
 from abstractrepo import VCS
 from abstractrepo import InvalidPermissions
-from abstractrepo import vcs_init
+from abstractrepo import match_permissions
+from abstractrepo import lazy_setting
 from repomanager import RepoManager
+import metrics
+import groups
+import accounting
+from authz import Authorizer
+import permstore
+import repolayout
+from fstools import atomic_write, file_lock
+from maintenance import push_hook_command
 
 
 class config:
     HG_BIN = "hg"
 
-    REPOSITORIES = os.path.join(subssh.config.SUBSSH_HOME, "vcs", "hg", "repos")
-    HOOKS_DIR = os.path.join(subssh.config.SUBSSH_HOME, "vcs", "hg", "hooks")
+    REPOSITORIES = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                     "vcs", "hg", "repos"))
+    HOOKS_DIR = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                  "vcs", "hg", "hooks"))
 
 
     MANAGER_TOOLS = "true"
 
+    # Hook checking write permissions. prechangegroup checks once per push,
+    # pretxnchangegroup inside the transaction. Written to the hgrc of new
+    # repositories and passed to every hg serve.
+    PERMISSIONS_HOOK = "prechangegroup"
+
+    # Queue pushed repositories for maintenance run by
+    # "python -m revisioncask.maintenance"
+    MAINTENANCE = "false"
+    MAINTENANCE_DIR = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "hg", "maintenance"))
+    MAINTENANCE_WORKERS = "1"
+    # Minimum seconds between maintenance runs of a repository
+    MAINTENANCE_INTERVAL = "3600"
+
+    # Write latency histograms to METRICS_DIR. Exported in Prometheus format
+    # with "python -m revisioncask.metrics <METRICS_DIR>"
+    METRICS = "false"
+    METRICS_DIR = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                    "metrics"))
+
+    # Record bytes, wall time and CPU of the transport sessions to
+    # ACCOUNTING_DIR. The transport process is run with relayed stdio.
+    ACCOUNTING = "false"
+    ACCOUNTING_DIR = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "accounting"))
+
+    # Keep owners and permissions in a SQLite database instead of reading
+    # them from the repositories. Run import_permission_store after enabling.
+    PERMISSION_STORE = "false"
+    PERMISSION_STORE_PATH = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "hg", "permissions.sqlite"))
+
+    # Allow giving permissions to the groups of PERMISSION_GROUPS_FILE with
+    # '@group'. The file is shared by all VCSs.
+    PERMISSION_GROUPS = "false"
+    PERMISSION_GROUPS_FILE = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "permission_groups"))
+
+    # Spread the repositories to hashed subdirectories. Existing
+    # repositories are moved with shard_repositories.
+    SHARDED_LAYOUT = "false"
+
+    # Copy new repositories from a pre-built empty repository instead of
+    # running the VCS. The template is rebuilt when the VCS is upgraded.
+    REPOSITORY_TEMPLATES = "false"
+
+    # Keep the hgweb list of the web enabled repositories in
+    # WEB_PROJECT_LIST_PATH so that it does not need to scan WEB_DIR
+    WEB_PROJECT_LIST = "false"
+    WEB_PROJECT_LIST_PATH = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "hg", "hgweb.config"))
+
+    # Seconds deleted repositories can be restored with undelete. With a
+    # grace period nothing is removed unless a cron job runs
+    # "python -m revisioncask.reaper --grace <seconds> <REPOSITORIES>/.trash"
+    DELETE_GRACE_PERIOD = "0"
+    REAPER_WORKERS = "1"
+    # Maximum number of files removed per second. 0 is unlimited.
+    REAPER_FILES_PER_SECOND = "1000"
+
 
     URL_RW =  "ssh://$hostusername@$hostname/hg/$name_on_fs"
     URL_HTTP_CLONE =  "http://$hostname/repo/$name_on_fs"
     URL_WEB_VIEW =  "http://$hostname/viewgit/?a=summary&p=$name_on_fs"
 
-    WEB_DIR = os.path.join( os.environ["HOME"], "repos", "webhg" )
+    WEB_DIR = lazy_setting(lambda: os.path.join(os.environ["HOME"],
+                                                "repos", "webhg"))
 
 
 hg_manager = None
 
+PERMISSIONS_HOOK_TYPES = ("prechangegroup", "pretxnchangegroup")
+PERMISSIONS_HOOK_COMMAND = "python:revisioncask.hg.permissions_hook"
+
 class Mercurial(VCS):
 
     required_by_valid_repo  = (".hg",)
@@ -52,30 +128,76 @@ class Mercurial(VCS):
 
     permdb_name=owner_filename
 
+    access_record_name = ".hg/" + VCS.access_record_name
+
+    # hgrc is read by Mercurial itself
+    legacy_files = ()
+
+    lock_filename=".hg/subssh.lock"
+
     owner_sep = ", "
 
+    # Mercurial breaks hard links itself before writing to a store file. This
+    # is how "hg clone" shares the store of local repositories.
+    immutable_dirs = (".hg/store",)
+
+    push_markers = (".hg/store/00changelog.i",)
+    size_markers = (".hg/store", ".hg/store/00manifest.i")
 
-    def _read_owners(self):
-        if self.permdb.has_section("web"):
-            owners_str = self.permdb.get("web", "contact")
-            for owner in owners_str.split(self.owner_sep):
-                self._owners.add(owner)
-        else:
-            self.permdb.add_section("web")
+    def _is_immutable(self, relpath):
+        return (VCS._is_immutable(self, relpath)
+                and os.path.basename(relpath) != "lock")
 
 
+    _description = None
 
-    def write_owners(self):
+    def _read_legacy_owners(self, permdb):
+        if permdb.has_section("web"):
+            owners_str = permdb.get("web", "contact")
+            return [owner for owner in owners_str.split(self.owner_sep)
+                    if owner]
+        return []
+
+
+
+    def write_native_access(self):
+        """
+        Writes owners as the web contact and the permissions for the
+        permissions hook to the hgrc
+        """
+        hgrc = SafeConfigParser()
+        hgrc.read(self.permdb_filepath)
+
+        if not hgrc.has_section("web"):
+            hgrc.add_section("web")
         sorted_owners = sorted(self._owners)
         owners_str = self.owner_sep.join(sorted_owners).strip(self.owner_sep)
-        self.permdb.set("web", "contact", owners_str )
+        hgrc.set("web", "contact", owners_str)
+        if self._description is not None:
+            hgrc.set("web", "description", self._description)
+
+        if hgrc.has_section(self._permissions_section):
+            hgrc.remove_section(self._permissions_section)
+        hgrc.add_section(self._permissions_section)
+        for username, permissions in self.get_all_permissions():
+            hgrc.set(self._permissions_section, username, permissions)
+
+        f = StringIO()
+        hgrc.write(f)
+        atomic_write(self.permdb_filepath, f.getvalue())
 
 
 
     def set_description(self, description):
-        self.permdb.set("web", "description", description)
+        # Written to the hgrc on save
+        self._description = description
 
 
+    @classmethod
+    def template_key(cls):
+        from mercurial import util
+        return "%s %s" % (util.version(), config.PERMISSIONS_HOOK)
+
     def _create_repository_files(self):
         from mercurial import ui, hg
         hg_repo = hg.repository(ui.ui(), self.repo_path, create=True)
@@ -83,8 +205,9 @@ class Mercurial(VCS):
         # Setup the permission hook.
         # TODO: This should be in the default global hook file.
         # This permission restraint could be done without hooks like in Git
-        self.set_hooks((("prechangegroup.revisioncask.permissions",
-                         "python:revisioncask.hg.permissions_hook"),))
+        self.set_hooks((("%s.revisioncask.permissions"
+                         % config.PERMISSIONS_HOOK,
+                         PERMISSIONS_HOOK_COMMAND),))
         # http://hgbook.red-bean.com/read/handling-repository-events-with-hooks.html#sec:hook:prechangegroup
         # http://hgbook.red-bean.com/read/handling-repository-events-with-hooks.html#sec:hook:pretxnchangegroup
 
@@ -102,29 +225,45 @@ class Mercurial(VCS):
         #The file standard ini-file so we can add new hooks to the
         #hooks section with Python SafeConfigParser
 
-        # TODO: Lock the file for reading&writing
-
-        hgrc = SafeConfigParser()
         hgrc_filepath = os.path.join(self.repo_path, ".hg", "hgrc")
 
-        hgrc.read(hgrc_filepath)
+        with file_lock(os.path.join(self.repo_path, self.lock_filename)):
+            hgrc = SafeConfigParser()
+            hgrc.read(hgrc_filepath)
 
-        if not hgrc.has_section("hooks"):
-            hgrc.add_section("hooks")
+            if not hgrc.has_section("hooks"):
+                hgrc.add_section("hooks")
 
-        for hook_name, hook in hooks:
-            hgrc.set("hooks", hook_name, hook)
+            for hook_name, hook in hooks:
+                hgrc.set("hooks", hook_name, hook)
+
+            f = StringIO()
+            hgrc.write(f)
+            atomic_write(hgrc_filepath, f.getvalue())
 
-        f = open(hgrc_filepath, "w")
-        hgrc.write(f)
-        f.close()
+
+    def install_push_hook(self, queue_path):
+        # Shell hooks are run in the repository root
+        self.set_hooks((("changegroup.revisioncask.maintenance",
+                         push_hook_command(queue_path)),))
+
+    def maintenance_commands(self, upgrade_storage=False):
+        commands = [(config.HG_BIN, "-R", self.repo_path, "debugupdatecaches")]
+        if upgrade_storage:
+            # Keeps a backup of the old store in .hg/upgradebackup.*
+            commands.append((config.HG_BIN, "-R", self.repo_path,
+                             "debugupgraderepo", "--run"))
+        return tuple(commands)
 
 
 class MercurialManager(RepoManager):
     klass = Mercurial
 
+    web_list_format = "hgweb"
+
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def set_description(self, user, repo_name, *description):
         """
         Set description for web interface.
@@ -135,8 +274,10 @@ class MercurialManager(RepoManager):
         # This just wraps the repo method to a subssh command
 
         repo = self.get_repo_object(user.username, repo_name)
-        repo.set_description(" ".join(description))
-        repo.save()
+        with repo.locked():
+            repo.set_description(" ".join(description))
+            repo.save()
+        self._update_web_projects([repo])
 
 
     def copy_common_hooks(self, user, repo_name):
@@ -154,8 +295,11 @@ parser.add_option("--stdio", action="store_true", dest='stdio' )
 
 @subssh.no_interactive
 @subssh.expose_as("hg")
+@metrics.timed_transport
 def hg_handle(user, *args):
     """Used internally by Mercurial"""
+    metrics.enable_from(config)
+    groups.enable_from(config, Mercurial)
 
 
     options, args = parser.parse_args(list(args))
@@ -170,6 +314,9 @@ def hg_handle(user, *args):
 
 
 valid_repo = re.compile(r"^/?hg/[%s]+$" % subssh.safe_chars)
+
+authorizer = Authorizer(Mercurial)
+
 def hg_serve(user, options, args):
     if not options.repository:
         raise subssh.InvalidArguments("Repository is missing")
@@ -185,53 +332,149 @@ def hg_serve(user, options, args):
 
 
     # Transform virtual root
-    real_repository_path = os.path.join(config.REPOSITORIES, repo_name)
+    real_repository_path = repolayout.from_config(config).path(repo_name)
 
-    repo = Mercurial(real_repository_path, subssh.config.ADMIN)
-
-    if not repo.has_permissions(user.username, "r"):
+    if authorizer.store is None:
+        authorizer.store = permstore.store_from(config)
+    if not authorizer.has_permissions(real_repository_path, user.username,
+                                      "r"):
         raise InvalidPermissions("%s has no read permissions to %s"
                                  %(user.username, options.repository))
 
+    hg_args = serve_args(user.username, real_repository_path)
+
+    session = accounting.session(config, "hg", user.username, repo_name,
+                                 "hg-serve")
+    if session is not None:
+        # Run in a child process so that its stdio and rusage can be
+        # accounted
+        with metrics.timer(metrics.PHASE, phase="hg_process"):
+            return session.call([config.HG_BIN] + hg_args)
+
     from mercurial.dispatch import dispatch
-    return dispatch(['-R', repo.repo_path, 'serve', '--stdio'])
+    with metrics.timer(metrics.PHASE, phase="hg_dispatch"):
+        return dispatch(hg_args)
 
 
 
-def hg_init(user, options, args):
-    return hg_manager.init(user, args[1])
+def serve_args(username, repo_path):
+    """
+    Returns the hg arguments serving the repository to the user.
 
-def permissions_hook(ui=None, repo=None, **kwargs):
+    The settings of permissions_hook are passed with --config so that they
+    hold also in a separate hg process. The hook is set for both hook types
+    so that repositories created with the other PERMISSIONS_HOOK check the
+    permissions once with the current one. Hooks with empty command are not
+    run by hg.
+    """
+    groups_path = ""
+    if Mercurial.permission_groups is not None:
+        groups_path = Mercurial.permission_groups.path
 
-    # Get user from subssh global. Bad? I should eliminate this, but how to
-    # tell the hook which user is asking for permission to the repository?
-    user = subssh.get_user()
+    args = ['--config', 'revisioncask.user=' + username,
+            '--config', 'revisioncask.permission_groups=' + groups_path]
+    for hook_type in PERMISSIONS_HOOK_TYPES:
+        command = ""
+        if hook_type == config.PERMISSIONS_HOOK:
+            command = PERMISSIONS_HOOK_COMMAND
+        args += ['--config', 'hooks.%s.revisioncask.permissions=%s'
+                 % (hook_type, command)]
+    return args + ['-R', repo_path, 'serve', '--stdio']
 
-    # TODO: upper = os.path.dirname(repo.path) ?
-    upper = "/".join(repo.path.split("/")[:-1])
 
-    repo_subssh = Mercurial(upper, subssh.config.ADMIN)
+def hg_init(user, options, args):
+    global hg_manager
+    if hg_manager is None:
+        hg_manager = create_manager()
+    return hg_manager.init(user, args[1])
+
+def permissions_hook(ui=None, repo=None, **kwargs):
+    """
+    Checks write permissions on prechangegroup or pretxnchangegroup.
+
+    Mercurial has already loaded the hgrc of the repository so the
+    permissions are read from the repository ui instead of parsing it again.
+    """
+
+    # hg_serve passes the user in the config. Fall back to the subssh global
+    # if the hook is run some other way.
+    username = repo.ui.config("revisioncask", "user")
+    if not username:
+        username = subssh.get_user().username
+
+    permissions = dict(repo.ui.configitems(Mercurial._permissions_section))
+
+    # hg_serve passes the group file also to a separate hg process which
+    # has not read the subssh config. Empty means groups are disabled.
+    groups_path = repo.ui.config("revisioncask", "permission_groups")
+    if groups_path is None:
+        groups.enable_from(config, Mercurial)
+    elif groups_path:
+        groups.enable(Mercurial, groups_path)
+    else:
+        groups.disable(Mercurial)
 
-    if not repo_subssh.has_permissions(user.username, "w"):
+    if not match_permissions(permissions, username, "w",
+                             Mercurial.permission_groups):
         from mercurial.util import Abort
         raise Abort('%s has no write permissions to %s' %
-                          (user.username, repo_subssh.name ))
-
-
+                          (username, os.path.basename(repo.root)))
+
+
+
+
+def create_manager(**overrides):
+    """
+    Returns MercurialManager set up from the config. Keyword arguments
+    override the arguments taken from the config.
+    """
+    options = dict(repos_path=config.REPOSITORIES,
+                   web_repos_path=config.WEB_DIR,
+                   urls={'rw': config.URL_RW,
+                         'anonymous_read': config.URL_HTTP_CLONE,
+                         'webview': config.URL_WEB_VIEW},
+                   delete_grace_period=int(
+                       config.DELETE_GRACE_PERIOD),
+                   reaper_workers=int(config.REAPER_WORKERS),
+                   reaper_files_per_second=int(
+                       config.REAPER_FILES_PER_SECOND),
+                   maintenance_path=(
+                       config.MAINTENANCE_DIR if
+                       subssh.to_bool(config.MAINTENANCE)
+                       else None),
+                   accounting_path=(
+                       config.ACCOUNTING_DIR if
+                       subssh.to_bool(config.ACCOUNTING)
+                       else None),
+                   permission_store_path=(
+                       config.PERMISSION_STORE_PATH if
+                       subssh.to_bool(config.PERMISSION_STORE)
+                       else None),
+                   sharded=subssh.to_bool(config.SHARDED_LAYOUT),
+                   templates=subssh.to_bool(
+                       config.REPOSITORY_TEMPLATES),
+                   web_project_list_path=(
+                       config.WEB_PROJECT_LIST_PATH if
+                       subssh.to_bool(config.WEB_PROJECT_LIST)
+                       else None),
+                   )
+    options.update(overrides)
+    return MercurialManager(**options)
+
+
+def configure():
+    """
+    Enables the settings of the config used also by the transport commands
+    """
+    metrics.enable_from(config)
+    groups.enable_from(config, Mercurial)
 
 
 def appinit():
-
-    vcs_init(config)
+    configure()
 
     if subssh.to_bool(config.MANAGER_TOOLS):
         global hg_manager
-        hg_manager = MercurialManager(config.REPOSITORIES,
-                         web_repos_path=config.WEB_DIR,
-                         urls={'rw': config.URL_RW,
-                               'anonymous_read': config.URL_HTTP_CLONE,
-                               'webview': config.URL_WEB_VIEW},
-                         )
+        hg_manager = create_manager()
 
         subssh.expose_instance(hg_manager, prefix="hg-")
-
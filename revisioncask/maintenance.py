@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+
+Background maintenance of the repositories.
+
+Push hooks installed to the repositories touch <maintenance dir>/queue/<name>.
+The scheduler, run periodically eg. from cron, picks the queued repositories
+and runs the maintenance commands of their VCS: git repack with bitmaps and
+commit-graph, svnadmin pack or hg cache updates. hg store format upgrades
+are run only with --upgrade-storage. Jobs run in a bounded worker pool with
+low CPU and I/O priority. A repository is never maintained by two jobs at
+the same time.
+
+The subssh app config is not read by the scheduler. If REPOSITORIES or
+MAINTENANCE_DIR are changed there, give them with --repositories and
+--maintenance-dir.
+
+The result of the last run of each repository is kept in
+<maintenance dir>/state/<name>.json.
+
+usage: python -m revisioncask.maintenance [options]
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import errno
+
+
+QUEUE_DIR = "queue"
+STATE_DIR = "state"
+
+HOOK_MARKER = "# revisioncask maintenance push hook"
+CHAINED_SUFFIX = ".chained"
+
+
+def shell_quote(arg):
+    return "'%s'" % arg.replace("'", "'\\''")
+
+
+def push_hook_command(queue_path, repo_path_expr='"$PWD"'):
+    """
+    Shell command queuing the repository for maintenance. repo_path_expr is
+    the shell expression of the repository path in the hook.
+    """
+    return 'touch %s/"$(basename %s)"' % (shell_quote(queue_path),
+                                          repo_path_expr)
+
+
+def push_hook_script(queue_path, repo_path_expr='"$PWD"', chained=None):
+    """
+    Hook script queuing the repository. If chained is given it is run
+    afterwards with the arguments and the input of the hook.
+    """
+    script = "#!/bin/sh\n%s\n%s\n" % (HOOK_MARKER,
+                                      push_hook_command(queue_path,
+                                                        repo_path_expr))
+    if chained:
+        script += 'exec %s "$@"\n' % shell_quote(chained)
+    return script
+
+
+def install_hook_script(hook, queue_path, repo_path_expr='"$PWD"'):
+    """
+    Writes the push hook script to hook. A hook which was not installed by
+    us is moved to <hook>.chained and run by the push hook.
+    """
+    from fstools import atomic_write
+
+    chained = hook + CHAINED_SUFFIX
+    if os.path.lexists(hook) and not is_push_hook(hook):
+        if os.path.lexists(chained):
+            raise OSError(errno.EEXIST, "Refusing to replace hook %s, "
+                          "%s exists already" % (hook, chained), hook)
+        os.rename(hook, chained)
+
+    if not os.path.lexists(chained):
+        chained = None
+    atomic_write(hook, push_hook_script(queue_path, repo_path_expr, chained))
+    os.chmod(hook, 0755)
+
+
+def is_push_hook(hook):
+    try:
+        f = open(hook)
+    except IOError:
+        return False
+    try:
+        return HOOK_MARKER in f.read(4096)
+    finally:
+        f.close()
+
+
+def low_priority_prefix():
+    """
+    Command prefix running the command with idle I/O and lowest CPU priority
+    """
+    prefix = ["nice", "-n", "19"]
+    for path in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        if os.access(os.path.join(path, "ionice"), os.X_OK):
+            prefix = ["ionice", "-c", "3"] + prefix
+            break
+    return prefix
+
+
+class Maintenance(object):
+    """
+    The queue and the state of the maintenance
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue_path = os.path.join(path, QUEUE_DIR)
+        self.state_path = os.path.join(path, STATE_DIR)
+
+    def create_directories(self):
+        for path in (self.queue_path, self.state_path):
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def queue(self, name_on_fs):
+        self.create_directories()
+        open(os.path.join(self.queue_path, name_on_fs), "a").close()
+        os.utime(os.path.join(self.queue_path, name_on_fs), None)
+
+    def queued(self):
+        """
+        Returns list of (queued time, name on fs) tuples, oldest first
+        """
+        if not os.path.exists(self.queue_path):
+            return []
+        entries = []
+        for name in os.listdir(self.queue_path):
+            try:
+                queued = os.stat(os.path.join(self.queue_path, name)).st_mtime
+            except OSError:
+                continue
+            entries.append((queued, name))
+        entries.sort()
+        return entries
+
+    def queued_time(self, name_on_fs):
+        try:
+            return os.stat(os.path.join(self.queue_path,
+                                        name_on_fs)).st_mtime
+        except OSError:
+            return None
+
+    def dequeue(self, name_on_fs):
+        try:
+            os.remove(os.path.join(self.queue_path, name_on_fs))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def state(self, name_on_fs):
+        """
+        Returns state dict of the last maintenance run or None
+        """
+        try:
+            f = open(os.path.join(self.state_path, name_on_fs + ".json"))
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def write_state(self, name_on_fs, state):
+        from fstools import atomic_write
+        atomic_write(os.path.join(self.state_path, name_on_fs + ".json"),
+                     json.dumps(state, sort_keys=True))
+
+    def try_lock(self, name_on_fs):
+        """
+        Returns open lock file of the repository or None if a job is already
+        running on it
+        """
+        self.create_directories()
+        lock_file = open(os.path.join(self.state_path, name_on_fs + ".lock"),
+                         "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return lock_file
+
+    def is_running(self, name_on_fs):
+        lock_file = self.try_lock(name_on_fs)
+        if lock_file is None:
+            return True
+        lock_file.close()
+        return False
+
+
+class Scheduler(object):
+
+    def __init__(self, manager, workers=1, interval=0, low_priority=True,
+                 upgrade_storage=False):
+        self.manager = manager
+        self.maintenance = manager.maintenance
+        self.workers = workers
+        self.interval = interval
+        self.upgrade_storage = upgrade_storage
+        self.prefix = low_priority_prefix() if low_priority else []
+
+    def due(self):
+        """
+        Returns names of the queued repositories which were not maintained
+        during the interval
+        """
+        now = time.time()
+        names = []
+        for queued, name_on_fs in self.maintenance.queued():
+            state = self.maintenance.state(name_on_fs) or {}
+            if now - state.get("finished", 0) >= self.interval:
+                names.append(name_on_fs)
+        return names
+
+    def run_job(self, name_on_fs):
+        """
+        Runs maintenance commands of the repository. Returns the new state
+        or None if the job was skipped.
+        """
+        import subprocess
+        from subssh import config
+        from abstractrepo import InvalidRepository
+
+        lock_file = self.maintenance.try_lock(name_on_fs)
+        if lock_file is None:
+            # Stays in the queue for the next run
+            return None
+
+        try:
+            # Pushes during the job queue the repository again
+            self.maintenance.dequeue(name_on_fs)
+
+            repo_path = self.manager.layout.path(name_on_fs)
+            try:
+                repo = self.manager.open_repository(repo_path, config.ADMIN)
+            except InvalidRepository:
+                # Deleted after the push
+                return None
+
+            state = {"started": time.time()}
+            codes = []
+            for cmd in repo.maintenance_commands(self.upgrade_storage):
+                codes.append(subprocess.call(self.prefix + list(cmd),
+                                             cwd=repo_path))
+                if codes[-1] != 0:
+                    break
+            state["finished"] = time.time()
+            state["duration"] = state["finished"] - state["started"]
+            state["exit_codes"] = codes
+            state["result"] = "ok" if not [c for c in codes if c] else "failed"
+
+            self.maintenance.write_state(name_on_fs, state)
+            return state
+        finally:
+            lock_file.close()
+
+    def run(self):
+        """
+        Runs all due maintenance jobs. Returns dict of name -> state of the
+        jobs run.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        names = self.due()
+        pool = ThreadPool(self.workers)
+        try:
+            states = pool.map(self.run_job, names)
+        finally:
+            pool.close()
+            pool.join()
+        return dict((name, state) for name, state in zip(names, states)
+                    if state is not None)
+
+
+def install_hooks(manager):
+    """
+    Installs the push hooks to all existing repositories of the manager
+    """
+    from subssh import config
+
+    for repo in manager.index.repositories():
+        repo = manager.open_repository(repo.repo_path, config.ADMIN)
+        repo.install_push_hook(manager.maintenance.queue_path)
+
+
+def main(args=None):
+    from optparse import OptionParser
+    from revisioncask import plugins
+    from revisioncask.repolayout import SHARDS_NAME
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--vcs", default="git,hg,svn",
+                      help="Comma separated list of VCSs")
+    parser.add_option("--repositories",
+                      help="Repository directory of the VCS. Default is "
+                           "REPOSITORIES of the VCS")
+    parser.add_option("--maintenance-dir",
+                      help="Maintenance directory of the VCS. Default is "
+                           "MAINTENANCE_DIR of the VCS")
+    parser.add_option("--workers", type="int",
+                      help="Number of concurrent jobs. Default is "
+                           "MAINTENANCE_WORKERS of the VCS")
+    parser.add_option("--interval", type="int",
+                      help="Seconds between the jobs of a repository. "
+                           "Default is MAINTENANCE_INTERVAL of the VCS")
+    parser.add_option("--upgrade-storage", action="store_true",
+                      help="Also upgrade the storage format of the "
+                           "repositories where the VCS supports it")
+    parser.add_option("--install-hooks", action="store_true",
+                      help="Install push hooks to existing repositories")
+    options, _ = parser.parse_args(args)
+
+    vcs_names = options.vcs.split(",")
+    if len(vcs_names) > 1 and (options.repositories or
+                               options.maintenance_dir):
+        parser.error("--repositories and --maintenance-dir need a single "
+                     "--vcs")
+
+    for vcs in vcs_names:
+        vcs_config = plugins.load_module(vcs).config
+        repos_path = options.repositories or vcs_config.REPOSITORIES
+        maintenance_path = (options.maintenance_dir or
+                            vcs_config.MAINTENANCE_DIR)
+        if not os.path.isdir(repos_path):
+            continue
+
+        manager = plugins.load_module(vcs).create_manager(
+            repos_path=repos_path,
+            maintenance_path=maintenance_path,
+            sharded=os.path.isdir(os.path.join(repos_path, SHARDS_NAME)))
+
+        if options.install_hooks:
+            install_hooks(manager)
+            continue
+
+        scheduler = Scheduler(manager,
+                              workers=(options.workers or
+                                       int(vcs_config.MAINTENANCE_WORKERS)),
+                              interval=(options.interval if
+                                        options.interval is not None else
+                                        int(vcs_config.MAINTENANCE_INTERVAL)),
+                              upgrade_storage=options.upgrade_storage)
+        for name, state in sorted(scheduler.run().items()):
+            print json.dumps(dict(state, vcs=vcs, repository=name),
+                             sort_keys=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+
+Latency histograms of the commands and their internal phases.
+
+Timings are collected to histograms in the process. When metrics are enabled
+the histograms are appended as one JSON line to <metrics dir>/spool when the
+process exits or before it execs. The exporter merges the spool into
+<metrics dir>/metrics.json and prints it in Prometheus text format.
+
+usage: python -m revisioncask.metrics [--output file] <metrics dir>
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import errno
+import atexit
+import bisect
+import functools
+
+
+COMMAND = "revisioncask_command_seconds"
+PHASE = "revisioncask_phase_seconds"
+
+# Upper bounds of the buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float("inf"))
+
+SPOOL_NAME = "spool"
+AGGREGATE_NAME = "metrics.json"
+# The spool is renamed to <COLLECTING_PREFIX><unique id> while collected
+COLLECTING_PREFIX = SPOOL_NAME + ".collecting."
+
+
+class Histogram(object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, counts=None, sum=0.0, count=0):
+        self.counts = counts or [0] * len(BUCKETS)
+        self.sum = sum
+        self.count = count
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts, sum, count):
+        for i, c in enumerate(counts):
+            self.counts[i] += c
+        self.sum += sum
+        self.count += count
+
+
+class Timer(object):
+    """
+    Context manager observing the time spent in the with block
+    """
+    __slots__ = ("registry", "key", "started")
+
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe_key(self.key, time.time() - self.started)
+
+
+def metric_key(name, labels):
+    return (name,) + tuple(sorted(labels.items()))
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.histograms = {}
+        self.spool_path = None
+
+    def observe_key(self, key, seconds):
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def observe(self, name, seconds, **labels):
+        self.observe_key(metric_key(name, labels), seconds)
+
+    def timer(self, name, **labels):
+        return Timer(self, metric_key(name, labels))
+
+    def enable(self, metrics_dir):
+        if self.spool_path is None:
+            atexit.register(self.flush)
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+        self.spool_path = os.path.join(metrics_dir, SPOOL_NAME)
+
+    def records(self):
+        return [{"name": key[0],
+                 "labels": dict(key[1:]),
+                 "counts": histogram.counts,
+                 "sum": histogram.sum,
+                 "count": histogram.count}
+                for key, histogram in self.histograms.items()]
+
+    def flush(self):
+        """
+        Appends the collected histograms to the spool and resets them
+        """
+        if self.spool_path is None or not self.histograms:
+            return
+        line = json.dumps(self.records()) + "\n"
+        self.histograms = {}
+        try:
+            append_line(self.spool_path, line)
+        except (IOError, OSError), e:
+            # Metrics must never break the commands
+            sys.stderr.write("Failed to write metrics: %s\n" % e)
+
+
+def append_line(path, line):
+    """
+    Appends line to the file with single write. Writers hold a shared lock
+    so that the exporter can wait for them after taking the file away.
+    """
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                current = os.stat(path).st_ino
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                current = None
+            if current == os.fstat(fd).st_ino:
+                os.write(fd, line)
+                return
+            # The exporter took this file. Write to the new one.
+        finally:
+            os.close(fd)
+
+
+_registry = Registry()
+
+observe = _registry.observe
+timer = _registry.timer
+flush = _registry.flush
+
+
+def enable(metrics_dir):
+    """
+    Writes the metrics of this process to metrics_dir
+    """
+    _registry.enable(metrics_dir)
+
+
+def enable_from(config):
+    """
+    Enables metrics if METRICS is set in the config of a VCS
+    """
+    import subssh
+    if subssh.to_bool(config.METRICS):
+        enable(config.METRICS_DIR)
+
+
+def timed(name, **labels):
+    """
+    Decorator observing the time spent in the function
+    """
+    key = metric_key(name, labels)
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Timer(_registry, key):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_transport(function):
+    """
+    Decorator for the transport command handlers taking user as the first
+    argument. The command is labeled with user.cmd.
+    """
+    @functools.wraps(function)
+    def wrapper(user, *args, **kwargs):
+        with _registry.timer(COMMAND, command=user.cmd):
+            return function(user, *args, **kwargs)
+    return wrapper
+
+
+def timed_command(method):
+    """
+    Decorator for the RepoManager commands. The command is labeled as
+    <vcs>-<method name>, eg. git-ls.
+    """
+    name = method.__name__
+    def call(self, *args, **kwargs):
+        vcs = self.klass.__module__.rsplit(".", 1)[-1]
+        with _registry.timer(COMMAND, command="%s-%s" % (vcs, name)):
+            return method(self, *args, **kwargs)
+    return wraps_signature(method, call)
+
+
+def wraps_signature(function, call):
+    """
+    Returns a wrapper of function which passes its arguments to call. Unlike
+    functools.wraps the wrapper has the same arguments as function, so that
+    inspect.getargspec of a decorated command still shows them.
+    """
+    import inspect
+
+    args, varargs, varkw, defaults = inspect.getargspec(function)
+    signature = inspect.formatargspec(args, varargs, varkw)
+    source = "def %s%s:\n    return __call%s\n" % (
+        function.__name__, signature, signature)
+    namespace = {"__call": call}
+    exec source in namespace
+    wrapper = namespace[function.__name__]
+    wrapper.func_defaults = defaults
+    return functools.wraps(function)(wrapper)
+
+
+def load_aggregate(path):
+    """
+    Returns tuple of dict of metric key -> Histogram and the name of the
+    spool file merged last to the aggregate
+    """
+    histograms = {}
+    try:
+        f = open(path)
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return histograms, None
+        raise
+    try:
+        aggregate = json.load(f)
+    finally:
+        f.close()
+    if isinstance(aggregate, list):
+        # Written before the merged spool was recorded
+        aggregate = {"records": aggregate, "merged": None}
+    for record in aggregate["records"]:
+        merge_record(histograms, record)
+    return histograms, aggregate["merged"]
+
+
+def merge_record(histograms, record):
+    key = metric_key(record["name"], record["labels"])
+    if key not in histograms:
+        histograms[key] = Histogram()
+    histograms[key].merge(record["counts"], record["sum"], record["count"])
+
+
+def collect(metrics_dir):
+    """
+    Merges the spool to the aggregate. Returns dict of metric key ->
+    Histogram.
+    """
+    from fstools import atomic_write, file_lock
+
+    spool_path = os.path.join(metrics_dir, SPOOL_NAME)
+    aggregate_path = os.path.join(metrics_dir, AGGREGATE_NAME)
+
+    with file_lock(os.path.join(metrics_dir, ".lock")):
+        histograms, merged = load_aggregate(aggregate_path)
+
+        # Leftover of an interrupted exporter is merged first unless the
+        # aggregate was already written with it
+        leftovers = []
+        for name in os.listdir(metrics_dir):
+            if not name.startswith(COLLECTING_PREFIX):
+                continue
+            if name == merged:
+                os.remove(os.path.join(metrics_dir, name))
+            else:
+                leftovers.append(name)
+
+        if leftovers:
+            collecting_name = leftovers[0]
+        else:
+            collecting_name = "%s%d.%d" % (COLLECTING_PREFIX,
+                                           time.time() * 1000000, os.getpid())
+            try:
+                os.rename(spool_path,
+                          os.path.join(metrics_dir, collecting_name))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return histograms
+        collecting_path = os.path.join(metrics_dir, collecting_name)
+
+        f = open(collecting_path)
+        try:
+            # Wait for the writers which opened the file before the rename
+            fcntl.flock(f, fcntl.LOCK_EX)
+            for line in f:
+                if line.strip():
+                    for record in json.loads(line):
+                        merge_record(histograms, record)
+        finally:
+            f.close()
+
+        registry = Registry()
+        registry.histograms = histograms
+        atomic_write(aggregate_path, json.dumps({"records": registry.records(),
+                                                 "merged": collecting_name}))
+        os.remove(collecting_path)
+
+    return histograms
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                                 .replace('"', '\\"'))
+                    for name, value in labels)
+
+
+def format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(bound)
+
+
+def prometheus_text(histograms):
+    """
+    Formats the histograms in the Prometheus text exposition format
+    """
+    lines = []
+    by_name = {}
+    for key in histograms:
+        by_name.setdefault(key[0], []).append(key)
+
+    for name in sorted(by_name):
+        lines.append("# TYPE %s histogram" % name)
+        for key in sorted(by_name[name]):
+            histogram = histograms[key]
+            labels = list(key[1:])
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append("%s_bucket{%s} %d" % (
+                    name, format_labels(labels + [("le",
+                                                   format_bound(bound))]),
+                    cumulative))
+            lines.append("%s_sum{%s} %r" % (name, format_labels(labels),
+                                            histogram.sum))
+            lines.append("%s_count{%s} %d" % (name, format_labels(labels),
+                                              histogram.count))
+
+    return "".join(line + "\n" for line in lines)
+
+
+def main(args=None):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [--output file] <metrics dir>")
+    parser.add_option("--output",
+                      help="Write to this file instead of stdout, eg. for "
+                           "the textfile collector of node_exporter")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("Metrics directory is missing")
+
+    text = prometheus_text(collect(args[0]))
+    if options.output:
+        from fstools import atomic_write
+        atomic_write(options.output, text)
+    else:
+        sys.stdout.write(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+
+Caches the packs git-upload-pack sends to cloning clients.
+
+The cache is used as uploadpack.packObjectsHook. Git runs the hook in the
+repository with the pack-objects command line as arguments and the
+want/have list in stdin. Packs of clones, requests without haves, are
+stored in <cache dir>/<repository hash>/<request hash>.pack where the request
+hash covers the pack-objects arguments (the capabilities) and the wanted
+objects, which pin down the refs the client saw. The cache of a repository is
+invalidated after each push and the least recently used packs are evicted
+when the cache grows over its size limit.
+
+usage: python -m revisioncask.packcache [options] git pack-objects [args]
+"""
+
+import os
+import sys
+import fcntl
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+
+PACK_SUFFIX = ".pack"
+CHUNK_SIZE = 64 * 1024
+
+
+def is_clone_request(request):
+    """
+    Returns True if the pack-objects request has no haves. Packs for fetches
+    depend on what the client has and are not worth caching.
+    """
+    lines = request.splitlines()
+    if "--not" not in lines:
+        return True
+    haves = lines[lines.index("--not") + 1:]
+    return not [line for line in haves if line and not line.startswith("-")]
+
+
+def config_parameter(key, value):
+    """
+    Quotes key=value for GIT_CONFIG_PARAMETERS
+    """
+    return "'%s'" % ("%s=%s" % (key, value)).replace("'", "'\\''")
+
+
+def shell_quote(arg):
+    return "'%s'" % arg.replace("'", "'\\''")
+
+
+class PackCache(object):
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def hook_command(self):
+        """
+        Command for uploadpack.packObjectsHook
+        """
+        return " ".join(shell_quote(arg) for arg in
+                        (sys.executable, "-m", "revisioncask.packcache",
+                         "--dir", self.cache_dir,
+                         "--max-size", str(self.max_size)))
+
+    def enable(self, environ=os.environ):
+        """
+        Makes git processes started with the environment use the cache.
+        packObjectsHook is ignored in the repository config, so it is given
+        as command line config in GIT_CONFIG_PARAMETERS.
+        """
+        environ["GIT_CONFIG_PARAMETERS"] = config_parameter(
+            "uploadpack.packObjectsHook", self.hook_command())
+
+    def repo_dir(self, repo_path):
+        return os.path.join(self.cache_dir, hashlib.sha1(
+            os.path.realpath(repo_path)).hexdigest())
+
+    def key(self, args, request):
+        h = hashlib.sha1()
+        for arg in args:
+            h.update(arg + "\0")
+        h.update(request)
+        return h.hexdigest()
+
+    def pack_path(self, repo_path, key):
+        return os.path.join(self.repo_dir(repo_path), key + PACK_SUFFIX)
+
+    def lookup(self, repo_path, key):
+        """
+        Returns open file of the cached pack or None
+        """
+        path = self.pack_path(repo_path, key)
+        try:
+            f = open(path, "rb")
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        # mtime is the last use for the eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return f
+
+    def new_pack(self, repo_path):
+        """
+        Returns (file, path) of a temporary file for a new pack
+        """
+        repo_dir = self.repo_dir(repo_path)
+        if not os.path.exists(repo_dir):
+            try:
+                os.makedirs(repo_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, path = tempfile.mkstemp(dir=repo_dir, prefix=".tmp-")
+        return os.fdopen(fd, "wb"), path
+
+    def store(self, repo_path, key, tmp_path):
+        try:
+            os.rename(tmp_path, self.pack_path(repo_path, key))
+        except OSError, e:
+            # Invalidated while the pack was generated
+            if e.errno != errno.ENOENT:
+                raise
+            self._remove(tmp_path)
+            return
+        self.evict()
+
+    def invalidate(self, repo_path):
+        """
+        Drops all cached packs of the repository
+        """
+        repo_dir = self.repo_dir(repo_path)
+        if not os.path.exists(repo_dir):
+            return
+        # Rename first so that packs being generated cannot be stored to the
+        # old cache
+        dropped = tempfile.mkdtemp(prefix=".invalidated-", dir=self.cache_dir)
+        try:
+            os.rename(repo_dir, os.path.join(dropped, "packs"))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        shutil.rmtree(dropped, ignore_errors=True)
+
+    def entries(self):
+        """
+        Yields (last use, size, path) of all cached packs
+        """
+        if not os.path.exists(self.cache_dir):
+            return
+        for repo_hash in os.listdir(self.cache_dir):
+            if repo_hash.startswith("."):
+                continue
+            repo_dir = os.path.join(self.cache_dir, repo_hash)
+            try:
+                names = os.listdir(repo_dir)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith(PACK_SUFFIX):
+                    continue
+                path = os.path.join(repo_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def evict(self):
+        """
+        Removes least recently used packs until the cache fits to max_size
+        """
+        lock_file = open(os.path.join(self.cache_dir, ".lock"), "a")
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    # Other process is evicting
+                    return
+                raise
+
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                self._remove(path)
+                total -= size
+        finally:
+            lock_file.close()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def serve(self, repo_path, args, stdin, stdout):
+        """
+        Writes the pack requested from pack-objects command args to stdout.
+        Returns exit code.
+        """
+        request = stdin.read()
+
+        if not is_clone_request(request):
+            return self._pack_objects(args, request, stdout)
+
+        key = self.key(args, request)
+        cached = self.lookup(repo_path, key)
+        if cached is not None:
+            try:
+                shutil.copyfileobj(cached, stdout, CHUNK_SIZE)
+                stdout.flush()
+            finally:
+                cached.close()
+            return 0
+
+        pack, tmp_path = self.new_pack(repo_path)
+        try:
+            code = self._pack_objects(args, request, stdout, pack)
+        except:
+            pack.close()
+            self._remove(tmp_path)
+            raise
+        pack.close()
+
+        if code == 0:
+            self.store(repo_path, key, tmp_path)
+        else:
+            self._remove(tmp_path)
+        return code
+
+    def _pack_objects(self, args, request, stdout, copy_to=None):
+        process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+
+        # Large want lists must not block the pack output
+        def feed():
+            try:
+                process.stdin.write(request)
+            except IOError:
+                pass
+            process.stdin.close()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+
+        try:
+            while True:
+                data = process.stdout.read(CHUNK_SIZE)
+                if not data:
+                    break
+                stdout.write(data)
+                if copy_to is not None:
+                    copy_to.write(data)
+            stdout.flush()
+        except:
+            process.kill()
+            process.wait()
+            feeder.join()
+            raise
+
+        feeder.join()
+        return process.wait()
+
+
+def main(args=None):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] git pack-objects [args]")
+    parser.disable_interspersed_args()
+    parser.add_option("--dir", dest="cache_dir",
+                      help="Directory of the cache")
+    parser.add_option("--max-size", dest="max_size", type="int", default=0,
+                      help="Maximum size of the cache in bytes")
+
+    options, command = parser.parse_args(args)
+    if not options.cache_dir or not command:
+        parser.error("Cache directory or pack-objects command is missing")
+
+    # Git runs the hook in the repository
+    cache = PackCache(options.cache_dir, options.max_size)
+    return cache.serve(os.getcwd(), command, sys.stdin, sys.stdout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+
+Central SQLite store of repository owners and permissions.
+
+When enabled the store is the source of truth of the permissions. The access
+record and the native permission files of the repositories are still
+written on every change for svnserve, hg and undelete.
+"""
+
+import os
+import threading
+
+from repoindex import IndexedRepo
+import groups
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS repos (
+    name_on_fs TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS repos_by_name ON repos (name);
+CREATE TABLE IF NOT EXISTS owners (
+    name_on_fs TEXT NOT NULL,
+    username TEXT NOT NULL,
+    PRIMARY KEY (name_on_fs, username)
+);
+CREATE INDEX IF NOT EXISTS owners_by_username ON owners (username);
+CREATE TABLE IF NOT EXISTS permissions (
+    name_on_fs TEXT NOT NULL,
+    username TEXT NOT NULL,
+    permissions TEXT NOT NULL,
+    PRIMARY KEY (name_on_fs, username)
+);
+CREATE INDEX IF NOT EXISTS permissions_by_username
+    ON permissions (username, permissions);
+"""
+
+# Repositories readable by a user: given to the user, to the groups of the
+# user or to everybody
+READABLE_BY = ("SELECT name_on_fs FROM permissions "
+               "WHERE username IN (%s) AND permissions LIKE '%%r%%'")
+
+OWNED_BY = "SELECT name_on_fs FROM owners WHERE username = ?"
+
+
+class StoredRepo(IndexedRepo):
+    """
+    IndexedRepo whose path is resolved from the layout only when needed
+    """
+
+    def __init__(self, layout, name_on_fs, name, owners, permissions,
+                 permission_groups=None):
+        self._layout = layout
+        self._name_on_fs = name_on_fs
+        self.name = name
+        self._owners = set(owners)
+        self._permissions = permissions
+        self.permission_groups = permission_groups
+
+    @property
+    def name_on_fs(self):
+        return self._name_on_fs
+
+    @property
+    def repo_path(self):
+        return self._layout.path(self._name_on_fs)
+
+
+def store_from(config):
+    """
+    Returns PermissionStore if PERMISSION_STORE is enabled in the config of
+    the VCS, otherwise None
+    """
+    import subssh
+    if not subssh.to_bool(config.PERMISSION_STORE):
+        return None
+    return PermissionStore(config.PERMISSION_STORE_PATH)
+
+
+class PermissionStore(object):
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # sqlite3 connections cannot be shared between the threads of the
+        # bulk commands
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # Imported here to keep startup of the transport commands fast
+            import sqlite3
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            db = sqlite3.connect(self.db_path, timeout=30)
+            # Readers are not blocked by the writers
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    def imported(self):
+        """
+        Returns True if the existing repositories have been imported. Until
+        then the store does not know all repositories.
+        """
+        return self.db.execute("SELECT 1 FROM meta WHERE key = 'imported'"
+                               ).fetchone() is not None
+
+    def mark_imported(self):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                        "VALUES ('imported', '1')")
+        self.db.commit()
+
+    def __contains__(self, name_on_fs):
+        return self.db.execute("SELECT 1 FROM repos WHERE name_on_fs = ?",
+                               (name_on_fs,)).fetchone() is not None
+
+    def load(self, name_on_fs):
+        """
+        Returns (owners, permissions dict) of the repository or None if it is
+        not in the store
+        """
+        if name_on_fs not in self:
+            return None
+        owners = [row[0] for row in
+                  self.db.execute("SELECT username FROM owners "
+                                  "WHERE name_on_fs = ?", (name_on_fs,))]
+        return owners, self._permissions(name_on_fs)
+
+    def _permissions(self, name_on_fs):
+        return dict(self.db.execute("SELECT username, permissions "
+                                    "FROM permissions WHERE name_on_fs = ?",
+                                    (name_on_fs,)))
+
+    def get_all_permissions(self, name_on_fs):
+        """
+        Returns username/permissions dict of the repository or None if it is
+        not in the store
+        """
+        rows = self.db.execute("SELECT p.username, p.permissions "
+                               "FROM repos r LEFT JOIN permissions p "
+                               "ON p.name_on_fs = r.name_on_fs "
+                               "WHERE r.name_on_fs = ?",
+                               (name_on_fs,)).fetchall()
+        if not rows:
+            return None
+        return dict(row for row in rows if row[0] is not None)
+
+    def save(self, name_on_fs, name, owners, permissions):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO repos (name_on_fs, name) "
+                            "VALUES (?, ?)", (name_on_fs, name))
+            self._delete_access(name_on_fs)
+            self.db.executemany("INSERT INTO owners (name_on_fs, username) "
+                                "VALUES (?, ?)",
+                                [(name_on_fs, owner) for owner in owners])
+            self.db.executemany("INSERT INTO permissions "
+                                "(name_on_fs, username, permissions) "
+                                "VALUES (?, ?, ?)",
+                                [(name_on_fs, username, perms)
+                                 for username, perms in permissions.items()])
+
+    def _delete_access(self, name_on_fs):
+        for table in ("owners", "permissions"):
+            self.db.execute("DELETE FROM %s WHERE name_on_fs = ?" % table,
+                            (name_on_fs,))
+
+    def delete(self, name_on_fs):
+        with self.db:
+            self.db.execute("DELETE FROM repos WHERE name_on_fs = ?",
+                            (name_on_fs,))
+            self._delete_access(name_on_fs)
+
+    def rename(self, name_on_fs, new_name_on_fs, new_name):
+        with self.db:
+            self.db.execute("UPDATE repos SET name_on_fs = ?, name = ? "
+                            "WHERE name_on_fs = ?",
+                            (new_name_on_fs, new_name, name_on_fs))
+            for table in ("owners", "permissions"):
+                self.db.execute("UPDATE %s SET name_on_fs = ? "
+                                "WHERE name_on_fs = ?" % table,
+                                (new_name_on_fs, name_on_fs))
+
+    def iter_repositories(self, layout, owner=None, readable_by=None,
+                          permission_groups=None):
+        """
+        Yields the repositories as IndexedRepo objects ordered by name. Only
+        the ones owned by owner or readable by readable_by if given. Paths
+        are resolved from the layout and group membership from
+        permission_groups.
+
+        Rows are streamed from one query. Owners and permissions of each
+        repository are collected by the primary key indexes.
+        """
+        where = ""
+        args = ()
+        if owner is not None:
+            where = "WHERE r.name_on_fs IN (%s)" % OWNED_BY
+            args = (owner,)
+        elif readable_by is not None:
+            args = ((readable_by.lower(), "*")
+                    + tuple(groups.member_of(permission_groups,
+                                             readable_by)))
+            where = "WHERE r.name_on_fs IN (%s)" % (
+                READABLE_BY % ", ".join("?" * len(args)))
+
+        rows = self.db.execute(
+            "SELECT r.name_on_fs, r.name, "
+            "(SELECT group_concat(username, ' ') FROM owners o "
+            " WHERE o.name_on_fs = r.name_on_fs), "
+            "(SELECT group_concat(username || '=' || permissions, ' ') "
+            " FROM permissions p WHERE p.name_on_fs = r.name_on_fs) "
+            "FROM repos r " + where + " ORDER BY r.name", args)
+        try:
+            for name_on_fs, name, owners, permissions in rows:
+                yield StoredRepo(layout, name_on_fs, name,
+                                 (owners or "").split(),
+                                 dict(item.rsplit("=", 1) for item
+                                      in (permissions or "").split()),
+                                 permission_groups)
+        finally:
+            rows.close()
+
+    def repositories(self, layout, owner=None, readable_by=None,
+                     permission_groups=None):
+        """
+        Returns the repositories as a list of IndexedRepo objects
+        """
+        return list(self.iter_repositories(
+            layout, owner=owner, readable_by=readable_by,
+            permission_groups=permission_groups))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+Lazy registry of the VCS modules.
+
+Only the module needed by a command is imported and only the managers
+asked for are created.
+"""
+
+import sys
+
+
+VCS_MODULES = { "git": "revisioncask.git",
+                "hg":  "revisioncask.hg",
+                "svn": "revisioncask.svn" }
+
+# Transport command -> (vcs, handler function name)
+TRANSPORT_COMMANDS = { "git-upload-pack":    ("git", "handle_git"),
+                       "git-receive-pack":   ("git", "handle_git"),
+                       "git-upload-archive": ("git", "handle_git"),
+                       "hg":                 ("hg", "hg_handle"),
+                       "svnserve":           ("svn", "handle_svn") }
+
+_managers = {}
+
+
+def load_module(vcs):
+    module_name = VCS_MODULES[vcs]
+    if module_name not in sys.modules:
+        __import__(module_name)
+    return sys.modules[module_name]
+
+
+def load_handler(cmd):
+    """
+    Returns the handler function of the transport command or None
+    """
+    try:
+        vcs, handler_name = TRANSPORT_COMMANDS[cmd]
+    except KeyError:
+        return None
+    return getattr(load_module(vcs), handler_name)
+
+
+def get_manager(vcs):
+    """
+    Returns RepoManager of the VCS. It is created on the first call.
+    """
+    if vcs not in _managers:
+        _managers[vcs] = load_module(vcs).create_manager()
+    return _managers[vcs]
+
+
+def load_config(path):
+    """
+    Applies the app sections of the subssh config file to the config classes
+    of the VCS modules like the subssh loader does. Option REPOSITORIES of
+    section [revisioncask.git] sets revisioncask.git.config.REPOSITORIES.
+    """
+    from ConfigParser import RawConfigParser
+
+    parser = RawConfigParser()
+    if not parser.read(path):
+        raise IOError("Cannot read config file %s" % path)
+
+    for vcs, module_name in VCS_MODULES.items():
+        if not parser.has_section(module_name):
+            continue
+        module = load_module(vcs)
+        for key, value in parser.items(module_name):
+            setattr(module.config, key.upper(), value)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+Removes deleted repositories from the trash directories.
+
+Deleted repositories are moved to trash as <trash>/<timestamp>-<random>/<name>.
+The reaper removes the entries older than the grace period. The removal is
+rate limited so that it does not starve the other users of the disk.
+
+usage: python -m revisioncask.reaper [options] <trash dir>...
+"""
+
+import os
+import sys
+import time
+import fcntl
+import errno
+import tempfile
+import threading
+
+
+REAPING_SUFFIX = ".reaping"
+
+
+def move_to_trash(path, trash_path, name):
+    """
+    Moves path to a new unique entry of the trash directory as
+    <entry>/<name>.
+
+    The entry is filled under a name starting with a dot, which reapers
+    skip, and renamed to its <timestamp>-<random> name only after that.
+    Otherwise a reaper could claim the empty entry before path is moved in.
+    """
+    if not os.path.exists(trash_path):
+        os.makedirs(trash_path)
+    pending = tempfile.mkdtemp(prefix=".%d-" % time.time(), dir=trash_path)
+    os.rename(path, os.path.join(pending, name))
+    os.rename(pending, os.path.join(trash_path,
+                                    os.path.basename(pending)[1:]))
+
+
+def entry_time(entry_name):
+    try:
+        return int(entry_name.split("-", 1)[0])
+    except ValueError:
+        return None
+
+
+def trash_entries(trash_path):
+    """
+    Yields tuples of (deletion time, entry path) for entries not yet claimed
+    by a reaper
+    """
+    if not os.path.exists(trash_path):
+        return
+
+    for entry_name in os.listdir(trash_path):
+        deleted = entry_time(entry_name)
+        if deleted is None or entry_name.endswith(REAPING_SUFFIX):
+            continue
+        yield deleted, os.path.join(trash_path, entry_name)
+
+
+class RateLimiter(object):
+    """
+    Allows at most rate operations per second shared between threads
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        self.lock.acquire()
+        try:
+            now = time.time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Reaper(object):
+
+    def __init__(self, trash_paths, grace_period=0, workers=1,
+                 files_per_second=0):
+        self.trash_paths = trash_paths
+        self.grace_period = grace_period
+        self.workers = workers
+        self.limiter = RateLimiter(files_per_second)
+
+    def _remove_tree(self, path):
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for filename in filenames:
+                self.limiter.wait()
+                os.remove(os.path.join(dirpath, filename))
+            for dirname in dirnames:
+                dirname = os.path.join(dirpath, dirname)
+                if os.path.islink(dirname):
+                    os.remove(dirname)
+                else:
+                    os.rmdir(dirname)
+        os.rmdir(path)
+
+    def _reap_entry(self, entry_path):
+        # Claim the entry first so that it cannot be undeleted while it's
+        # half removed.
+        claimed = entry_path + REAPING_SUFFIX
+        try:
+            os.rename(entry_path, claimed)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        self._remove_tree(claimed)
+
+    def expired_entries(self):
+        deadline = time.time() - self.grace_period
+        for trash_path in self.trash_paths:
+            for deleted, entry_path in trash_entries(trash_path):
+                if deleted <= deadline:
+                    yield entry_path
+
+            # Leftovers from interrupted reapers
+            if os.path.exists(trash_path):
+                for entry_name in os.listdir(trash_path):
+                    if entry_name.endswith(REAPING_SUFFIX):
+                        yield os.path.join(trash_path, entry_name)
+
+    def _reap(self, entry_path):
+        if entry_path.endswith(REAPING_SUFFIX):
+            self._remove_tree(entry_path)
+        else:
+            self._reap_entry(entry_path)
+
+    def reap(self):
+        """
+        Removes all expired entries from the trash directories
+        """
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.workers)
+        try:
+            pool.map(self._reap, list(self.expired_entries()))
+        finally:
+            pool.close()
+            pool.join()
+
+
+def acquire_reaper_lock(trash_path):
+    """
+    Returns an open lock file or None if other reaper is already running
+    """
+    if not os.path.exists(trash_path):
+        os.makedirs(trash_path)
+    lock_file = open(os.path.join(trash_path, ".lock"), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            lock_file.close()
+            return None
+        raise
+    return lock_file
+
+
+def spawn(trash_path, grace_period=0, workers=1, files_per_second=0):
+    """
+    Starts reaper on the background with low I/O and CPU priority. The idle
+    I/O class is used if ionice is available.
+    """
+    import subprocess
+
+    cmd = ["nice", sys.executable, "-m", "revisioncask.reaper",
+           "--grace", str(grace_period),
+           "--workers", str(workers),
+           "--rate", str(files_per_second),
+           trash_path]
+
+    devnull = open(os.devnull, "r+")
+    try:
+        for ionice in (["ionice", "-c3"], []):
+            try:
+                subprocess.Popen(ionice + cmd, stdin=devnull, stdout=devnull,
+                                 stderr=devnull, close_fds=True,
+                                 preexec_fn=os.setsid)
+                return
+            except OSError, e:
+                if e.errno != errno.ENOENT or not ionice:
+                    raise
+    finally:
+        devnull.close()
+
+
+def main(args=None):
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] <trash dir>...")
+    parser.add_option("--grace", dest="grace", type="int", default=0,
+                      help="Seconds to keep deleted repositories")
+    parser.add_option("--workers", dest="workers", type="int", default=1,
+                      help="Number of repositories removed concurrently")
+    parser.add_option("--rate", dest="rate", type="int", default=0,
+                      help="Maximum number of files removed per second")
+
+    options, trash_paths = parser.parse_args(args)
+    if not trash_paths:
+        parser.error("Trash directory is missing")
+
+    locks = []
+    for trash_path in trash_paths:
+        lock = acquire_reaper_lock(trash_path)
+        if lock is None:
+            # Other reaper is handling it
+            continue
+        locks.append(lock)
+
+        Reaper([trash_path], grace_period=options.grace,
+               workers=options.workers, files_per_second=options.rate).reap()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+import errno
+import json
+import threading
+
+from subssh import config
+
+from abstractrepo import InvalidRepository, BrokenRepository
+from abstractrepo import match_permissions
+from repolayout import FlatLayout
+from fstools import directory_size
+
+
+# Timestamps younger than this are not trusted. The file might still change
+# within the same mtime tick without us noticing it.
+FRESHNESS_WINDOW = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS repos (
+    name_on_fs TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    stamp TEXT NOT NULL,
+    owners TEXT NOT NULL,
+    permissions TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invalid (
+    name_on_fs TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS usage (
+    name_on_fs TEXT PRIMARY KEY,
+    stamp TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+
+
+def _stat_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, repr(st.st_mtime), st.st_size)
+
+
+def _trusted(mtime, now):
+    return now - mtime > FRESHNESS_WINDOW
+
+
+def _latest_mtime(repo_path, markers):
+    """
+    Returns the latest mtime of the marker paths or None if none exists
+    """
+    mtimes = []
+    for marker in markers:
+        path = os.path.join(repo_path, marker)
+        if marker.endswith("/"):
+            paths = [dirpath for dirpath, _, _ in os.walk(path)]
+        else:
+            paths = [path]
+        for path in paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                pass
+    if mtimes:
+        return max(mtimes)
+
+
+class IndexedRepo(object):
+    """
+    Read-only view of a repository served from the index.
+
+    Implements the querying part of the VCS interface so it can be used
+    where only names, owners and permissions are needed.
+    """
+
+    def __init__(self, repo_path, name, owners, permissions,
+                 permission_groups=None):
+        self.repo_path = repo_path
+        self.name = name
+        self._owners = set(owners)
+        self._permissions = permissions
+        self.permission_groups = permission_groups
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+    @property
+    def name_on_fs(self):
+        return os.path.basename(self.repo_path)
+
+    def get_owners(self):
+        return sorted(self._owners)
+
+    def is_owner(self, username):
+        return username in self._owners
+
+    def get_all_permissions(self):
+        return sorted(self._permissions.items())
+
+    def has_permissions(self, username, permissions):
+        return match_permissions(self._permissions, username, permissions,
+                                 self.permission_groups)
+
+
+class RepoIndex(object):
+    """
+    Persistent index of repository names, owners and permissions.
+
+    Entries are validated against the mtimes of the repository directories
+    and the stat of the access record of each repository.
+    Only the repositories whose files have changed are parsed again.
+    """
+
+    def __init__(self, klass, repos_path, index_path, layout=None):
+        self.klass = klass
+        self.path_to_repos = repos_path
+        if layout is None:
+            layout = FlatLayout(repos_path)
+        self.layout = layout
+        self.index_path = index_path
+        # sqlite3 connections cannot be shared between threads. The unified
+        # commands list the managers in a thread pool.
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # Imported here to keep startup of the transport commands fast
+            import sqlite3
+            directory = os.path.dirname(self.index_path)
+            if directory and not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            db = sqlite3.connect(self.index_path, timeout=30)
+            # Readers streaming ls output must not block the writers
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key,)).fetchone()
+        if row:
+            return row[0]
+
+    def _set_meta(self, key, value):
+        if self._get_meta(key) == value:
+            # Writing would start a transaction for nothing
+            return
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                        "VALUES (?, ?)", (key, value))
+
+    def _repo_stamp(self, repo_path, now):
+        paths = [os.path.join(repo_path, self.klass.access_record_name)]
+        stamps = [_stat_stamp(paths[0])]
+        if stamps[0] is None:
+            # Not migrated to the access record yet
+            paths = [os.path.join(repo_path, self.klass.permdb_name)]
+            owner_path = os.path.join(repo_path, self.klass.owner_filename)
+            if owner_path not in paths:
+                paths.append(owner_path)
+            stamps = [_stat_stamp(path) for path in paths]
+
+        for stamp in stamps:
+            if stamp and not _trusted(float(stamp[1]), now):
+                # Changed too recently, force parsing on next run too.
+                return None
+        return json.dumps(stamps)
+
+    def _names_on_fs(self, now):
+        """
+        Returns the names on fs. Directories are listed only if they have
+        changed since the last time.
+        """
+        directories = self.layout.directories()
+        mtimes = [os.stat(directory).st_mtime for directory in directories]
+        dir_mtime = repr(mtimes)
+
+        if self._get_meta("dir_mtime") == dir_mtime:
+            # Invalid entries are checked again on every call. They may be
+            # repositories being created.
+            return [row[0] for row in
+                    self.db.execute("SELECT name_on_fs FROM repos UNION "
+                                    "SELECT name_on_fs FROM invalid")]
+
+        names = set()
+        for directory in directories:
+            names.update(name for name in os.listdir(directory)
+                         if not name.startswith("."))
+
+        known = set(row[0] for row in
+                    self.db.execute("SELECT name_on_fs FROM repos UNION "
+                                    "SELECT name_on_fs FROM invalid"))
+        for gone in known.difference(names):
+            self._delete_entry(gone)
+
+        if _trusted(max(mtimes), now):
+            self._set_meta("dir_mtime", dir_mtime)
+        else:
+            self._set_meta("dir_mtime", "")
+
+        return list(names)
+
+    def _parse(self, name_on_fs, stamp, updates):
+        """
+        Returns IndexedRepo built from the repository files or None if it is
+        not a valid repository. The new index row is appended to updates.
+        """
+        repo_path = self.layout.path(name_on_fs)
+        try:
+            repo = self.klass(repo_path, config.ADMIN)
+        except (InvalidRepository, BrokenRepository):
+            updates.append((name_on_fs, None))
+            return None
+
+        permissions = dict(repo.get_all_permissions())
+        updates.append((name_on_fs, (repo.name, stamp or "",
+                                     "\n".join(repo.get_owners()),
+                                     json.dumps(permissions))))
+
+        return IndexedRepo(repo_path, repo.name, repo.get_owners(),
+                           permissions, self.klass.permission_groups)
+
+    def _write_updates(self, updates):
+        for name_on_fs, row in updates:
+            if row is None:
+                self._delete_entry(name_on_fs)
+                self.db.execute("INSERT OR IGNORE INTO invalid (name_on_fs) "
+                                "VALUES (?)", (name_on_fs,))
+            else:
+                self.db.execute("DELETE FROM invalid WHERE name_on_fs = ?",
+                                (name_on_fs,))
+                self.db.execute("INSERT OR REPLACE INTO repos "
+                                "(name_on_fs, name, stamp, owners, "
+                                "permissions) VALUES (?, ?, ?, ?, ?)",
+                                (name_on_fs,) + row)
+
+    def _name(self, name_on_fs):
+        """
+        Returns the repository name of the name on fs
+        """
+        name = name_on_fs
+        if self.klass.prefix and name.startswith(self.klass.prefix):
+            name = name[len(self.klass.prefix):]
+        if self.klass.suffix and name.endswith(self.klass.suffix):
+            name = name[:-len(self.klass.suffix)]
+        return name
+
+    def _delete_entry(self, name_on_fs):
+        for table in ("repos", "invalid", "usage"):
+            self.db.execute("DELETE FROM %s WHERE name_on_fs = ?" % table,
+                            (name_on_fs,))
+
+    def discard(self, name_on_fs):
+        """
+        Removes repository from the index
+        """
+        self._delete_entry(name_on_fs)
+        self.db.commit()
+
+    def iter_repositories(self):
+        """
+        Yields all valid repositories as IndexedRepo objects ordered by name.
+        Stale entries are refreshed on the way.
+
+        The index rows are read with one ordered query merged with the
+        sorted names. Refreshed rows are written after the scan, since the
+        table must not change under the open query. No write transaction is
+        open while yielding, so the scan can be stopped at any point and
+        the consumer can be slow.
+        """
+        now = time.time()
+
+        if not os.path.isdir(self.path_to_repos):
+            return
+
+        updates = []
+        rows = None
+        complete = False
+        try:
+            names = sorted((self._name(name_on_fs), name_on_fs)
+                           for name_on_fs in self._names_on_fs(now))
+            self.db.commit()
+            rows = self.db.execute("SELECT name_on_fs, name, stamp, owners, "
+                                   "permissions FROM repos "
+                                   "ORDER BY name, name_on_fs")
+            row = next(rows, None)
+
+            for key in names:
+                name_on_fs = key[1]
+                while row is not None and (row[1], row[0]) < key:
+                    row = next(rows, None)
+
+                repo_path = self.layout.path(name_on_fs)
+                stamp = self._repo_stamp(repo_path, now)
+
+                if (row is not None and row[0] == name_on_fs and stamp
+                    and row[2] == stamp):
+                    _, name, _, owners, permissions = row
+                    repo = IndexedRepo(repo_path, name,
+                                       [o for o in owners.split("\n") if o],
+                                       json.loads(permissions),
+                                       self.klass.permission_groups)
+                else:
+                    repo = self._parse(name_on_fs, stamp, updates)
+
+                if repo is not None:
+                    yield repo
+
+            complete = True
+        finally:
+            if rows is not None:
+                rows.close()
+            self._write_updates(updates)
+            if not complete:
+                # The names after an interrupted scan were not checked
+                self._set_meta("dir_mtime", "")
+            self.db.commit()
+
+    def repositories(self):
+        """
+        Returns all valid repositories as IndexedRepo objects. Stale entries
+        are refreshed on the way.
+        """
+        return list(self.iter_repositories())
+
+    def iter_usage(self, repos):
+        """
+        Yields (repo, time of the last push, size in bytes) of the
+        repositories. The size is computed again only when the push or size
+        markers of the repository have changed since the last time.
+        """
+        now = time.time()
+        updates = []
+        try:
+            for repo in repos:
+                pushed = _latest_mtime(repo.repo_path, self.klass.push_markers)
+                changed = _latest_mtime(repo.repo_path,
+                                        self.klass.size_markers)
+                stamp = repr((pushed, changed))
+
+                row = self.db.execute("SELECT stamp, size FROM usage "
+                                      "WHERE name_on_fs = ?",
+                                      (repo.name_on_fs,)).fetchone()
+                if row and row[0] == stamp:
+                    size = row[1]
+                else:
+                    size = directory_size(repo.repo_path)
+                    if all(mtime is not None and _trusted(mtime, now)
+                           for mtime in (pushed, changed)):
+                        updates.append((repo.name_on_fs, stamp, size))
+
+                yield repo, pushed, size
+        finally:
+            # Written after the scan like the repository rows
+            self.db.executemany("INSERT OR REPLACE INTO usage "
+                                "(name_on_fs, stamp, size) "
+                                "VALUES (?, ?, ?)", updates)
+            self.db.commit()
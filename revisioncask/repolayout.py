@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+
+Directory layouts of the repositories.
+
+The flat layout keeps every repository directly in the repository
+directory. The sharded layout spreads them to 256 subdirectories by a hash
+of the name so that no directory grows huge:
+
+    <repos>/.shards/<first two hex digits of sha1 of name on fs>/<name on fs>
+
+Names starting with a dot are reserved, so the shards never collide with
+the repositories. Repositories not moved to the shards yet are still found
+in the flat location. svnserve resolves the repositories from the protocol
+itself, so for it the sharded layout can keep a symlink in the flat location
+of each repository.
+"""
+
+import os
+import hashlib
+
+
+SHARDS_NAME = ".shards"
+
+
+def shard(name_on_fs):
+    return hashlib.sha1(name_on_fs).hexdigest()[:2]
+
+
+class FlatLayout(object):
+
+    sharded = False
+
+    def __init__(self, repos_path):
+        self.repos_path = repos_path
+
+    def path(self, name_on_fs):
+        """
+        Returns path of the repository
+        """
+        return os.path.join(self.repos_path, name_on_fs)
+
+    def directories(self):
+        """
+        Returns the directories containing repositories
+        """
+        return [self.repos_path]
+
+    def link(self, name_on_fs):
+        """
+        Updates the flat location symlink of the repository if the layout
+        keeps them
+        """
+
+    def unlink(self, name_on_fs):
+        """
+        Removes the flat location symlink of the repository
+        """
+
+
+class ShardedLayout(FlatLayout):
+
+    sharded = True
+
+    def __init__(self, repos_path, flat_links=False):
+        self.repos_path = repos_path
+        self.shards_path = os.path.join(repos_path, SHARDS_NAME)
+        # Keep a symlink in the flat location of each sharded repository
+        self.flat_links = flat_links
+
+    def flat_path(self, name_on_fs):
+        return os.path.join(self.repos_path, name_on_fs)
+
+    def sharded_path(self, name_on_fs):
+        return os.path.join(self.shards_path, shard(name_on_fs), name_on_fs)
+
+    def path(self, name_on_fs):
+        path = self.sharded_path(name_on_fs)
+        if os.path.exists(path):
+            return path
+        # Not migrated yet
+        flat_path = self.flat_path(name_on_fs)
+        if os.path.exists(flat_path):
+            return flat_path
+        # New repositories go to the shards
+        return path
+
+    def directories(self):
+        directories = [self.repos_path]
+        if os.path.isdir(self.shards_path):
+            directories.extend(os.path.join(self.shards_path, name)
+                               for name in sorted(os.listdir(self.shards_path)))
+        return directories
+
+    def link(self, name_on_fs):
+        path = self.sharded_path(name_on_fs)
+        if not self.flat_links or not os.path.exists(path):
+            return
+        link = self.flat_path(name_on_fs)
+        tmp_link = os.path.join(self.repos_path, ".%s.link" % name_on_fs)
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.relpath(path, self.repos_path), tmp_link)
+        # Replaced atomically so that the repository is always found
+        os.rename(tmp_link, link)
+
+    def unlink(self, name_on_fs):
+        link = self.flat_path(name_on_fs)
+        if self.flat_links and os.path.islink(link):
+            os.remove(link)
+
+    def move_to_shard(self, repo):
+        """
+        Moves a repository from the flat location to its shard. The
+        repository is renamed atomically so it can be in use meanwhile.
+        """
+        repo.move_to(self.sharded_path(repo.name_on_fs))
+        self.link(repo.name_on_fs)
+
+
+def from_config(config):
+    """
+    Returns the layout set by SHARDED_LAYOUT in the config of a VCS
+    """
+    import subssh
+    if not subssh.to_bool(config.SHARDED_LAYOUT):
+        return FlatLayout(config.REPOSITORIES)
+    return ShardedLayout(config.REPOSITORIES)
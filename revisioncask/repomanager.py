@@ -20,7 +20,11 @@ License along with Subssh.  If not, see
 """
 
 import os
-import shutil
+import sys
+import json
+import time
+import fnmatch
+import itertools
 
 import subssh
 
@@ -28,6 +32,15 @@ import subssh
 from subssh.dirtools import create_required_directories_or_die
 from subssh import config
 from abstractrepo import InvalidPermissions, InvalidRepository
+from repoindex import RepoIndex
+from repolayout import FlatLayout, ShardedLayout
+from permstore import PermissionStore
+from repotemplate import RepoTemplates
+from weblists import WebProjects
+import reaper
+from maintenance import Maintenance
+import metrics
+import accounting
 
 
 
@@ -38,47 +51,196 @@ from abstractrepo import InvalidPermissions, InvalidRepository
 def format_list(iterable, sep=", "):
     return sep.join(iterable).strip(sep)
 
+
+def format_duration(seconds):
+    for unit, length in (("hours", 3600), ("minutes", 60)):
+        if seconds >= length:
+            return "%d %s" % (seconds / length, unit)
+    return "%d seconds" % seconds
+
+
+def name_matcher(pattern):
+    """
+    Returns a function matching repository names to a glob pattern or to a
+    prefix if the pattern has no wildcards
+    """
+    if any(c in pattern for c in "*?["):
+        return lambda name: fnmatch.fnmatchcase(name, pattern)
+    return lambda name: name.startswith(pattern)
+
+
+def paginate(repos, options):
+    """
+    Applies --offset and --limit of the ls options to the repositories
+    """
+    stop = None
+    if options["limit"] is not None:
+        stop = options["offset"] + options["limit"]
+    return itertools.islice(repos, options["offset"], stop)
+
+
+def repo_summary(repo):
+    """
+    Returns the JSON serializable summary of the repository used by ls
+    """
+    return {"name": repo.name,
+            "owners": repo.get_owners(),
+            "permissions": dict(repo.get_all_permissions())}
+
+
+def valid_repo_name(repo_name):
+    # Names starting with a dot are reserved for revisioncask itself
+    return (bool(subssh.safe_chars_only_pat.match(repo_name))
+            and not repo_name.startswith("."))
+
+
+def parse_ls_arguments(args):
+    """
+    Returns options of the ls command as a dict
+    """
+    options = {"mine": False, "json": False, "limit": None, "offset": 0,
+               "pattern": None}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ("--limit", "--offset") or arg.startswith(("--limit=",
+                                                               "--offset=")):
+            if "=" in arg:
+                arg, value = arg.split("=", 1)
+            elif args:
+                value = args.pop(0)
+            else:
+                raise subssh.InvalidArguments("%s needs a number" % arg)
+            try:
+                options[arg[2:]] = int(value)
+            except ValueError:
+                raise subssh.InvalidArguments("Bad number for %s: '%s'"
+                                              % (arg, value))
+            if options[arg[2:]] < 0:
+                raise subssh.InvalidArguments("%s cannot be negative" % arg)
+        elif arg == "--json":
+            options["json"] = True
+        elif arg.startswith("-"):
+            raise subssh.InvalidArguments("Unknown option '%s'" % arg)
+        elif arg == "mine" and not options["mine"]:
+            options["mine"] = True
+        elif options["pattern"] is None:
+            options["pattern"] = arg
+        else:
+            raise subssh.InvalidArguments("Too many arguments")
+    return options
+
 class RepoManager(object):
 
     klass = None
 
+    # In a subdirectory so that the journal files of the index do not
+    # change the mtime of the repository directory it watches
+    index_name = os.path.join(".revisioncask", "index.sqlite")
+
+    # Number of repositories modified concurrently by the bulk commands
+    bulk_workers = 4
+
+    trash_name = ".trash"
+
+    templates_name = ".templates"
+
+    # Format of the web project list. See weblists.RENDERERS.
+    web_list_format = None
+
+    # Keep symlinks in the flat locations in the sharded layout for VCSs
+    # finding the repositories by name themselves
+    flat_links = False
+
     def __init__(self, repos_path, web_repos_path=None,
-                 urls={}, default_permissions=tuple()):
+                 urls={}, default_permissions=tuple(), index_path=None,
+                 delete_grace_period=0, reaper_workers=1,
+                 reaper_files_per_second=1000, maintenance_path=None,
+                 accounting_path=None, permission_store_path=None,
+                 sharded=False, templates=False, web_project_list_path=None):
 
         self.default_permissions = default_permissions
 
         self.path_to_repos = repos_path
         self.urls = urls
 
+        # The trash must be on the same filesystem as the repositories
+        self.trash_path = os.path.join(self.path_to_repos, self.trash_name)
+        self.delete_grace_period = delete_grace_period
+        self.reaper_workers = reaper_workers
+        self.reaper_files_per_second = reaper_files_per_second
+
+        if maintenance_path:
+            self.maintenance = Maintenance(maintenance_path)
+        else:
+            self.maintenance = None
+
+        self.accounting_path = accounting_path
+
+        if permission_store_path:
+            self.store = PermissionStore(permission_store_path)
+        else:
+            self.store = None
+
+        if templates:
+            self.templates = RepoTemplates(os.path.join(self.path_to_repos,
+                                                        self.templates_name))
+        else:
+            self.templates = None
+
+        if sharded:
+            self.layout = ShardedLayout(self.path_to_repos, self.flat_links)
+        else:
+            self.layout = FlatLayout(self.path_to_repos)
+
+        if not index_path:
+            index_path = os.path.join(self.path_to_repos, self.index_name)
+        self.index = RepoIndex(self.klass, self.path_to_repos, index_path,
+                               layout=self.layout)
+
         if web_repos_path:
             self.web_repos_path = web_repos_path
         else:
             self.web_repos_path = os.path.join(self.path_to_repos, "web")
 
-
-        if self.web_repos_path and not os.path.exists(self.web_repos_path):
-            os.makedirs(self.web_repos_path)
+        if web_project_list_path:
+            self.web_projects = WebProjects(web_project_list_path,
+                                            self.web_list_format)
+        else:
+            self.web_projects = None
 
 
-        if not os.path.exists(self.path_to_repos):
-            os.makedirs(self.path_to_repos)
+    def _create_directories(self):
+        """
+        Directories are created on first use so that creating the manager
+        costs nothing when the command does not need it.
+        """
+        for path in (self.path_to_repos, self.web_repos_path):
+            if path and not os.path.exists(path):
+                os.makedirs(path)
 
 
     def create_repository(self, path, owner):
-        repo = self.klass(path, owner, create=True)
+        self._create_directories()
+        repo = self.open_repository(path, owner, create=True)
 
         for username, permission in self.default_permissions:
             repo.set_permissions(username, permission)
 
         repo.save()
+        self.layout.link(repo.name_on_fs)
+
+        if self.maintenance:
+            self.maintenance.create_directories()
+            repo.install_push_hook(self.maintenance.queue_path)
 
 
     def real_path(self, repo_name):
         """
         Return real path of the repository
         """
-        return os.path.join(self.path_to_repos,
-                            self.klass.prefix + repo_name + self.klass.suffix)
+        return self.layout.path(self.klass.prefix + repo_name +
+                                self.klass.suffix)
 
     def real_name(self, repo_name):
         """
@@ -87,13 +249,51 @@ class RepoManager(object):
         return os.path.basename(self.real_path(repo_name))
 
 
+    def open_repository(self, repo_path, username, create=False):
+        """
+        Returns the VCS object of the repository using the permission store
+        of the manager
+        """
+        return self.klass(repo_path, username, create=create, store=self.store,
+                          templates=self.templates)
+
     def get_repo_object(self, username, repo_name):
         if isinstance(repo_name, self.klass):
             return repo_name
-        return self.klass(self.real_path(repo_name), username)
+        return self.open_repository(self.real_path(repo_name), username)
+
+
+    def iter_repositories(self, owner=None, readable_by=None):
+        """
+        Yields read-only views of the repositories ordered by name. Only the
+        ones owned by owner or readable by readable_by if given.
+
+        The permission store is used after import_permission_store has been
+        run. Before that it would miss the existing repositories.
+        """
+        if self.store is not None and self.store.imported():
+            return self.store.iter_repositories(
+                self.layout, owner=owner, readable_by=readable_by,
+                permission_groups=self.klass.permission_groups)
+
+        repos = self.index.iter_repositories()
+        if owner is not None:
+            repos = (repo for repo in repos if repo.is_owner(owner))
+        if readable_by is not None:
+            repos = (repo for repo in repos
+                     if repo.has_permissions(readable_by, "r"))
+        return repos
+
+    def repositories(self, owner=None, readable_by=None):
+        """
+        Returns read-only views of the repositories as a list
+        """
+        return list(self.iter_repositories(owner=owner,
+                                           readable_by=readable_by))
 
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def fork(self, user, repo_name, fork_name):
         """
         Fork a reposotory
@@ -107,20 +307,22 @@ class RepoManager(object):
         if not repo.has_permissions(user.username, "r"):
             raise InvalidPermissions("You need read permissions for forking")
 
-        fork_path = os.path.join(self.path_to_repos, self.real_path(fork_name))
+        fork_path = self.real_path(fork_name)
 
         if os.path.exists(fork_path):
             raise InvalidRepository("Repository '%s' already exists."
                                      % repo_name)
 
-        shutil.copytree(repo.repo_path, fork_path)
+        self._create_directories()
+        repo.copy_files(fork_path)
 
 
-        repo = self.klass(fork_path, config.ADMIN)
+        repo = self.open_repository(fork_path, config.ADMIN)
         repo.reset_permissions_to(user.username)
         for username, permission in self.default_permissions:
             repo.set_permissions(username, permission)
         repo.save()
+        self.layout.link(repo.name_on_fs)
 
         subssh.writeln("\n\n Forked repository '%s' to '%s' \n"
                        % (repo_name, fork_name))
@@ -130,6 +332,7 @@ class RepoManager(object):
 
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def web_enable(self, user, repo_name, ):
         """
         Enable anonymous webview.
@@ -144,12 +347,15 @@ class RepoManager(object):
 
         webrepopath = os.path.join(self.web_repos_path, repo.name_on_fs)
 
+        self._create_directories()
         if not os.path.exists(webrepopath):
             os.symlink(repo.repo_path, webrepopath)
+        self._update_web_projects([repo])
 
 
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def web_disable(self, user, repo_name, ):
         """
         Enable anonymous webview.
@@ -161,6 +367,7 @@ class RepoManager(object):
 
         if os.path.exists(webrepopath):
             os.remove(webrepopath)
+        self._update_web_projects([repo])
 
 
 
@@ -170,47 +377,94 @@ class RepoManager(object):
         return os.path.exists(webpath)
 
 
+    def _web_project(self, repo):
+        return {"name": repo.name,
+                "path": os.path.join(self.web_repos_path, repo.name_on_fs),
+                "owner": format_list(repo.get_owners())}
+
+    def _update_web_projects(self, repos, removed=()):
+        """
+        Updates the web project list after changing the web status or the
+        owners of the repositories. removed are names on fs of the
+        repositories which are gone.
+        """
+        if self.web_projects is None:
+            return
+
+        if not self.web_projects.exists():
+            self._rebuild_web_projects()
+            return
+
+        changes = dict.fromkeys(removed)
+        for repo in repos:
+            if self.is_web_enabled(repo):
+                changes[repo.name_on_fs] = self._web_project(repo)
+            else:
+                changes[repo.name_on_fs] = None
+        self.web_projects.update(changes)
+
+    def _rebuild_web_projects(self):
+        """
+        Writes the web project list from the web directory
+        """
+        try:
+            enabled = set(os.listdir(self.web_repos_path))
+        except OSError:
+            enabled = set()
+        self.web_projects.rebuild(dict(
+            (repo.name_on_fs, self._web_project(repo))
+            for repo in self.iter_repositories()
+            if repo.name_on_fs in enabled))
+
+
 
     @subssh.exposable_as()
-    def ls(self, user, action=""):
+    @metrics.timed_command
+    def ls(self, user, *args):
         """
         List repositories.
 
-        usage: $cmd [mine]
+        Lists the repositories you can read or with mine the ones you own.
+        Names can be filtered by a prefix or a glob pattern. With --json
+        each repository is written as a JSON object on its own line.
+
+        usage: $cmd [mine] [--json] [--limit N] [--offset N] [prefix|pattern]
+
+        Eg. $cmd mine team-
+            $cmd --limit 20 --offset 40 '*-web'
         """
-        repos = []
+        options = parse_ls_arguments(args)
 
-        for repo_in_fs in os.listdir(self.path_to_repos):
-            try:
-                repo = self.klass(os.path.join(self.path_to_repos,
-                                               repo_in_fs),
-                                  config.ADMIN)
-            except InvalidRepository:
-                continue
+        # Written as they come so the first names appear right away
+        for repo in paginate(self.list_repositories(user, options), options):
+            if options["json"]:
+                subssh.writeln(json.dumps(repo_summary(repo), sort_keys=True))
             else:
-                repos.append(repo)
-
-        if action == "mine":
-            repos = [repo for repo in repos
-                     if repo.is_owner(user.username)]
-        elif not action:
-            repos = [repo for repo in repos
-                     if repo.has_permissions(user.username, 'r')]
-        elif action:
-            raise subssh.InvalidArguments("Unknown action '%s'" % action)
+                subssh.writeln(repo.name)
 
 
+    def list_repositories(self, user, options):
+        """
+        Yields the repositories ls shows to the user ordered by name.
+        options are from parse_ls_arguments.
+        """
+        if options["mine"]:
+            repos = self.iter_repositories(owner=user.username)
+        else:
+            repos = self.iter_repositories(readable_by=user.username)
 
+        if options["pattern"]:
+            matches = name_matcher(options["pattern"])
+            repos = (repo for repo in repos if matches(repo.name))
 
-        for repo in sorted(repos, lambda a, b: cmp(a.name, b.name)):
-            subssh.writeln(repo.name)
+        return repos
 
 
 
 
 
 
-    def viewable_urls(self, username, repo):
+    def viewable_urls(self, username, repo, web_enabled=None):
         viewable_urls = {}
 
         for name, url_tmp in self.urls.items():
@@ -223,7 +477,10 @@ class RepoManager(object):
 
                 del viewable_urls['rw']
 
-        if not self.is_web_enabled(repo):
+        if web_enabled is None:
+            web_enabled = self.is_web_enabled(repo)
+
+        if not web_enabled:
 
             if self.urls.has_key('anonymous_read'):
                 del viewable_urls['anonymous_read']
@@ -237,6 +494,7 @@ class RepoManager(object):
 
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def info(self, user, repo_name):
         """
         Show information about repository.
@@ -284,6 +542,159 @@ class RepoManager(object):
 
 
     @subssh.exposable_as()
+    @metrics.timed_command
+    def bulk_info(self, user, *selectors):
+        """
+        Show information about many repositories as JSON.
+
+        Writes owners, permissions, urls, web view status, size in bytes and
+        the time of the last push of each repository as a JSON object on its
+        own line. Selector can be a repository name, a glob pattern or
+        owner:<username>. Without selectors all repositories you can read
+        are shown.
+
+        usage: $cmd [repo name|pattern|owner:<username>]...
+
+        Eg. $cmd owner:bob 'team-*' myrepo
+        """
+        names = set()
+        patterns = []
+        owners = set()
+        for selector in selectors:
+            if selector.startswith("owner:"):
+                owners.add(selector[len("owner:"):])
+            elif any(c in selector for c in "*?["):
+                patterns.append(selector)
+            else:
+                names.add(selector)
+
+        def selected(repo):
+            if not selectors or repo.name in names:
+                return True
+            if any(fnmatch.fnmatchcase(repo.name, p) for p in patterns):
+                return True
+            return any(repo.is_owner(owner) for owner in owners)
+
+        repos = (repo for repo in
+                 self.iter_repositories(readable_by=user.username)
+                 if selected(repo))
+
+        # One listing instead of a stat per repository
+        try:
+            web_enabled = set(os.listdir(self.web_repos_path))
+        except OSError:
+            web_enabled = set()
+
+        found = set()
+        for repo, pushed, size in self.index.iter_usage(repos):
+            found.add(repo.name)
+            info = repo_summary(repo)
+            info.update({"web_enabled": repo.name_on_fs in web_enabled,
+                         "urls": self.viewable_urls(
+                             user.username, repo,
+                             web_enabled=repo.name_on_fs in web_enabled),
+                         "size": size,
+                         "last_push": pushed})
+            subssh.writeln(json.dumps(info, sort_keys=True))
+
+        for name in sorted(names - found):
+            subssh.writeln(json.dumps({"name": name,
+                                       "error": "No such repository"},
+                                      sort_keys=True))
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def maintenance_status(self, user, *repo_names):
+        """
+        Show maintenance status of repositories.
+
+        Shows the last maintenance run and whether the repository is waiting
+        for maintenance. Without repository names shows your repositories.
+
+        usage: $cmd [repo name]...
+        """
+        if not self.maintenance:
+            raise subssh.UserException("Maintenance is not enabled")
+
+        if repo_names:
+            repos = [self.get_repo_object(config.ADMIN, repo_name)
+                     for repo_name in repo_names]
+        else:
+            repos = self.repositories(owner=user.username)
+
+        for repo in sorted(repos, key=lambda repo: repo.name):
+            state = self.maintenance.state(repo.name_on_fs)
+            if self.maintenance.is_running(repo.name_on_fs):
+                status = "running"
+            elif state:
+                status = "%s, last run %s took %.1fs" % (
+                    state["result"],
+                    time.strftime("%Y-%m-%d %H:%M:%S",
+                                  time.localtime(state["finished"])),
+                    state["duration"])
+            else:
+                status = "never maintained"
+
+            queued = self.maintenance.queued_time(repo.name_on_fs)
+            if queued is not None:
+                status += ", queued since %s" % time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(queued))
+
+            subssh.writeln("%s: %s" % (repo.name, status))
+
+        queued = self.maintenance.queued()
+        subssh.writeln()
+        subssh.writeln("%d repositories in the maintenance queue"
+                       % len(queued))
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def top_usage(self, user, hours="24", order_by="cpu"):
+        """
+        Show the top resource consumers.
+
+        Sums the transport sessions of the last hours by user, repository and
+        command. Others than admin see only their own sessions and the
+        sessions on their repositories.
+
+        usage: $cmd [hours] [cpu|wall|bytes_in|bytes_out|sessions]
+        """
+        if not self.accounting_path:
+            raise subssh.UserException("Accounting is not enabled")
+        if order_by not in accounting.SUMMARY_FIELDS:
+            raise subssh.InvalidArguments("Unknown order '%s'" % order_by)
+        try:
+            since = time.time() - float(hours) * 3600
+        except ValueError:
+            raise subssh.InvalidArguments("Bad hours '%s'" % hours)
+
+        vcs = self.klass.__module__.rsplit(".", 1)[-1]
+        records = (record for record in
+                   accounting.read_records(self.accounting_path, since)
+                   if record["vcs"] == vcs)
+
+        if user.username != config.ADMIN:
+            owned = set(repo.name_on_fs for repo in
+                        self.repositories(owner=user.username))
+            records = (record for record in records
+                       if record["user"] == user.username
+                       or record["repo"] in owned)
+
+        subssh.writeln("%-16s %-24s %-18s %8s %10s %10s %12s %12s" % (
+            "user", "repository", "command", "sessions", "cpu s", "wall s",
+            "bytes in", "bytes out"))
+        for (username, repo, command), total in accounting.summarize(
+                records, order_by=order_by):
+            subssh.writeln("%-16s %-24s %-18s %8d %10.2f %10.2f %12d %12d" % (
+                username, repo or "-", command, total["sessions"],
+                total["cpu"], total["wall"], total["bytes_in"],
+                total["bytes_out"]))
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
     def delete(self, user, repo_name):
         """
         Delete repository.
@@ -291,9 +702,69 @@ class RepoManager(object):
         usage: $cmd <repo name>
         """
         repo = self.get_repo_object(user.username, repo_name)
-        repo.delete()
+
+        webrepopath = os.path.join(self.web_repos_path, repo.name_on_fs)
+        if os.path.lexists(webrepopath):
+            os.remove(webrepopath)
+
+        repo.delete(self.trash_path)
+        self.index.discard(repo.name_on_fs)
+        self.layout.unlink(repo.name_on_fs)
+        self._update_web_projects([], removed=[repo.name_on_fs])
+        if self.store is not None:
+            # The access record goes to the trash with the repository
+            self.store.delete(repo.name_on_fs)
+
+        if self.delete_grace_period:
+            subssh.writeln("Repository '%s' can be restored with undelete "
+                           "for %s" % (repo_name, format_duration(
+                               self.delete_grace_period)))
+        else:
+            reaper.spawn(self.trash_path, workers=self.reaper_workers,
+                         files_per_second=self.reaper_files_per_second)
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def undelete(self, user, repo_name):
+        """
+        Restore deleted repository.
+
+        Repositories can be restored until they are removed from the trash.
+
+        usage: $cmd <repo name>
+        """
+        repo_path = self.real_path(repo_name)
+        if os.path.exists(repo_path):
+            raise InvalidRepository("Repository '%s' already exists."
+                                     % repo_name)
+
+        name_on_fs = os.path.basename(repo_path)
+
+        for deleted, entry_path in sorted(reaper.trash_entries(self.trash_path),
+                                          reverse=True):
+            trashed_path = os.path.join(entry_path, name_on_fs)
+            if not os.path.exists(trashed_path):
+                continue
+
+            # Asserts that the user is owner of the deleted repository
+            self.klass(trashed_path, user.username)
+
+            if not os.path.exists(os.path.dirname(repo_path)):
+                os.makedirs(os.path.dirname(repo_path))
+            os.rename(trashed_path, repo_path)
+            os.rmdir(entry_path)
+            self.layout.link(name_on_fs)
+            if self.store is not None:
+                # Imports the access record back to the store
+                self.open_repository(repo_path, config.ADMIN).save()
+            subssh.writeln("Restored repository '%s'" % repo_name)
+            return
+
+        raise InvalidRepository("No deleted repository '%s' found" % repo_name)
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def add_owner(self, user, repo_name, username):
         """
         Add owner to repository.
@@ -301,11 +772,14 @@ class RepoManager(object):
         usage: $cmd <repo name> <username>
         """
         repo = self.get_repo_object(user.username, repo_name)
-        repo.add_owner(username)
-        repo.save()
+        with repo.locked():
+            repo.add_owner(username)
+            repo.save()
+        self._update_web_projects([repo])
 
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def remove_owner(self, user, repo_name, username):
         """
         Remove owner from repository.
@@ -313,12 +787,15 @@ class RepoManager(object):
         usage: $cmd <repo name> <username>
         """
         repo = self.get_repo_object(user.username, repo_name)
-        repo.remove_owner(username)
-        repo.save()
+        with repo.locked():
+            repo.remove_owner(username)
+            repo.save()
+        self._update_web_projects([repo])
 
 
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def rename(self, user, repo_name, new_name):
         """
         Rename repository.
@@ -326,10 +803,26 @@ class RepoManager(object):
         usage: $cmd <repo name> <new repo name>
         """
         repo = self.get_repo_object(user.username, repo_name)
-        repo.rename(new_name)
+        new_path = self.real_path(new_name)
+        if os.path.exists(new_path):
+            raise InvalidRepository("Repository '%s' already exists."
+                                     % new_name)
+
+        old_name_on_fs = repo.name_on_fs
+        repo.move_to(new_path)
+        self.layout.unlink(old_name_on_fs)
+        self.layout.link(repo.name_on_fs)
+
+        old_webrepopath = os.path.join(self.web_repos_path, old_name_on_fs)
+        if os.path.lexists(old_webrepopath):
+            os.remove(old_webrepopath)
+            os.symlink(repo.repo_path, os.path.join(self.web_repos_path,
+                                                    repo.name_on_fs))
+        self._update_web_projects([repo], removed=[old_name_on_fs])
 
 
     @subssh.exposable_as()
+    @metrics.timed_command
     def set_permissions(self, user, username, permissions, repo_name):
         """
         Set read/write permissions to repository.
@@ -340,21 +833,267 @@ class RepoManager(object):
 
         Eg. $cmd myfriend r myrepository
             $cmd myanotherfriend +w myrepository
+            $cmd @team rw myrepository
+
+        Permissions given to @group apply to all members of the group.
 
         Only owners can change permissions. Owners can also add and remove
         other owners.
 
         """
         repo = self.get_repo_object(user.username, repo_name)
-        repo.set_permissions(username, permissions)
-        if not repo.has_permissions('*', 'r') and self.is_web_enabled(repo):
-            self.web_disable(user, repo_name)
-            subssh.errln("Note: Web view disabled")
-        repo.save()
+        with repo.locked():
+            repo.set_permissions(username, permissions)
+            if (not repo.has_permissions('*', 'r')
+                and self.is_web_enabled(repo)):
+                self.web_disable(user, repo_name)
+                subssh.errln("Note: Web view disabled")
+            repo.save()
+        self._update_web_projects([repo])
 
 
+    def select_repositories(self, user, selectors):
+        """
+        Returns names of the repositories matching the selectors.
+
+        Selector can be a repository name, a glob pattern or
+        owner:<username>. Patterns match only repositories the user can
+        manage.
+        """
+        names = set()
+        if user.username == config.ADMIN:
+            manageable = self.repositories()
+        else:
+            manageable = self.repositories(owner=user.username)
+
+        for selector in selectors:
+            if selector.startswith("owner:"):
+                owner = selector[len("owner:"):]
+                names.update(repo.name for repo in manageable
+                             if repo.is_owner(owner))
+            elif any(c in selector for c in "*?["):
+                names.update(repo.name for repo in manageable
+                             if fnmatch.fnmatchcase(repo.name, selector))
+            else:
+                names.add(selector)
+
+        return sorted(names)
+
+
+    def apply_to_repositories(self, user, repo_names, operation):
+        """
+        Calls operation(repo) for each repository and saves it once while
+        holding the repository lock. Repositories are handled concurrently
+        in a pool of bulk_workers threads.
+
+        Returns a list of (repo name, error message or None) tuples.
+        """
+        changed = []
+
+        def apply(repo_name):
+            try:
+                repo = self.get_repo_object(user.username, repo_name)
+                with repo.locked():
+                    operation(repo)
+                    repo.save()
+            except (subssh.UserException, EnvironmentError), e:
+                return repo_name, str(e)
+            changed.append(repo)
+            return repo_name, None
+
+        results = self._map_concurrently(apply, repo_names)
+        # Once for all repositories
+        self._update_web_projects(changed)
+        return results
+
+    def _map_concurrently(self, function, items):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.bulk_workers)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def _report_bulk(self, results):
+        failed = 0
+        for repo_name, error in results:
+            if error:
+                failed += 1
+                subssh.writeln("%s: FAILED %s" % (repo_name, error))
+            else:
+                subssh.writeln("%s: ok" % repo_name)
+
+        subssh.writeln()
+        subssh.writeln("%d repositories, %d failed" % (len(results), failed))
+        if failed:
+            return 1
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def migrate_access_records(self, user):
+        """
+        Convert permissions of old repositories to access records.
+
+        Writes the access record of every repository which does not have
+        one yet. Only admin can run this.
+
+        usage: $cmd
+        """
+        if user.username != config.ADMIN:
+            raise InvalidPermissions("Only %s can migrate repositories"
+                                     % config.ADMIN)
+
+        names = [repo.name for repo in self.index.repositories()
+                 if not os.path.exists(os.path.join(
+                     repo.repo_path, self.klass.access_record_name))]
+
+        # apply_to_repositories saves them
+        return self._report_bulk(self.apply_to_repositories(
+            user, names, lambda repo: None))
+
 
     @subssh.exposable_as()
+    @metrics.timed_command
+    def import_permission_store(self, user):
+        """
+        Import permissions of repositories to the permission store.
+
+        Imports every repository missing from the store. Run this once after
+        enabling the store. Only admin can run this.
+
+        usage: $cmd
+        """
+        if user.username != config.ADMIN:
+            raise InvalidPermissions("Only %s can import repositories"
+                                     % config.ADMIN)
+        if self.store is None:
+            raise subssh.UserException("Permission store is not enabled")
+
+        names = [repo.name for repo in self.index.repositories()
+                 if repo.name_on_fs not in self.store]
+
+        # apply_to_repositories saves them to the store
+        results = self.apply_to_repositories(user, names, lambda repo: None)
+        if not [error for name, error in results if error]:
+            self.store.mark_imported()
+        return self._report_bulk(results)
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def rebuild_web_project_list(self, user):
+        """
+        Rebuild the project list of the web frontends.
+
+        The list is kept up to date by the other commands. Use this after
+        changing the web directory by hand. Only admin can run this.
+
+        usage: $cmd
+        """
+        if user.username != config.ADMIN:
+            raise InvalidPermissions("Only %s can rebuild the project list"
+                                     % config.ADMIN)
+        if self.web_projects is None:
+            raise subssh.UserException("Web project list is not enabled")
+
+        self._rebuild_web_projects()
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def shard_repositories(self, user):
+        """
+        Move repositories to the sharded directory layout.
+
+        Moves every repository still in the flat layout to its shard. The
+        repositories stay usable during the move. Only admin can run this.
+
+        usage: $cmd
+        """
+        if user.username != config.ADMIN:
+            raise InvalidPermissions("Only %s can move repositories"
+                                     % config.ADMIN)
+        if not self.layout.sharded:
+            raise subssh.UserException("Sharded layout is not enabled")
+
+        names = [repo.name for repo in self.index.repositories()
+                 if os.path.dirname(repo.repo_path) == self.path_to_repos]
+
+        def operation(repo):
+            self.layout.move_to_shard(repo)
+            webrepopath = os.path.join(self.web_repos_path, repo.name_on_fs)
+            if os.path.islink(webrepopath):
+                os.remove(webrepopath)
+                os.symlink(repo.repo_path, webrepopath)
+
+        return self._report_bulk(self.apply_to_repositories(
+            user, names, operation))
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def bulk_set_permissions(self, user, username, permissions, *selectors):
+        """
+        Set read/write permissions to many repositories.
+
+        usage: $cmd <username> <+/-permissions> <repo name|pattern|owner:<username>>...
+
+        Eg. $cmd newguy +r 'team-*'
+            $cmd leaver -rw owner:myself
+        """
+        if not selectors:
+            raise subssh.InvalidArguments("Repositories are missing")
+
+        def operation(repo):
+            repo.set_permissions(username, permissions)
+            if not repo.has_permissions('*', 'r'):
+                webrepopath = os.path.join(self.web_repos_path,
+                                           repo.name_on_fs)
+                if os.path.lexists(webrepopath):
+                    os.remove(webrepopath)
+
+        return self._report_bulk(self.apply_to_repositories(
+            user, self.select_repositories(user, selectors), operation))
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def bulk_add_owner(self, user, username, *selectors):
+        """
+        Add owner to many repositories.
+
+        usage: $cmd <username> <repo name|pattern|owner:<username>>...
+        """
+        if not selectors:
+            raise subssh.InvalidArguments("Repositories are missing")
+
+        return self._report_bulk(self.apply_to_repositories(
+            user, self.select_repositories(user, selectors),
+            lambda repo: repo.add_owner(username)))
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def bulk_remove_owner(self, user, username, *selectors):
+        """
+        Remove owner from many repositories.
+
+        usage: $cmd <username> <repo name|pattern|owner:<username>>...
+        """
+        if not selectors:
+            raise subssh.InvalidArguments("Repositories are missing")
+
+        return self._report_bulk(self.apply_to_repositories(
+            user, self.select_repositories(user, selectors),
+            lambda repo: repo.remove_owner(username)))
+
+
+
+    @subssh.exposable_as()
+    @metrics.timed_command
     def init(self, user, repo_name):
         """
         Create new repository.
@@ -362,7 +1101,7 @@ class RepoManager(object):
         usage: $cmd <repository name>
         """
 
-        if not subssh.safe_chars_only_pat.match(repo_name):
+        if not valid_repo_name(repo_name):
             subssh.errln("Bad repository name. Allowed characters: %s (regexp)"
                         % subssh.safe_chars)
             return 1
@@ -376,6 +1115,41 @@ class RepoManager(object):
         self.info(user, repo_name)
 
 
+    @subssh.exposable_as()
+    @metrics.timed_command
+    def bulk_init(self, user, *repo_names):
+        """
+        Create many repositories.
+
+        Names are read from the standard input one per line if not given
+        as arguments. Empty lines and lines starting with # are skipped.
+
+        usage: $cmd [repo name]...
+
+        Eg. $cmd < manifest.txt
+        """
+        if not repo_names:
+            repo_names = [line.strip() for line in sys.stdin]
+        repo_names = sorted(set(name for name in repo_names
+                                if name and not name.startswith("#")))
+
+        def create(repo_name):
+            if not valid_repo_name(repo_name):
+                return repo_name, "Bad repository name"
+            try:
+                self.create_repository(self.real_path(repo_name),
+                                       user.username)
+            except (subssh.UserException, EnvironmentError), e:
+                return repo_name, str(e)
+            return repo_name, None
+
+        # Here once instead of racing in the workers
+        self._create_directories()
+        if self.maintenance:
+            self.maintenance.create_directories()
+        return self._report_bulk(self._map_concurrently(create, repo_names))
+
+
     def copy_common_hooks(self, user, repo_name):
         """
         (re)Copies shared hooks to the repository
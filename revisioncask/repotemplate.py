@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+Pre-built empty repositories.
+
+Creating a repository runs the VCS binaries several times. The first
+repository created with a VCS version is stored as a template and the
+following ones are copied from it. Templates are keyed by
+VCS.template_key() so that they are rebuilt when the VCS is upgraded.
+"""
+
+import os
+import errno
+import shutil
+import hashlib
+import tempfile
+
+from fstools import copytree_linked
+
+
+def which(program):
+    """
+    Returns the path of the program found from PATH or None
+    """
+    if os.sep in program:
+        return program
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def binary_stamp(program):
+    """
+    Returns a string changing when the program is replaced, eg. upgraded.
+    Cheaper than asking the version from the program itself.
+    """
+    path = which(program)
+    if path is None:
+        return "%s:missing" % program
+    st = os.stat(path)
+    return "%s:%d:%d" % (path, st.st_size, st.st_mtime)
+
+
+class RepoTemplates(object):
+
+    def __init__(self, templates_path):
+        self.templates_path = templates_path
+
+    def _prefix(self, klass):
+        return klass.__name__.lower() + "-"
+
+    def template_path(self, klass):
+        key = hashlib.sha1(klass.template_key()).hexdigest()[:12]
+        return os.path.join(self.templates_path, self._prefix(klass) + key)
+
+    def copy_to(self, repo):
+        """
+        Copies the template to the empty directory of the new repository.
+        Returns False if there is no template for the current VCS version.
+        """
+        template = self.template_path(repo.__class__)
+        if not os.path.isdir(template):
+            return False
+
+        # copytree_linked creates the target itself
+        os.rmdir(repo.repo_path)
+        try:
+            copytree_linked(template, repo.repo_path, repo._is_immutable)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Pruned while copying by an upgraded revisioncask
+            shutil.rmtree(repo.repo_path, ignore_errors=True)
+            os.makedirs(repo.repo_path)
+            return False
+        return True
+
+    def save(self, repo):
+        """
+        Stores the freshly created repository as the template of its VCS and
+        removes the templates of the other versions
+        """
+        template = self.template_path(repo.__class__)
+        if os.path.exists(template):
+            return
+
+        if not os.path.exists(self.templates_path):
+            try:
+                os.makedirs(self.templates_path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Built next to the template and renamed so that it's never seen
+        # half written
+        tmp = tempfile.mkdtemp(prefix=".", dir=self.templates_path)
+        try:
+            copytree_linked(repo.repo_path, os.path.join(tmp, "template"))
+            try:
+                os.rename(os.path.join(tmp, "template"), template)
+            except OSError, e:
+                # Other process saved it first
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        prefix = self._prefix(repo.__class__)
+        for name in os.listdir(self.templates_path):
+            path = os.path.join(self.templates_path, name)
+            if name.startswith(prefix) and path != template:
+                shutil.rmtree(path, ignore_errors=True)
@@ -20,12 +20,20 @@ License along with Subssh.  If not, see
 """
 
 import os
+import uuid
+from StringIO import StringIO
 from ConfigParser import SafeConfigParser
 
 import subssh
 from abstractrepo import VCS
-from abstractrepo import vcs_init
+from abstractrepo import lazy_setting
 from repomanager import RepoManager
+import metrics
+import groups
+import accounting
+from fstools import atomic_write
+from repotemplate import binary_stamp
+from maintenance import install_hook_script
 
 
 class config:
@@ -35,10 +43,13 @@ class config:
 
     SVNADMIN_BIN = "svnadmin"
 
-    REPOSITORIES = os.path.join(subssh.config.SUBSSH_HOME, "vcs", "svn", "repos")
-    HOOKS_DIR = os.path.join(subssh.config.SUBSSH_HOME, "vcs", "svn", "hooks")
+    REPOSITORIES = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                     "vcs", "svn", "repos"))
+    HOOKS_DIR = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                  "vcs", "svn", "hooks"))
 
-    WEB_DIR = os.path.join( os.environ["HOME"], "repos", "websvn" )
+    WEB_DIR = lazy_setting(lambda: os.path.join(os.environ["HOME"],
+                                                "repos", "websvn"))
 
     URL_RW =  "svn+ssh://$hostusername@$hostname/$name_on_fs"
     URL_WEB_VIEW =  "http://$hostname/websvn/listing.php?repname=$name_on_fs"
@@ -48,9 +59,76 @@ class config:
 
     MANAGER_TOOLS = "true"
 
+    # Queue pushed repositories for maintenance run by
+    # "python -m revisioncask.maintenance"
+    MAINTENANCE = "false"
+    MAINTENANCE_DIR = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "svn", "maintenance"))
+    MAINTENANCE_WORKERS = "1"
+    # Minimum seconds between maintenance runs of a repository
+    MAINTENANCE_INTERVAL = "3600"
+
+    # Write latency histograms to METRICS_DIR. Exported in Prometheus format
+    # with "python -m revisioncask.metrics <METRICS_DIR>"
+    METRICS = "false"
+    METRICS_DIR = lazy_setting(lambda: os.path.join(subssh.config.SUBSSH_HOME,
+                                                    "metrics"))
+
+    # Record bytes, wall time and CPU of the transport sessions to
+    # ACCOUNTING_DIR. The transport process is run with relayed stdio.
+    ACCOUNTING = "false"
+    ACCOUNTING_DIR = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "accounting"))
+
+    # Keep owners and permissions in a SQLite database instead of reading
+    # them from the repositories. Run import_permission_store after enabling.
+    PERMISSION_STORE = "false"
+    PERMISSION_STORE_PATH = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "svn", "permissions.sqlite"))
+
+    # Allow giving permissions to the groups of PERMISSION_GROUPS_FILE with
+    # '@group'. The file is shared by all VCSs.
+    PERMISSION_GROUPS = "false"
+    PERMISSION_GROUPS_FILE = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "permission_groups"))
+
+    # Spread the repositories to hashed subdirectories. Existing
+    # repositories are moved with shard_repositories.
+    SHARDED_LAYOUT = "false"
+
+    # Copy new repositories from a pre-built empty repository instead of
+    # running the VCS. The template is rebuilt when the VCS is upgraded.
+    REPOSITORY_TEMPLATES = "false"
+
+    # Keep the WebSVN list of the web enabled repositories in
+    # WEB_PROJECT_LIST_PATH so that it does not need to scan WEB_DIR
+    WEB_PROJECT_LIST = "false"
+    WEB_PROJECT_LIST_PATH = lazy_setting(lambda: os.path.join(
+        subssh.config.SUBSSH_HOME, "vcs", "svn", "websvn_repositories.php"))
+
+    # Seconds deleted repositories can be restored with undelete. With a
+    # grace period nothing is removed unless a cron job runs
+    # "python -m revisioncask.reaper --grace <seconds> <REPOSITORIES>/.trash"
+    DELETE_GRACE_PERIOD = "0"
+    REAPER_WORKERS = "1"
+    # Maximum number of files removed per second. 0 is unlimited.
+    REAPER_FILES_PER_SECOND = "1000"
+
 class Subversion(VCS):
     required_by_valid_repo = ("conf/svnserve.conf",)
+    # FSFS revision files are written once. Revision properties can change
+    # so they are copied.
+    immutable_dirs = ("db/revs",)
+
+    # Holds the youngest revision. Packing changes the revision directories.
+    push_markers = ("db/current",)
+    size_markers = ("db/revs", "db/revprops")
+
+    lock_filename = "locks/subssh.lock"
+    access_record_name = "conf/" + VCS.access_record_name
+    # The permdb is the authz-db of svnserve
     permdb_name= "conf/" + VCS.permdb_name
+    legacy_files = (VCS.owner_filename,)
     # For svnserve, "/" stands for whole repository
     _permissions_section = "/"
 
@@ -65,30 +143,106 @@ class Subversion(VCS):
         subssh.check_call((config.SVNADMIN_BIN, "create", path))
         subssh.check_call((
                           config.SVN_BIN, "-m", "automatically created project base",
+                          "--username", self.requester,
                           "mkdir", "file://%s" % os.path.join(path, "trunk"),
                                    "file://%s" % os.path.join(path, "tags"),
                                    "file://%s" % os.path.join(path, "branches"),
                           ))
 
-
-
-    def _enable_svn_perm(self):
+    @classmethod
+    def template_key(cls):
+        return "%s %s" % (binary_stamp(config.SVNADMIN_BIN),
+                          binary_stamp(config.SVN_BIN))
+
+    def _fix_template_copy(self):
+        # Clients use the UUID to tell repositories apart. Newer formats
+        # have also an instance ID on the second line.
+        uuid_path = os.path.join(self.repo_path, "db", "uuid")
+        lines = open(uuid_path).read().splitlines()
+        atomic_write(uuid_path, "".join(str(uuid.uuid4()) + "\n"
+                                        for line in lines))
+
+        # The project base was committed by the creator of the template
+        from datetime import datetime
+        self._set_revprop(1, "svn:author", self.requester)
+        self._set_revprop(1, "svn:date",
+                          datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+
+    def _set_revprop(self, revision, name, value):
+        import tempfile
+        f = tempfile.NamedTemporaryFile(prefix="revprop")
+        try:
+            f.write(value)
+            f.flush()
+            subssh.check_call((config.SVNADMIN_BIN, "setrevprop",
+                               self.repo_path, "-r", str(revision), name,
+                               f.name))
+        finally:
+            f.close()
+
+
+
+    def write_native_access(self):
+        lines = ["[%s]" % self._permissions_section]
+        for username, permissions in self.get_all_permissions():
+            if (groups.is_group(username) and
+                not groups.exists(self.permission_groups, username)):
+                # svnserve refuses authz files with undefined groups. Left
+                # from the time the group existed or groups were enabled.
+                continue
+            lines.append("%s = %s" % (username, permissions))
+        atomic_write(self.permdb_filepath, "\n".join(lines) + "\n")
+
+        # svnserve reads the shared group file itself
+        self._enable_svn_perm(groups_only=True)
+
+    def _enable_svn_perm(self, groups_only=False):
         """
-        Set Subversion repository to use our permission config file
+        Set Subversion repository to use our permission config file.
+
+        With groups_only the config is written only if the group file
+        setting has changed.
         """
         confpath = os.path.join(self.repo_path, "conf/svnserve.conf")
         conf = SafeConfigParser()
         conf.read(confpath)
+
+        groups_db = None
+        if self.permission_groups is not None:
+            groups_db = self.permission_groups.path
+        current = None
+        if conf.has_option("general", "groups-db"):
+            current = conf.get("general", "groups-db")
+        if groups_only and groups_db == current:
+            return
+
         conf.set("general", "authz-db", self.permdb_name)
-        f = open(confpath, "w")
+        if groups_db is not None:
+            conf.set("general", "groups-db", groups_db)
+        else:
+            conf.remove_option("general", "groups-db")
+        f = StringIO()
         conf.write(f)
-        f.close()
+        atomic_write(confpath, f.getvalue())
+
+
+    def install_push_hook(self, queue_path):
+        # Repository path is the first argument of the post-commit hook
+        hook = os.path.join(self.repo_path, "hooks", "post-commit")
+        install_hook_script(hook, queue_path, '"$1"')
+
+    def maintenance_commands(self, upgrade_storage=False):
+        return ((config.SVNADMIN_BIN, "pack", "-q", self.repo_path),)
 
 
 class SubversionManager(RepoManager):
 
     klass = Subversion
 
+    flat_links = True
+
+    web_list_format = "websvn"
+
 
 
 
@@ -106,32 +260,82 @@ class SubversionManager(RepoManager):
 
 @subssh.no_interactive
 @subssh.expose_as("svnserve")
+@metrics.timed_transport
 def handle_svn(user, *args):
+    metrics.enable_from(config)
 
     # Subversion can handle itself permissions and virtual root.
     # So there's no need to manually check permissions here or
-    # transform the virtual root.
-    return subssh.call((config.SVNSERVE_BIN,
-                            '--tunnel-user=' + user.username,
-                            '-t', '-r',
-                            repos_path_with_svn_prefix))
-
-
-
-
-
+    # transform the virtual root. In the sharded layout the repositories are
+    # found through their symlinks in the flat locations.
+    argv = (config.SVNSERVE_BIN,
+            '--tunnel-user=' + user.username,
+            '-t', '-r',
+            config.REPOSITORIES)
+
+    # svnserve picks the repository from the protocol, so it is not known
+    # here
+    session = accounting.session(config, "svn", user.username, None,
+                                 user.cmd)
+    with metrics.timer(metrics.PHASE, phase="svnserve_process"):
+        if session is not None:
+            return session.call(argv)
+        return subssh.call(argv)
+
+
+
+
+
+
+
+def create_manager(**overrides):
+    """
+    Returns SubversionManager set up from the config. Keyword arguments
+    override the arguments taken from the config.
+    """
+    options = dict(repos_path=config.REPOSITORIES,
+                   web_repos_path=config.WEB_DIR,
+                   urls={'rw': config.URL_RW,
+                         'webview': config.URL_WEB_VIEW},
+                   delete_grace_period=int(
+                       config.DELETE_GRACE_PERIOD),
+                   reaper_workers=int(config.REAPER_WORKERS),
+                   reaper_files_per_second=int(
+                       config.REAPER_FILES_PER_SECOND),
+                   maintenance_path=(
+                       config.MAINTENANCE_DIR if
+                       subssh.to_bool(config.MAINTENANCE)
+                       else None),
+                   accounting_path=(
+                       config.ACCOUNTING_DIR if
+                       subssh.to_bool(config.ACCOUNTING)
+                       else None),
+                   permission_store_path=(
+                       config.PERMISSION_STORE_PATH if
+                       subssh.to_bool(config.PERMISSION_STORE)
+                       else None),
+                   sharded=subssh.to_bool(config.SHARDED_LAYOUT),
+                   templates=subssh.to_bool(
+                       config.REPOSITORY_TEMPLATES),
+                   web_project_list_path=(
+                       config.WEB_PROJECT_LIST_PATH if
+                       subssh.to_bool(config.WEB_PROJECT_LIST)
+                       else None),
+                   )
+    options.update(overrides)
+    return SubversionManager(**options)
+
+
+def configure():
+    """
+    Enables the settings of the config used also by the transport commands
+    """
+    metrics.enable_from(config)
+    groups.enable_from(config, Subversion)
 
 
 def appinit():
-
-    vcs_init(config)
+    configure()
 
     if subssh.to_bool(config.MANAGER_TOOLS):
-        manager = SubversionManager(config.REPOSITORIES,
-                                    web_repos_path=config.WEB_DIR,
-                                    urls={'rw': config.URL_RW,
-                                          'webview': config.URL_WEB_VIEW},
-                                     )
-
-        subssh.expose_instance(manager, prefix="svn-")
-
+        subssh.expose_instance(create_manager(), prefix="svn-")
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+
+Commands listing the repositories of all VCSs at once.
+
+The managers of the VCSs are queried concurrently in a thread pool, so the
+latency is that of the slowest VCS instead of the sum of them. Enable by
+adding revisioncask.unified to the subssh apps.
+"""
+
+import json
+import heapq
+import itertools
+
+import subssh
+from subssh import config as subssh_config
+
+import plugins
+import metrics
+from abstractrepo import InvalidRepository
+from repomanager import parse_ls_arguments, paginate, repo_summary
+
+
+class config:
+    # Comma separated list of the VCSs included in the unified commands
+    VCS = "git,hg,svn"
+
+
+def enabled_vcs():
+    return [vcs.strip() for vcs in config.VCS.split(",") if vcs.strip()]
+
+
+def query_managers(function, vcs_list=None):
+    """
+    Calls function(manager) with the manager of each VCS concurrently.
+    Returns a list of (vcs, result, error message or None) tuples in the
+    order of the VCSs.
+    """
+    if vcs_list is None:
+        vcs_list = enabled_vcs()
+
+    def query(vcs):
+        try:
+            return vcs, function(plugins.get_manager(vcs)), None
+        except (subssh.UserException, EnvironmentError, ImportError), e:
+            return vcs, None, str(e)
+
+    if len(vcs_list) < 2:
+        return [query(vcs) for vcs in vcs_list]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(len(vcs_list))
+    try:
+        return pool.map(query, vcs_list)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@subssh.expose_as("ls")
+@metrics.timed(metrics.COMMAND, command="ls")
+def ls(user, *args):
+    """
+    List repositories of all version control systems.
+
+    Takes the same options as the ls of each VCS. Repositories are prefixed
+    with their VCS.
+
+    usage: $cmd [mine] [--json] [--limit N] [--offset N] [prefix|pattern]
+    """
+    options = parse_ls_arguments(args)
+
+    stop = None
+    if options["limit"] is not None:
+        stop = options["offset"] + options["limit"]
+
+    def collect(manager):
+        # No VCS can contribute more than the last page needs
+        return list(itertools.islice(manager.list_repositories(user, options),
+                                     stop))
+
+    lists = []
+    for vcs, repos, error in query_managers(collect):
+        if error:
+            subssh.errln("%s: %s" % (vcs, error))
+            continue
+        lists.append([(repo.name, vcs, repo) for repo in repos])
+
+    merged = ((vcs, repo) for name, vcs, repo in heapq.merge(*lists))
+    for vcs, repo in paginate(merged, options):
+        if options["json"]:
+            summary = repo_summary(repo)
+            summary["vcs"] = vcs
+            subssh.writeln(json.dumps(summary, sort_keys=True))
+        else:
+            subssh.writeln("%s/%s" % (vcs, repo.name))
+
+
+@subssh.expose_as("info")
+@metrics.timed(metrics.COMMAND, command="info")
+def info(user, repo_name):
+    """
+    Show information about repository of any version control system.
+
+    Shows all repositories with the name. Prefix the name with the VCS to
+    show only one, eg. git/myrepo.
+
+    usage: $cmd [vcs/]<repo name>
+    """
+    vcs_list = None
+    if "/" in repo_name:
+        vcs, repo_name = repo_name.split("/", 1)
+        if vcs not in enabled_vcs():
+            raise subssh.InvalidArguments("Unknown VCS '%s'" % vcs)
+        vcs_list = [vcs]
+
+    def load(manager):
+        try:
+            return manager.get_repo_object(subssh_config.ADMIN, repo_name)
+        except InvalidRepository:
+            return None
+
+    found = 0
+    for vcs, repo, error in query_managers(load, vcs_list):
+        if error:
+            subssh.errln("%s: %s" % (vcs, error))
+        if repo is None:
+            continue
+        found += 1
+        subssh.writeln("%s/%s" % (vcs, repo.name))
+        plugins.get_manager(vcs).info(user, repo)
+
+    if not found:
+        raise InvalidRepository("Repository '%s' does not exists!"
+                                % repo_name)
+
+
+def appinit():
+    """
+    The commands are exposed by the decorators when the module is imported
+    """
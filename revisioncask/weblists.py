@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+Project lists of the web enabled repositories for the web frontends.
+
+The list is updated when repositories are web enabled, disabled, renamed,
+deleted or their owners change, so that the frontends do not need to scan
+the web directory on every page view. The entries are kept in a JSON file
+next to the list and the list is rendered from it in the format of the
+frontend:
+
+    gitweb  $projects_list file
+    hgweb   [paths] section of the hgweb config
+    websvn  PHP file included from the WebSVN config.php
+"""
+
+import os
+import json
+import urllib
+
+from fstools import atomic_write, file_lock
+
+
+def render_gitweb(projects):
+    # Paths relative to $projectroot, which is the web directory
+    return "".join("%s %s\n" % (urllib.quote_plus(name_on_fs),
+                                urllib.quote_plus(project["owner"]))
+                   for name_on_fs, project in sorted(projects.items()))
+
+
+def render_hgweb(projects):
+    lines = ["[paths]"]
+    for name_on_fs, project in sorted(projects.items()):
+        lines.append("%s = %s" % (project["name"], project["path"]))
+    return "\n".join(lines) + "\n"
+
+
+def php_string(s):
+    return "'%s'" % s.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def render_websvn(projects):
+    lines = ["<?php"]
+    for name_on_fs, project in sorted(projects.items()):
+        lines.append("$config->addRepository(%s, %s);" % (
+            php_string(project["name"]),
+            php_string("file://" + project["path"])))
+    return "\n".join(lines) + "\n"
+
+
+RENDERERS = { "gitweb": render_gitweb,
+              "hgweb":  render_hgweb,
+              "websvn": render_websvn }
+
+
+class WebProjects(object):
+
+    def __init__(self, list_path, list_format):
+        self.list_path = list_path
+        self.render = RENDERERS[list_format]
+        directory, filename = os.path.split(list_path)
+        self.state_path = os.path.join(directory, "." + filename + ".json")
+        self.lock_path = os.path.join(directory, "." + filename + ".lock")
+
+    def exists(self):
+        return os.path.exists(self.state_path)
+
+    def _write(self, projects):
+        atomic_write(self.state_path, json.dumps(projects, sort_keys=True))
+        atomic_write(self.list_path, self.render(projects))
+
+    def _locked(self):
+        directory = os.path.dirname(self.list_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        return file_lock(self.lock_path)
+
+    def rebuild(self, projects):
+        """
+        Replaces all entries. projects is a dict of name on fs to project
+        dict with name, path and owner keys.
+        """
+        with self._locked():
+            self._write(projects)
+
+    def update(self, changes):
+        """
+        Updates the entries of changes dict. Entries with None are removed.
+        """
+        with self._locked():
+            f = open(self.state_path)
+            try:
+                projects = json.load(f)
+            finally:
+                f.close()
+
+            updated = dict(projects)
+            for name_on_fs, project in changes.items():
+                if project is None:
+                    updated.pop(name_on_fs, None)
+                else:
+                    updated[name_on_fs] = project
+
+            if updated != projects:
+                self._write(updated)
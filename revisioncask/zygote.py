@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (C) 2010 Esa-Matti Suuronen <esa-matti@suuronen.org>
+
+This file is part of subssh.
+
+Subssh is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of
+the License, or (at your option) any later version.
+
+Subssh is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with Subssh.  If not, see
+<http://www.gnu.org/licenses/>.
+
+Resident server for the transport commands.
+
+The server imports subssh and the VCS modules once and applies the app
+sections of the subssh config file given to it. The ssh forced command
+is replaced by a small client which passes its stdin, stdout and stderr to
+the server over a Unix socket. The server forks a worker which runs the
+command on those file descriptors and sends the exit code back.
+
+Commands the server does not handle are run by the fallback command given
+to the client, eg. the normal subssh entry point.
+
+Keep the imports of this module light. The client is run on every
+connection.
+"""
+
+import os
+import sys
+import json
+import errno
+import socket
+from _multiprocessing import sendfd, recvfd
+
+
+USAGE = """usage: python -m revisioncask.zygote serve <socket> [subssh config]
+       python -m revisioncask.zygote client <socket> <username> [fallback command...]
+"""
+
+# Exit code telling the client that the command must be run by the fallback
+NOT_HANDLED = 254
+
+# Environment passed from the client to the worker
+PASSED_ENV = ("SSH_CONNECTION", "SSH_CLIENT", "SSH_ORIGINAL_COMMAND",
+              "GIT_PROTOCOL")
+
+
+class ZygoteUser(object):
+    """
+    User making the request in a worker
+    """
+
+    def __init__(self, username, cmd):
+        self.username = username
+        self.cmd = cmd
+
+
+def prewarm(config_path=None):
+    """
+    Imports everything needed by the transport commands and applies the
+    subssh config file to them. Workers inherit the result.
+    """
+    import subssh
+    from revisioncask import plugins
+    for vcs in plugins.VCS_MODULES:
+        plugins.load_module(vcs)
+    if config_path:
+        plugins.load_config(config_path)
+    for vcs in plugins.VCS_MODULES:
+        plugins.load_module(vcs).configure()
+    try:
+        import mercurial.dispatch
+    except ImportError:
+        pass
+
+
+def run_command(username, command):
+    """
+    Runs transport command in the worker. Returns the exit code.
+    """
+    import shlex
+    import subssh
+    from revisioncask import plugins
+
+    args = shlex.split(command)
+    if not args:
+        return NOT_HANDLED
+    cmd, args = args[0], args[1:]
+
+    handler = plugins.load_handler(cmd)
+    if handler is None:
+        return NOT_HANDLED
+
+    try:
+        return handler(ZygoteUser(username, cmd), *args) or 0
+    except subssh.UserException, e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+
+
+def _worker(conn):
+    import signal
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    # File descriptors are sent before the request so that buffered reading
+    # cannot swallow the bytes carrying them.
+    fds = [recvfd(conn.fileno()) for _ in range(3)]
+    request = json.loads(conn.makefile("r").readline())
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    os.environ.update(request["env"])
+
+    # The worker must live to report the exit code
+    from revisioncask import git
+    git.config.EXEC_TRANSPORT = "false"
+
+    code = 1
+    try:
+        try:
+            code = run_command(request["username"], request["command"])
+        except Exception:
+            import traceback
+            traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # os._exit skips the atexit handlers
+        from revisioncask import metrics, accounting
+        metrics.flush()
+        accounting.flush()
+        try:
+            conn.sendall("%d\n" % code)
+        except socket.error:
+            pass
+        os._exit(code)
+
+
+def serve(socket_path, config_path=None):
+    import signal
+
+    prewarm(config_path)
+
+    # Workers are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(128)
+
+    while True:
+        try:
+            conn, _ = server.accept()
+        except socket.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if os.fork() == 0:
+            server.close()
+            _worker(conn)
+        conn.close()
+
+
+def client(socket_path, username, fallback=()):
+    """
+    Passes the connection to the server. Runs fallback command if the server
+    is not running or it does not handle the command.
+    """
+    command = os.environ.get("SSH_ORIGINAL_COMMAND", "")
+
+    code = NOT_HANDLED
+    if command:
+        try:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(socket_path)
+        except socket.error:
+            pass
+        else:
+            for fd in (0, 1, 2):
+                sendfd(conn.fileno(), fd)
+
+            env = dict((key, os.environ[key]) for key in PASSED_ENV
+                       if key in os.environ)
+            conn.sendall(json.dumps({"username": username,
+                                     "command": command,
+                                     "env": env}) + "\n")
+
+            reply = conn.makefile("r").readline()
+            conn.close()
+            code = int(reply) if reply.strip() else 1
+
+    if code == NOT_HANDLED and fallback:
+        os.execvp(fallback[0], list(fallback))
+
+    return code
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    if len(args) in (2, 3) and args[0] == "serve":
+        serve(*args[1:])
+    elif len(args) >= 3 and args[0] == "client":
+        return client(args[1], args[2], args[3:])
+    else:
+        sys.stderr.write(USAGE)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+'''
+Tests for the permission groups.
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from revisioncask import groups
+from revisioncask.abstractrepo import match_permissions
+
+
+GROUPS = """
+[groups]
+team = Alice, bob
+all = @team, carol, @loop
+loop = @all
+"""
+
+
+class TestGroups(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="subuser_test_tmp_")
+        self.path = os.path.join(self.tempdir, "permission_groups")
+        self.write(GROUPS)
+        self.groups = groups.Groups(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, data):
+        f = open(self.path, "w")
+        f.write(data)
+        f.close()
+        # Freshly written files are compiled on every use
+        hour_ago = time.time() - 3600
+        os.utime(self.path, (hour_ago, hour_ago))
+
+    def test_nested_groups(self):
+        self.assertEquals(self.groups.member_of("alice"),
+                          frozenset(["@team", "@all", "@loop"]))
+        self.assertEquals(self.groups.member_of("carol"),
+                          frozenset(["@all", "@loop"]))
+        self.assertEquals(self.groups.member_of("dave"), frozenset())
+        self.assert_(self.groups.exists("@team"))
+        self.assertFalse(self.groups.exists("@nobody"))
+
+    def test_match_permissions(self):
+        granted = {"@team": "rw", "@all": "r"}
+        self.assert_(match_permissions(granted, "bob", "rw",
+                                       self.groups))
+        self.assert_(match_permissions(granted, "carol", "r",
+                                       self.groups))
+        self.assertFalse(match_permissions(granted, "carol", "w",
+                                            self.groups))
+        self.assertFalse(match_permissions(granted, "dave", "r",
+                                            self.groups))
+
+    def test_changed_file_is_compiled_again(self):
+        self.assert_(self.groups.member_of("bob"))
+        self.write("[groups]\nteam = alice\n")
+        self.assertEquals(self.groups.member_of("bob"), frozenset())
+        os.remove(self.path)
+        self.assertEquals(self.groups.member_of("alice"), frozenset())
+
+    def test_enabled_per_vcs(self):
+        class Enabled(object):
+            permission_groups = None
+        class Disabled(object):
+            permission_groups = None
+        class config:
+            PERMISSION_GROUPS = "true"
+            PERMISSION_GROUPS_FILE = self.path
+
+        groups.enable_from(config, Enabled)
+        self.assertEquals(Enabled.permission_groups.path, self.path)
+        self.assertEquals(Disabled.permission_groups, None)
+        self.assertFalse(match_permissions({"@team": "r"}, "bob", "r",
+                                           Disabled.permission_groups))
+
+        config.PERMISSION_GROUPS = "false"
+        groups.enable_from(config, Enabled)
+        self.assertEquals(Enabled.permission_groups, None)
@@ -0,0 +1,134 @@
+'''
+Tests for the latency histograms and the Prometheus export.
+'''
+
+import os
+import sys
+import shutil
+import inspect
+import tempfile
+import unittest
+import subprocess
+
+from revisioncask import metrics
+
+
+WRITER = """
+from revisioncask import metrics
+metrics.enable(%r)
+for seconds in (0.0005, 0.02, 3):
+    metrics.observe(metrics.COMMAND, seconds, command="git-upload-pack")
+"""
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="subuser_test_tmp_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def run_writer(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        subprocess.check_call([sys.executable, "-c", WRITER % self.tempdir],
+                              env=env)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        for seconds in (0.001, 0.002, 1000):
+            histogram.observe(seconds)
+        self.assertEquals(histogram.count, 3)
+        self.assertEquals(histogram.counts[0], 1)
+        self.assertEquals(histogram.counts[1], 1)
+        self.assertEquals(histogram.counts[-1], 1)
+
+    def test_processes_are_aggregated(self):
+        self.run_writer()
+        self.run_writer()
+        histograms = metrics.collect(self.tempdir)
+
+        self.run_writer()
+        histograms = metrics.collect(self.tempdir)
+
+        key = metrics.metric_key(metrics.COMMAND,
+                                 {"command": "git-upload-pack"})
+        self.assertEquals(histograms[key].count, 9)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir,
+                                                     metrics.SPOOL_NAME)))
+
+    def test_interrupted_collect_is_counted_once(self):
+        from revisioncask import fstools
+        key = metrics.metric_key(metrics.COMMAND,
+                                 {"command": "git-upload-pack"})
+
+        def crash(*args):
+            raise KeyboardInterrupt()
+
+        self.run_writer()
+        # Exporter dies before writing the aggregate
+        atomic_write, fstools.atomic_write = fstools.atomic_write, crash
+        try:
+            self.assertRaises(KeyboardInterrupt, metrics.collect,
+                              self.tempdir)
+        finally:
+            fstools.atomic_write = atomic_write
+        self.assertEquals(metrics.collect(self.tempdir)[key].count, 3)
+
+        self.run_writer()
+        # Exporter dies after writing the aggregate
+        remove, os.remove = os.remove, crash
+        try:
+            self.assertRaises(KeyboardInterrupt, metrics.collect,
+                              self.tempdir)
+        finally:
+            os.remove = remove
+        self.assertEquals(metrics.collect(self.tempdir)[key].count, 6)
+        self.assertEquals([name for name in os.listdir(self.tempdir)
+                           if name.startswith(metrics.SPOOL_NAME)], [])
+
+    def test_prometheus_text(self):
+        self.run_writer()
+        text = metrics.prometheus_text(metrics.collect(self.tempdir))
+        lines = text.splitlines()
+
+        self.assertEquals(lines[0],
+                          "# TYPE revisioncask_command_seconds histogram")
+        self.assert_('revisioncask_command_seconds_bucket'
+                     '{command="git-upload-pack",le="0.001"} 1' in lines)
+        self.assert_('revisioncask_command_seconds_bucket'
+                     '{command="git-upload-pack",le="0.025"} 2' in lines)
+        self.assert_('revisioncask_command_seconds_bucket'
+                     '{command="git-upload-pack",le="+Inf"} 3' in lines)
+        self.assert_('revisioncask_command_seconds_count'
+                     '{command="git-upload-pack"} 3' in lines)
+
+    def test_timed_keeps_command_docs(self):
+        @metrics.timed(metrics.PHASE, phase="test")
+        def command(user):
+            """usage: $cmd"""
+            return 42
+        self.assertEquals(command(None), 42)
+        self.assertEquals(command.__name__, "command")
+        self.assertEquals(command.__doc__, "usage: $cmd")
+
+    def test_timed_command_keeps_signature(self):
+        from revisioncask import git
+
+        class Manager(object):
+            klass = git.Git
+
+            def command(self, user, repo_name, mode="rw", *names, **options):
+                """usage: $cmd <repo name>"""
+                return repo_name, mode, names, options
+
+            timed = metrics.timed_command(command)
+
+        self.assertEquals(inspect.getargspec(Manager.timed),
+                          inspect.getargspec(Manager.command))
+        self.assertEquals(Manager.timed.__doc__, "usage: $cmd <repo name>")
+        self.assertEquals(Manager().timed(None, "repo"),
+                          ("repo", "rw", (), {}))
+        self.assertEquals(Manager().timed(None, "repo", "r", "a", force=True),
+                          ("repo", "r", ("a",), {"force": True}))
@@ -0,0 +1,50 @@
+'''
+Modules imported by the entry points run on every ssh connection.
+'''
+
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+
+PROBE = """
+import sys
+modules_before = set(sys.modules)
+import %s
+import json
+print json.dumps({"modules": sorted(set(sys.modules) - modules_before)})
+"""
+
+
+def measure_import(module):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    output = subprocess.check_output([sys.executable, "-c", PROBE % module],
+                                     env=env)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class TestStartup(unittest.TestCase):
+
+    def assertNotImported(self, result, *modules):
+        for module in modules:
+            self.assertFalse(module in result["modules"],
+                             "%s was imported" % module)
+
+    def test_zygote_client_is_light(self):
+        result = measure_import("revisioncask.zygote")
+        self.assertNotImported(result, "subssh", "revisioncask.git",
+                               "revisioncask.hg", "revisioncask.svn")
+
+    def test_plugins_load_nothing(self):
+        result = measure_import("revisioncask.plugins")
+        self.assertNotImported(result, "subssh", "revisioncask.git",
+                               "revisioncask.hg", "revisioncask.svn")
+
+    def test_git_loads_only_git(self):
+        result = measure_import("revisioncask.git")
+        self.assertNotImported(result, "revisioncask.hg", "revisioncask.svn",
+                               "mercurial", "sqlite3", "optparse",
+                               "multiprocessing")
@@ -0,0 +1,76 @@
+'''
+Tests for the commands listing the repositories of all VCSs.
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from revisioncask import git, plugins, unified
+from revisioncask.abstractrepo import InvalidRepository
+
+
+class UserRequest(object):
+    def __init__(self, **kwargs):
+        self.__dict__ = kwargs
+
+
+class TestUnified(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="subuser_test_tmp_")
+        self.user = UserRequest(username="tester")
+
+        # Two git managers stand for two different VCSs
+        self.managers = {"git": git.GitManager(
+                             os.path.join(self.tempdir, "git")),
+                         "hg": git.GitManager(
+                             os.path.join(self.tempdir, "hg"))}
+        plugins._managers.update(self.managers)
+        unified.config.VCS = "git,hg"
+
+        self.output(self.managers["git"].init, self.user, "beta")
+        self.output(self.managers["git"].init, self.user, "alpha")
+        self.output(self.managers["hg"].init, self.user, "alpha2")
+        self.output(self.managers["hg"].init, self.user, "gamma")
+
+    def tearDown(self):
+        for vcs in self.managers:
+            plugins._managers.pop(vcs, None)
+        unified.config.VCS = "git,hg,svn"
+        shutil.rmtree(self.tempdir)
+
+    def output(self, function, *args):
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            function(*args)
+        finally:
+            sys.stdout = stdout
+        return output.getvalue().splitlines()
+
+    def test_ls_merges_all_vcs(self):
+        self.assertEquals(self.output(unified.ls, self.user),
+                          ["git/alpha", "hg/alpha2", "git/beta", "hg/gamma"])
+        self.assertEquals(self.output(unified.ls, self.user, "--offset", "1",
+                                      "--limit", "2"),
+                          ["hg/alpha2", "git/beta"])
+
+        line, = self.output(unified.ls, self.user, "--json", "mine", "g*")
+        self.assertEquals(json.loads(line)["vcs"], "hg")
+        self.assertEquals(json.loads(line)["name"], "gamma")
+
+        self.assertEquals(self.output(unified.ls,
+                                      UserRequest(username="stranger")), [])
+
+    def test_info(self):
+        self.assertEquals(self.output(unified.info, self.user, "alpha")[0],
+                          "git/alpha")
+        self.assertEquals(self.output(unified.info, self.user,
+                                      "hg/gamma")[0], "hg/gamma")
+        self.assertRaises(InvalidRepository, unified.info, self.user,
+                          "git/gamma")
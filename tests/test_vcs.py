@@ -9,9 +9,22 @@ import unittest
 import tempfile
 import os
 import shutil
-
-from revisioncask import git, svn, hg
-from revisioncask.abstractrepo import InvalidPermissions
+import threading
+import subprocess
+import sys
+import json
+import time
+from StringIO import StringIO
+from ConfigParser import SafeConfigParser
+
+from revisioncask import git, svn, hg, repoindex, groups, repolayout
+from revisioncask.authz import Authorizer
+from revisioncask.reaper import Reaper
+from revisioncask.packcache import PackCache
+from revisioncask.maintenance import Scheduler
+from revisioncask import maintenance
+from revisioncask import accounting
+from revisioncask.abstractrepo import InvalidPermissions, InvalidRepository
 
 
 class UserRequest(object):
@@ -154,6 +167,28 @@ class VCSMixIn(object):
 
 
 
+    def test_concurrent_set_permissions(self):
+        usernames = ["user%d" % i for i in range(30)]
+
+        def set_permissions(username):
+            repo = self.vcs_class(self.dir, self.username)
+            with repo.locked():
+                repo.set_permissions(username, "rw")
+                repo.save()
+
+        threads = [threading.Thread(target=set_permissions, args=(u,))
+                   for u in usernames]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        repo = self.vcs_class(self.dir, self.username)
+        for username in usernames:
+            self.assert_(repo.has_permissions(username, "rw"))
+        self.assert_(repo.is_owner(self.username))
+
+
     def tearDown(self):
         shutil.rmtree(self.tempdir, ignore_errors=True)
 
@@ -172,10 +207,524 @@ class TestGit(VCSMixIn, unittest.TestCase):
     vcs_class = git.Git
 
 
+TRANSPORT = """#!/bin/sh
+echo "$GIT_PROTOCOL" > %(protocol_file)s
+exec %(python)s -c '
+import sys
+from revisioncask import git
+class User(object):
+    username = "tester"
+    cmd = "%(cmd)s"
+git.config.REPOSITORIES = "%(repos)s"
+git.config.PACK_CACHE_SIZE = "%(pack_cache_size)s"
+git.config.PACK_CACHE_DIR = "%(pack_cache_dir)s"
+git.config.ACCOUNTING = "%(accounting)s"
+git.config.ACCOUNTING_DIR = "%(accounting_dir)s"
+git.config.SHARDED_LAYOUT = "%(sharded)s"
+sys.exit(git.handle_git(User(), "git/testingrepo"))
+'
+"""
+
+def push_files(work, repo_path, count=3):
+    """
+    Commits count files to work repository and pushes them to repo_path
+    """
+    if not os.path.exists(work):
+        subprocess.check_call(["git", "init", "-q", work])
+    for i in range(count):
+        f = open(os.path.join(work, "file%d" % i), "a")
+        f.write("content %d\n" % i)
+        f.close()
+    subprocess.check_call(["git", "-C", work, "add", "."])
+    subprocess.check_call(["git", "-C", work, "-c", "user.name=tester",
+                           "-c", "user.email=tester@localhost",
+                           "commit", "-q", "-m", "files"])
+    subprocess.check_call(["git", "-C", work, "push", "-q", repo_path,
+                           "HEAD:refs/heads/master"])
+
+class TestGitTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="subuser_test_tmp_")
+        self.repos = os.path.join(self.tempdir, "repos")
+        self.repomanager = git.GitManager(self.repos)
+        self.user = UserRequest(username="tester")
+        self.repomanager.init(self.user, "testingrepo")
+
+        push_files(os.path.join(self.tempdir, "work"),
+                   self.repomanager.real_path("testingrepo"))
+
+        self.protocol_file = os.path.join(self.tempdir, "protocol")
+        self.pack_cache_dir = os.path.join(self.tempdir, "packcache")
+        self.accounting_dir = os.path.join(self.tempdir, "accounting")
+        self.upload_pack = self.write_transport("git-upload-pack")
+
+    def write_transport(self, cmd, pack_cache_size=0, accounting="false",
+                        sharded="false"):
+        path = os.path.join(self.tempdir, cmd)
+        f = open(path, "w")
+        f.write(TRANSPORT % {"python": sys.executable,
+                             "cmd": cmd,
+                             "repos": self.repos,
+                             "protocol_file": self.protocol_file,
+                             "pack_cache_size": pack_cache_size,
+                             "pack_cache_dir": self.pack_cache_dir,
+                             "accounting": accounting,
+                             "accounting_dir": self.accounting_dir,
+                             "sharded": sharded})
+        f.close()
+        os.chmod(path, 0700)
+        return path
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def clone(self, *options, **kwargs):
+        target = os.path.join(self.tempdir, kwargs.get("target", "clone"))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        # file:// forces the pack protocol instead of a local copy
+        subprocess.check_call(["git", "-c", "protocol.version=2", "clone",
+                               "-q", "--no-checkout",
+                               "--upload-pack=" + self.upload_pack] +
+                              list(options) +
+                              ["file://" + self.tempdir, target], env=env)
+        return target
+
+    def test_sharded_layout(self):
+        manager = git.GitManager(self.repos, sharded=True)
+        manager.shard_repositories(
+            UserRequest(username=git.subssh.config.ADMIN))
+        self.assert_(repolayout.SHARDS_NAME in
+                     manager.real_path("testingrepo"))
+
+        self.upload_pack = self.write_transport("git-upload-pack",
+                                                sharded="true")
+        target = self.clone()
+        self.assert_(subprocess.check_output(
+            ["git", "-C", target, "rev-parse", "HEAD"]).strip())
+
+    def test_server_options_are_set_on_init(self):
+        repo = self.repomanager.get_repo_object("tester", "testingrepo")
+        options = dict(repo.get_server_options())
+        self.assertEquals(options["uploadpack.allowfilter"], "true")
+        self.assertFalse("uploadpack.allowanysha1inwant" in options)
+
+    def test_set_server_option(self):
+        self.repomanager.set_server_option(self.user, "testingrepo",
+                                           "uploadpack.allowFilter", "false")
+        repo = self.repomanager.get_repo_object("tester", "testingrepo")
+        options = dict(repo.get_server_options())
+        self.assertEquals(options["uploadpack.allowfilter"], "false")
+
+    def test_unknown_server_option(self):
+        self.assertRaises(git.subssh.InvalidArguments,
+                          self.repomanager.set_server_option, self.user,
+                          "testingrepo", "core.hooksPath", "/tmp")
+        self.assertRaises(git.subssh.InvalidArguments,
+                          self.repomanager.set_server_option, self.user,
+                          "testingrepo", "uploadpack.allowFilter", "maybe")
+
+    def test_only_owners_set_server_options(self):
+        self.assertRaises(InvalidPermissions,
+                          self.repomanager.set_server_option,
+                          UserRequest(username="randomdude"), "testingrepo",
+                          "uploadpack.allowFilter", "false")
+
+    def test_protocol_v2_clone(self):
+        target = self.clone()
+        self.assertEquals(open(self.protocol_file).read().strip(),
+                          "version=2")
+        self.assertTrue(os.path.exists(os.path.join(target, ".git")))
+
+    def test_partial_clone(self):
+        target = self.clone("--filter=blob:none")
+
+        # Filter was accepted and the blobs were left out
+        self.assertEquals(subprocess.check_output(
+            ["git", "-C", target, "config", "remote.origin.promisor"]).strip(),
+            "true")
+        missing = subprocess.check_output(
+            ["git", "-C", target, "rev-list", "--objects", "--all",
+             "--missing=print"]).splitlines()
+        self.assertEquals(len([l for l in missing if l.startswith("?")]), 3)
+
+    def test_shallow_clone(self):
+        target = self.clone("--depth=1")
+        self.assertTrue(os.path.exists(os.path.join(target, ".git",
+                                                    "shallow")))
+
+    def cached_packs(self):
+        return sorted(PackCache(self.pack_cache_dir, 0).entries())
+
+    def test_pack_cache(self):
+        self.upload_pack = self.write_transport("git-upload-pack", 10)
+
+        self.clone(target="first")
+        packs = self.cached_packs()
+        self.assertEquals(len(packs), 1)
+        _, _, path = packs[0]
+        os.utime(path, (0, 0))
+
+        target = self.clone(target="second")
+        subprocess.check_call(["git", "-C", target, "fsck"])
+        # Same pack was served again
+        packs = self.cached_packs()
+        self.assertEquals(len(packs), 1)
+        self.assert_(packs[0][0] > 0)
+
+    def test_push_invalidates_pack_cache(self):
+        self.upload_pack = self.write_transport("git-upload-pack", 10)
+        receive_pack = self.write_transport("git-receive-pack", 10)
+
+        target = self.clone()
+        self.assertEquals(len(self.cached_packs()), 1)
+
+        subprocess.check_call(["git", "-C", target, "-c", "user.name=tester",
+                               "-c", "user.email=tester@localhost",
+                               "commit", "-q", "--allow-empty", "-m", "more"])
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        subprocess.check_call(["git", "-C", target, "push", "-q",
+                               "--receive-pack=" + receive_pack,
+                               "origin", "HEAD:refs/heads/master"], env=env)
+        self.assertEquals(self.cached_packs(), [])
+
+    def test_pack_cache_eviction(self):
+        cache = PackCache(self.pack_cache_dir, 250)
+        for i in range(3):
+            f, tmp_path = cache.new_pack("repo%d" % i)
+            f.write("x" * 100)
+            f.close()
+            os.utime(tmp_path, (i, i))
+            os.rename(tmp_path, cache.pack_path("repo%d" % i, "key"))
+        cache.evict()
+
+        self.assertEquals([os.path.exists(cache.pack_path("repo%d" % i, "key"))
+                           for i in range(3)], [False, True, True])
+
+    def test_accounting(self):
+        self.upload_pack = self.write_transport("git-upload-pack",
+                                                accounting="true")
+        target = self.clone()
+        subprocess.check_call(["git", "-C", target, "fsck"])
+
+        records = list(accounting.read_records(self.accounting_dir))
+        self.assertEquals(len(records), 1)
+        record = records[0]
+        self.assertEquals((record["vcs"], record["user"], record["repo"],
+                           record["command"], record["exit"]),
+                          ("git", "tester", "testingrepo", "git-upload-pack",
+                           0))
+        self.assert_(record["bytes_in"] > 0)
+        self.assert_(record["bytes_out"] > 0)
+        self.assert_(record["maxrss"] > 0)
+
+    def test_top_usage(self):
+        self.upload_pack = self.write_transport("git-upload-pack",
+                                                accounting="true")
+        self.clone(target="first")
+        self.clone(target="second")
+
+        top = accounting.summarize(
+            accounting.read_records(self.accounting_dir), order_by="bytes_out")
+        self.assertEquals(len(top), 1)
+        group, total = top[0]
+        self.assertEquals(group, ("tester", "testingrepo", "git-upload-pack"))
+        self.assertEquals(total["sessions"], 2)
+
+        manager = git.GitManager(self.repos,
+                                 accounting_path=self.accounting_dir)
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            manager.top_usage(self.user, "1", "bytes_out")
+        finally:
+            sys.stdout = stdout
+        self.assert_("git-upload-pack" in output.getvalue())
+
+        output = StringIO()
+        sys.stdout = output
+        try:
+            manager.top_usage(UserRequest(username="randomdude"))
+        finally:
+            sys.stdout = stdout
+        self.assertFalse("git-upload-pack" in output.getvalue())
+
+    def test_invalid_protocol_is_dropped(self):
+        os.environ["GIT_PROTOCOL"] = "version=2; rm -rf /"
+        try:
+            git.clean_protocol_env()
+            self.assertFalse("GIT_PROTOCOL" in os.environ)
+        finally:
+            os.environ.pop("GIT_PROTOCOL", None)
+
+
+class TestGitMaintenance(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="subuser_test_tmp_")
+        self.repomanager = git.GitManager(
+            os.path.join(self.tempdir, "repos"),
+            maintenance_path=os.path.join(self.tempdir, "maintenance"))
+        self.user = UserRequest(username="tester")
+        self.repomanager.init(self.user, "testingrepo")
+        self.work = os.path.join(self.tempdir, "work")
+        self.repo_path = self.repomanager.real_path("testingrepo")
+        self.maintenance = self.repomanager.maintenance
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def queued_names(self):
+        return [name for _, name in self.maintenance.queued()]
+
+    def test_push_queues_repository(self):
+        self.assertEquals(self.queued_names(), [])
+        push_files(self.work, self.repo_path)
+        self.assertEquals(self.queued_names(), ["testingrepo"])
+
+    def test_scheduler_maintains_repository(self):
+        push_files(self.work, self.repo_path)
+        states = Scheduler(self.repomanager, low_priority=False).run()
+
+        self.assertEquals(states["testingrepo"]["result"], "ok")
+        self.assertEquals(self.queued_names(), [])
+        self.assertEquals(self.maintenance.state("testingrepo")["result"],
+                          "ok")
+
+        pack_dir = os.path.join(self.repo_path, "objects", "pack")
+        self.assert_([f for f in os.listdir(pack_dir)
+                      if f.endswith(".bitmap")])
+        self.assert_(os.path.exists(os.path.join(self.repo_path, "objects",
+                                                 "info", "commit-graph")))
+
+    def test_repository_is_not_maintained_concurrently(self):
+        push_files(self.work, self.repo_path)
+        lock = self.maintenance.try_lock("testingrepo")
+        try:
+            self.assertEquals(
+                Scheduler(self.repomanager, low_priority=False).run(), {})
+        finally:
+            lock.close()
+        self.assertEquals(self.queued_names(), ["testingrepo"])
+
+    def test_interval(self):
+        push_files(self.work, self.repo_path)
+        scheduler = Scheduler(self.repomanager, interval=3600,
+                              low_priority=False)
+        scheduler.run()
+
+        push_files(self.work, self.repo_path)
+        self.assertEquals(scheduler.due(), [])
+        self.assertEquals(self.queued_names(), ["testingrepo"])
+
+    def test_deleted_repository_is_dropped_from_queue(self):
+        push_files(self.work, self.repo_path)
+        shutil.rmtree(self.repo_path)
+        self.assertEquals(
+            Scheduler(self.repomanager, low_priority=False).run(), {})
+        self.assertEquals(self.queued_names(), [])
+
+    def run_main(self, *args):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertEquals(maintenance.main(
+                ["--vcs", "git",
+                 "--repositories", self.repomanager.path_to_repos,
+                 "--maintenance-dir", self.maintenance.path] +
+                list(args)), 0)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_main_maintains_queued_repository(self):
+        push_files(self.work, self.repo_path)
+        output = self.run_main("--interval", "0")
+
+        self.assertEquals(json.loads(output)["repository"], "testingrepo")
+        self.assertEquals(self.maintenance.state("testingrepo")["result"],
+                          "ok")
+        self.assertEquals(self.queued_names(), [])
+
+    def test_main_installs_hooks(self):
+        os.remove(os.path.join(self.repo_path, "hooks", "post-receive"))
+        self.run_main("--install-hooks")
+        push_files(self.work, self.repo_path)
+        self.assertEquals(self.queued_names(), ["testingrepo"])
+
+    def test_existing_hook_is_chained(self):
+        hook = os.path.join(self.repo_path, "hooks", "post-receive")
+        received = os.path.join(self.tempdir, "received")
+        f = open(hook, "w")
+        f.write("#!/bin/sh\ncat > %s\n" % received)
+        f.close()
+        os.chmod(hook, 0755)
+
+        repo = self.repomanager.get_repo_object("tester", "testingrepo")
+        repo.install_push_hook(self.maintenance.queue_path)
+        repo.install_push_hook(self.maintenance.queue_path)
+        push_files(self.work, self.repo_path)
+
+        self.assertEquals(self.queued_names(), ["testingrepo"])
+        self.assert_(open(received).read().endswith(" refs/heads/master\n"))
+        self.assertEquals(sorted(f for f in os.listdir(os.path.dirname(hook))
+                                 if f.startswith("post-receive")),
+                          ["post-receive", "post-receive.chained"])
+
+
 class TestMercurial(VCSMixIn, unittest.TestCase):
     manager_class = hg.MercurialManager
     vcs_class = hg.Mercurial
 
+class FakeUI(object):
+    def __init__(self, sections):
+        self.sections = sections
+
+    def config(self, section, name):
+        return self.sections.get(section, {}).get(name)
+
+    def configitems(self, section):
+        return self.sections.get(section, {}).items()
+
+class FakeHgRepo(object):
+    def __init__(self, root, sections):
+        self.root = root
+        self.ui = FakeUI(sections)
+
+class TestMercurialPermissionsHook(unittest.TestCase):
+
+    def hook(self, username, permissions):
+        repo = FakeHgRepo("/repos/testingrepo",
+                          {"revisioncask": {"user": username},
+                           "revisioncask.permissions": permissions})
+        return hg.permissions_hook(ui=repo.ui, repo=repo)
+
+    def test_writer_is_allowed(self):
+        self.hook("tester", {"tester": "rw"})
+        self.hook("tester", {"*": "rw"})
+
+    def test_reader_is_denied(self):
+        from mercurial.util import Abort
+        self.assertRaises(Abort, self.hook, "tester", {"tester": "r"})
+        self.assertRaises(Abort, self.hook, "tester", {"other": "rw"})
+
+    def test_groups_are_passed_by_serve(self):
+        tempdir = tempfile.mkdtemp(prefix="subuser_test_tmp_")
+        try:
+            groups_file = os.path.join(tempdir, "groups")
+            f = open(groups_file, "w")
+            f.write("[groups]\nteam = tester\n")
+            f.close()
+
+            # The hook run in a separate hg process has not read the config
+            groups.disable(hg.Mercurial)
+            repo = FakeHgRepo("/repos/testingrepo",
+                              {"revisioncask": {"user": "tester",
+                                                "permission_groups":
+                                                    groups_file},
+                               "revisioncask.permissions": {"@team": "rw"}})
+            hg.permissions_hook(ui=repo.ui, repo=repo)
+        finally:
+            groups.disable(hg.Mercurial)
+            shutil.rmtree(tempdir)
+
+    def test_serve_args(self):
+        hook = hg.config.PERMISSIONS_HOOK
+        hg.config.PERMISSIONS_HOOK = "pretxnchangegroup"
+        groups.enable(hg.Mercurial, "/groups")
+        try:
+            args = hg.serve_args("tester", "/repos/testingrepo")
+        finally:
+            hg.config.PERMISSIONS_HOOK = hook
+            groups.disable(hg.Mercurial)
+
+        config = [args[i + 1] for i, arg in enumerate(args)
+                  if arg == "--config"]
+        self.assertEquals(config,
+            ["revisioncask.user=tester",
+             "revisioncask.permission_groups=/groups",
+             "hooks.prechangegroup.revisioncask.permissions=",
+             "hooks.pretxnchangegroup.revisioncask.permissions="
+             "python:revisioncask.hg.permissions_hook"])
+        self.assertEquals(args[-4:],
+                          ["-R", "/repos/testingrepo", "serve", "--stdio"])
+
+
+HG_TRANSPORT = """#!/bin/sh
+exec %(python)s -c '
+import sys, shlex
+from revisioncask import hg
+class User(object):
+    username = "%(username)s"
+    cmd = "hg"
+hg.config.REPOSITORIES = "%(repos)s"
+hg.config.ACCOUNTING = "true"
+hg.config.ACCOUNTING_DIR = "%(accounting_dir)s"
+hg.config.PERMISSION_GROUPS = "true"
+hg.config.PERMISSION_GROUPS_FILE = "%(groups_file)s"
+hg.config.PERMISSIONS_HOOK = "%(permissions_hook)s"
+sys.exit(hg.hg_handle(User(), *shlex.split(sys.argv[1])[1:]))
+' "$2"
+"""
+
+class TestMercurialTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="subuser_test_tmp_")
+        self.repos = os.path.join(self.tempdir, "repos")
+        self.groups_file = os.path.join(self.tempdir, "groups")
+        f = open(self.groups_file, "w")
+        f.write("[groups]\nteam = member\n")
+        f.close()
+        groups.enable(hg.Mercurial, self.groups_file)
+
+        self.repomanager = hg.MercurialManager(self.repos)
+        self.user = UserRequest(username="tester")
+        self.repomanager.init(self.user, "testingrepo")
+        repo = self.repomanager.get_repo_object("tester", "testingrepo")
+        repo.set_permissions("@team", "rw")
+        repo.set_permissions("*", "r")
+        repo.save()
+
+        self.work = os.path.join(self.tempdir, "work")
+        subprocess.check_call(["hg", "init", self.work])
+        open(os.path.join(self.work, "file"), "w").write("content\n")
+        subprocess.check_call(["hg", "-R", self.work, "commit", "-q", "-A",
+                               "-u", "tester", "-m", "file"])
+
+    def tearDown(self):
+        groups.disable(hg.Mercurial)
+        shutil.rmtree(self.tempdir)
+
+    def push(self, username, permissions_hook="prechangegroup"):
+        ssh = os.path.join(self.tempdir, "ssh")
+        f = open(ssh, "w")
+        f.write(HG_TRANSPORT % {"python": sys.executable,
+                                "username": username,
+                                "repos": self.repos,
+                                "accounting_dir": os.path.join(
+                                    self.tempdir, "accounting"),
+                                "groups_file": self.groups_file,
+                                "permissions_hook": permissions_hook})
+        f.close()
+        os.chmod(ssh, 0700)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        return subprocess.call(["hg", "-R", self.work, "push", "-q",
+                                "--ssh", ssh,
+                                "ssh://localhost/hg/testingrepo"], env=env)
+
+    def test_group_member_pushes_with_accounting(self):
+        self.assertEquals(self.push("member"), 0)
+
+    def test_non_member_is_denied_with_either_hook(self):
+        self.assertNotEquals(self.push("other"), 0)
+        self.assertNotEquals(self.push("other", "pretxnchangegroup"), 0)
+        self.assertEquals(self.push("member", "pretxnchangegroup"), 0)
+
+
 class RepoManagertMixIn(object):
     username = "tester"
     vcs_class = None
@@ -227,6 +776,140 @@ class RepoManagertMixIn(object):
         self.assertFalse(newrepo.has_permissions(randomdude, "w"))
         self.assertFalse(newrepo.is_owner(randomdude))
 
+    def test_fork_links_immutable_files(self):
+        repo = self.repomanager.get_repo_object(self.username, self.repo_name)
+        immutable_dir = os.path.join(repo.repo_path, repo.immutable_dirs[0])
+        if not os.path.exists(immutable_dir):
+            os.makedirs(immutable_dir)
+        original = os.path.join(immutable_dir, "immutable")
+        open(original, "w").write("data")
+
+        user = UserRequest(username="forker")
+        self.repomanager.fork(user, self.repo_name, "newfork")
+
+        fork = self.repomanager.get_repo_object("forker", "newfork")
+        forked = os.path.join(fork.repo_path, repo.immutable_dirs[0],
+                              "immutable")
+        self.assertEquals(os.stat(original).st_ino, os.stat(forked).st_ino)
+
+        # Permission files must not be shared
+        self.assertNotEquals(os.stat(repo.record_filepath).st_ino,
+                             os.stat(fork.record_filepath).st_ino)
+
+    def test_delete_and_undelete(self):
+        self.repomanager.delete_grace_period = 3600
+        repo_path = self.repomanager.real_path(self.repo_name)
+
+        self.repomanager.delete(self.user, self.repo_name)
+        self.assertFalse(os.path.exists(repo_path))
+
+        self.repomanager.undelete(self.user, self.repo_name)
+        self.assert_(os.path.exists(repo_path))
+        self.repomanager.get_repo_object(self.username, self.repo_name)
+
+    def test_delete_tells_short_grace_period(self):
+        self.repomanager.delete_grace_period = 1800
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            self.repomanager.delete(self.user, self.repo_name)
+        finally:
+            sys.stdout = stdout
+        self.assert_("for 30 minutes" in output.getvalue(), output.getvalue())
+
+    def test_reaper_removes_deleted(self):
+        self.repomanager.delete_grace_period = 3600
+        self.repomanager.delete(self.user, self.repo_name)
+
+        # Grace period has not passed yet
+        Reaper([self.repomanager.trash_path], grace_period=3600).reap()
+        self.assertEquals(len(os.listdir(self.repomanager.trash_path)), 1)
+
+        Reaper([self.repomanager.trash_path]).reap()
+        self.assertEquals(os.listdir(self.repomanager.trash_path), [])
+        self.assertRaises(InvalidRepository, self.repomanager.undelete,
+                          self.user, self.repo_name)
+
+    def test_reaper_racing_delete(self):
+        trash_path = self.repomanager.trash_path
+        mkdtemp = tempfile.mkdtemp
+
+        def mkdtemp_and_reap(*args, **kwargs):
+            path = mkdtemp(*args, **kwargs)
+            # Reaper spawned by another delete without grace period
+            Reaper([trash_path]).reap()
+            return path
+
+        self.repomanager.delete_grace_period = 3600
+        tempfile.mkdtemp = mkdtemp_and_reap
+        try:
+            self.repomanager.delete(self.user, self.repo_name)
+        finally:
+            tempfile.mkdtemp = mkdtemp
+
+        self.assertEquals(len(os.listdir(trash_path)), 1)
+        self.repomanager.undelete(self.user, self.repo_name)
+        self.repomanager.get_repo_object(self.username, self.repo_name)
+
+    def test_bulk_set_permissions(self):
+        self.repomanager.init(self.user, "other")
+        self.repomanager.init(UserRequest(username="stranger"), "strangers")
+
+        self.repomanager.bulk_set_permissions(self.user, "newguy", "rw",
+                                              "owner:" + self.username)
+
+        for repo_name in (self.repo_name, "other"):
+            repo = self.repomanager.get_repo_object(self.username, repo_name)
+            self.assert_(repo.has_permissions("newguy", "rw"))
+
+        repo = self.repomanager.get_repo_object("stranger", "strangers")
+        self.assertFalse(repo.has_permissions("newguy", "r"))
+
+    def test_bulk_reports_failures(self):
+        results = self.repomanager.apply_to_repositories(
+            self.user, [self.repo_name, "nonexistent"],
+            lambda repo: repo.add_owner("newguy"))
+
+        self.assertEquals(results[0], (self.repo_name, None))
+        self.assertEquals(results[1][0], "nonexistent")
+        self.assert_(results[1][1])
+
+    def test_bulk_remove_owner_reports_non_owners(self):
+        self.repomanager.init(self.user, "shared")
+        self.repomanager.add_owner(self.user, "shared", "bob")
+
+        results = self.repomanager.apply_to_repositories(
+            self.user, [self.repo_name, "shared"],
+            lambda repo: repo.remove_owner("bob"))
+
+        self.assertEquals(results[0][0], self.repo_name)
+        self.assert_("not owner" in results[0][1])
+        self.assertEquals(results[1], ("shared", None))
+        repo = self.repomanager.get_repo_object(self.username, "shared")
+        self.assertEquals(repo.get_owners(), [self.username])
+
+    def test_concurrent_set_permissions_on_many_repos(self):
+        repo_names = ["repo%d" % i for i in range(5)]
+        for repo_name in repo_names:
+            self.repomanager.init(self.user, repo_name)
+
+        def set_permissions(username, repo_name):
+            self.repomanager.set_permissions(self.user, username, "rw",
+                                             repo_name)
+
+        threads = [threading.Thread(target=set_permissions,
+                                    args=("user%d" % i, repo_name))
+                   for i in range(10) for repo_name in repo_names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for repo_name in repo_names:
+            repo = self.repomanager.get_repo_object(self.username, repo_name)
+            for i in range(10):
+                self.assert_(repo.has_permissions("user%d" % i, "rw"))
+
     def test_enable_web(self):
         self.repomanager.web_enable(self.user, self.repo_name)
         webpath = os.path.join(self.repomanager.web_repos_path,
@@ -260,13 +943,526 @@ class RepoManagertMixIn(object):
         self.assertFalse(os.path.exists(webpath))
 
 
+    def test_index_lists_repositories(self):
+        repos = self.repomanager.index.repositories()
+        self.assertEquals([r.name for r in repos], [self.repo_name])
+        self.assert_(repos[0].is_owner(self.username))
+        self.assert_(repos[0].has_permissions("nonexistent", "r"))
+        self.assertFalse(repos[0].has_permissions("nonexistent", "w"))
+
+    def test_index_notices_changes(self):
+        # Trust all timestamps so that the cached entries are really used
+        repoindex.FRESHNESS_WINDOW = -1
+        try:
+            self.repomanager.index.repositories()
+            self.repomanager.set_permissions(self.user, "other", "rw",
+                                             self.repo_name)
+            repo, = self.repomanager.index.repositories()
+            self.assert_(repo.has_permissions("other", "w"))
+        finally:
+            repoindex.FRESHNESS_WINDOW = 2
+
+
+    def ls_output(self, manager, *args):
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            manager.ls(self.user, *args)
+        finally:
+            sys.stdout = stdout
+        return output.getvalue().splitlines()
+
+    def test_ls_filters_and_pages(self):
+        for name in ("team-b", "team-a", "other"):
+            self.repomanager.init(self.user, name)
+        managers = [self.repomanager, self.make_store_manager()]
+
+        for manager in managers:
+            self.assertEquals(self.ls_output(manager, "team-"),
+                              ["team-a", "team-b"])
+            self.assertEquals(self.ls_output(manager, "--limit", "2"),
+                              ["other", "team-a"])
+            self.assertEquals(self.ls_output(manager, "--limit=1",
+                                             "--offset", "1", "*-b"), [])
+            self.assertEquals(self.ls_output(manager, "--offset=1", "t*"),
+                              ["team-b", self.repo_name])
+
+            line, = self.ls_output(manager, "--json", "mine", "oth")
+            self.assertEquals(json.loads(line),
+                              {"name": "other", "owners": [self.username],
+                               "permissions": {self.username: "rw"}})
+
+        self.assertRaises(git.subssh.InvalidArguments, self.repomanager.ls,
+                          self.user, "--limit", "many")
+
+    def test_index_skips_listing_unchanged_directory(self):
+        self.repomanager.init(self.user, "another")
+        # Creates the index outside of the repository directory
+        self.repomanager.index.repositories()
+        hour_ago = time.time() - 3600
+        os.utime(self.tempdir, (hour_ago, hour_ago))
+        self.ls_output(self.repomanager)
+
+        def listdir(path):
+            self.fail("Listed %s" % path)
+        real_listdir, repoindex.os.listdir = repoindex.os.listdir, listdir
+        try:
+            self.assertEquals(self.ls_output(self.repomanager),
+                              ["another", self.repo_name])
+        finally:
+            repoindex.os.listdir = real_listdir
+
+    def test_index_lists_repository_completed_after_scan(self):
+        source_manager = self.manager_class(tempfile.mkdtemp(
+            prefix="subuser_test_tmp_"))
+        self.addCleanup(shutil.rmtree, source_manager.path_to_repos)
+        source_manager.init(self.user, "racing")
+        source = source_manager.real_path("racing")
+
+        # init is still creating the files while ls scans the directory
+        self.repomanager.index.repositories()
+        racing = os.path.join(self.tempdir, "racing")
+        os.mkdir(racing)
+        hour_ago = time.time() - 3600
+        os.utime(self.tempdir, (hour_ago, hour_ago))
+        self.assertEquals(self.ls_output(self.repomanager), [self.repo_name])
+
+        for name in os.listdir(source):
+            path = os.path.join(source, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(racing, name))
+            else:
+                shutil.copy2(path, racing)
+        # The directory listing is still trusted
+        self.assert_(os.stat(self.tempdir).st_mtime < hour_ago + 1)
+
+        self.assertEquals(self.ls_output(self.repomanager),
+                          ["racing", self.repo_name])
+
+    def test_ls_orders_by_name(self):
+        # "foo-bar.x" sorts before "foo.x" on fs
+        klass = type("Suffixed", (self.manager_class.klass,),
+                     {"suffix": ".x"})
+        manager_class = type("SuffixedManager", (self.manager_class,),
+                             {"klass": klass})
+        repos_path = os.path.join(self.tempdir, "suffixed")
+        manager = manager_class(repos_path)
+        for name in ("foo-bar", "foo", "foo.baz"):
+            manager.init(self.user, name)
+        store_manager = manager_class(
+            repos_path, permission_store_path=os.path.join(
+                self.tempdir, ".suffixed.sqlite"))
+        store_manager.import_permission_store(
+            UserRequest(username=git.subssh.config.ADMIN))
+
+        for manager in (manager, store_manager):
+            self.assertEquals(self.ls_output(manager),
+                              ["foo", "foo-bar", "foo.baz"])
+
+    def test_concurrent_index_scans(self):
+        self.repomanager.init(self.user, "another")
+        repos = self.repomanager.index.iter_repositories()
+        repos.next()
+        try:
+            # Other process writing the index while the first one streams
+            other = self.manager_class(self.tempdir)
+            other.init(self.user, "third")
+            self.assertEquals([r.name for r in other.index.repositories()],
+                              ["another", self.repo_name, "third"])
+        finally:
+            repos.close()
+
+    def test_interrupted_index_scan(self):
+        self.repomanager.init(self.user, "another")
+        repos = self.repomanager.index.iter_repositories()
+        self.assertEquals(repos.next().name, "another")
+        repos.close()
+        self.assertEquals(
+            [r.name for r in self.repomanager.index.repositories()],
+            ["another", self.repo_name])
+
+    def test_bulk_info(self):
+        self.repomanager.init(self.user, "team-a")
+        self.repomanager.set_permissions(self.user, "*", "r", "team-a")
+        self.repomanager.web_enable(self.user, "team-a")
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            self.repomanager.bulk_info(self.user, "team-*", "missing")
+            self.repomanager.bulk_info(self.user, "team-a")
+        finally:
+            sys.stdout = stdout
+        first, missing, second = [json.loads(line) for line
+                                  in output.getvalue().splitlines()]
+
+        self.assertEquals(first["name"], "team-a")
+        self.assertEquals(first["owners"], [self.username])
+        self.assert_(first["web_enabled"])
+        self.assert_(first["size"] > 0)
+        self.assertEquals(missing, {"name": "missing",
+                                    "error": "No such repository"})
+        self.assertEquals(second, first)
+
+    def test_authorizer_matches_repository(self):
+        repo = self.repomanager.get_repo_object(self.username, self.repo_name)
+        repo.set_permissions("writer", "w")
+        repo.set_permissions("CamelCase", "rw")
+        repo.save()
+
+        authorizer = Authorizer(self.manager_class.klass)
+        for username in ("*", self.username, "writer", "CamelCase",
+                         "nonexistent"):
+            for perms in ("r", "w", "rw"):
+                self.assertEquals(
+                    authorizer.has_permissions(repo.repo_path, username,
+                                               perms),
+                    repo.has_permissions(username, perms))
+
+    def make_legacy_repository(self):
+        """
+        Turns the repository to the format used before the access records
+        """
+        repo = self.repomanager.get_repo_object(self.username, self.repo_name)
+        os.remove(repo.record_filepath)
+
+        if not os.path.exists(repo.permdb_filepath):
+            permdb = SafeConfigParser()
+            permdb.add_section(repo._permissions_section)
+            for username, permissions in repo.get_all_permissions():
+                permdb.set(repo._permissions_section, username, permissions)
+            f = open(repo.permdb_filepath, "w")
+            permdb.write(f)
+            f.close()
+
+        if repo.owner_filepath != repo.permdb_filepath:
+            f = open(repo.owner_filepath, "w")
+            f.write("".join(owner + "\n" for owner in repo.get_owners()))
+            f.close()
+        return repo
+
+    def test_legacy_repository(self):
+        repo = self.make_legacy_repository()
+
+        legacy = self.repomanager.get_repo_object(self.username,
+                                                  self.repo_name)
+        self.assertEquals(legacy.get_owners(), [self.username])
+        self.assertEquals(legacy.get_all_permissions(),
+                          repo.get_all_permissions())
+        self.assert_(Authorizer(self.manager_class.klass).has_permissions(
+            repo.repo_path, "nonexistent", "r"))
+        indexed, = self.repomanager.index.repositories()
+        self.assertEquals(indexed.get_owners(), [self.username])
+
+    def test_migrate_access_records(self):
+        repo = self.make_legacy_repository()
+        self.repomanager.migrate_access_records(
+            UserRequest(username=git.subssh.config.ADMIN))
+
+        self.assert_(os.path.exists(repo.record_filepath))
+        for filename in repo.legacy_files:
+            self.assertFalse(os.path.exists(os.path.join(repo.repo_path,
+                                                         filename)))
+
+        migrated = self.repomanager.get_repo_object(self.username,
+                                                    self.repo_name)
+        self.assertEquals(migrated.get_owners(), [self.username])
+        self.assertEquals(migrated.get_all_permissions(),
+                          repo.get_all_permissions())
+
+    def test_only_admin_migrates(self):
+        self.assertRaises(InvalidPermissions,
+                          self.repomanager.migrate_access_records, self.user)
+
+    def test_repository_templates(self):
+        manager = self.manager_class(self.tempdir, templates=True)
+        for name in ("first", "second"):
+            manager.init(self.user, name)
+            repo = manager.get_repo_object(self.username, name)
+            self.assertEquals(repo.get_owners(), [self.username])
+
+        templates = os.listdir(manager.templates.templates_path)
+        self.assertEquals(templates, [os.path.basename(
+            manager.templates.template_path(self.manager_class.klass))])
+
+    def test_web_project_list(self):
+        list_path = os.path.join(self.tempdir, "weblist", "projects")
+        manager = self.manager_class(self.tempdir,
+                                     web_project_list_path=list_path)
+
+        def projects():
+            f = open(manager.web_projects.state_path)
+            try:
+                projects = json.load(f)
+            finally:
+                f.close()
+            self.assertEquals(open(list_path).read(),
+                              manager.web_projects.render(projects))
+            return dict((p["name"], p["owner"]) for p in projects.values())
+
+        manager.init(self.user, "public")
+        manager.set_permissions(self.user, "*", "r", "public")
+        manager.set_permissions(self.user, "*", "r", self.repo_name)
+        manager.web_enable(self.user, "public")
+        self.assertEquals(projects(), {"public": self.username})
+
+        manager.web_enable(self.user, self.repo_name)
+        manager.add_owner(self.user, "public", "other")
+        manager.rename(self.user, "public", "renamed")
+        self.assertEquals(projects(), {"renamed": "other, " + self.username,
+                                       self.repo_name: self.username})
+        self.assert_(manager.is_web_enabled(
+            manager.get_repo_object(self.username, "renamed")))
+
+        manager.bulk_set_permissions(self.user, "*", "-r", self.repo_name)
+        manager.delete(self.user, "renamed")
+        self.assertEquals(projects(), {})
+
+    def test_bulk_init(self):
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        stdin, sys.stdin = sys.stdin, StringIO("# manifest\nbulk-a\n\n"
+                                               "bulk-b\n.hidden\n")
+        try:
+            self.assertEquals(self.repomanager.bulk_init(self.user), 1)
+            self.repomanager.bulk_init(self.user, "bulk-c")
+        finally:
+            sys.stdout = stdout
+            sys.stdin = stdin
+
+        self.assert_(".hidden: FAILED Bad repository name"
+                     in output.getvalue())
+        for name in ("bulk-a", "bulk-b", "bulk-c"):
+            repo = self.repomanager.get_repo_object(self.username, name)
+            self.assertEquals(repo.get_owners(), [self.username])
+
+    def make_store_manager(self):
+        manager = self.manager_class(
+            self.tempdir, delete_grace_period=3600,
+            permission_store_path=os.path.join(self.tempdir,
+                                               ".permissions.sqlite"))
+        manager.import_permission_store(
+            UserRequest(username=git.subssh.config.ADMIN))
+        return manager
+
+    def test_permission_store(self):
+        manager = self.make_store_manager()
+        name_on_fs = manager.real_name(self.repo_name)
+        repo_path = manager.real_path(self.repo_name)
+        self.assert_(name_on_fs in manager.store)
+
+        manager.set_permissions(self.user, "friend", "r", self.repo_name)
+        authorizer = Authorizer(self.manager_class.klass, store=manager.store)
+        self.assert_(authorizer.has_permissions(repo_path, "friend", "r"))
+        # The files of the repository are still written
+        self.assert_(Authorizer(self.manager_class.klass).has_permissions(
+            repo_path, "friend", "r"))
+        self.assertEquals(
+            [repo.name for repo in manager.repositories(readable_by="friend")],
+            [self.repo_name])
+
+        # Permissions are read from the store
+        manager.store.save(name_on_fs, self.repo_name, [self.username], {})
+        self.assertFalse(authorizer.has_permissions(repo_path, "friend", "r"))
+        repo = manager.get_repo_object(self.username, self.repo_name)
+        self.assertFalse(repo.has_permissions("friend", "r"))
+        self.assertEquals(manager.repositories(readable_by="friend"), [])
+        self.assertEquals(
+            [repo.name for repo in manager.repositories(owner=self.username)],
+            [self.repo_name])
+
+        manager.rename(self.user, self.repo_name, "renamed")
+        self.assertFalse(name_on_fs in manager.store)
+        self.assert_("renamed" in manager.store)
+
+    def test_permission_store_lists_after_import(self):
+        manager = self.manager_class(
+            self.tempdir, permission_store_path=os.path.join(
+                self.tempdir, ".permissions.sqlite"))
+        manager.init(self.user, "created")
+
+        # Existing repositories are listed from the files until imported
+        self.assertEquals([r.name for r in manager.repositories()],
+                          ["created", self.repo_name])
+        self.assertFalse(manager.store.imported())
+
+        manager.import_permission_store(
+            UserRequest(username=git.subssh.config.ADMIN))
+        self.assert_(manager.store.imported())
+        self.assertEquals([r.name for r in manager.repositories()],
+                          ["created", self.repo_name])
+
+    def test_permission_store_undelete(self):
+        manager = self.make_store_manager()
+        name_on_fs = manager.real_name(self.repo_name)
+
+        manager.delete(self.user, self.repo_name)
+        self.assertFalse(name_on_fs in manager.store)
+
+        manager.undelete(self.user, self.repo_name)
+        self.assert_(name_on_fs in manager.store)
+        repo = manager.get_repo_object(self.username, self.repo_name)
+        self.assertEquals(repo.get_owners(), [self.username])
+        self.assert_(repo.has_permissions("anybody", "r"))
+
+    def test_only_admin_imports_permission_store(self):
+        manager = self.make_store_manager()
+        self.assertRaises(InvalidPermissions,
+                          manager.import_permission_store, self.user)
+
+    def test_permission_groups(self):
+        groups_path = os.path.join(self.tempdir, ".permission_groups")
+        f = open(groups_path, "w")
+        f.write("[groups]\nteam = friend\n")
+        f.close()
+        klass = self.manager_class.klass
+        self.assertRaises(InvalidPermissions,
+                          self.repomanager.set_permissions, self.user,
+                          "@team", "r", self.repo_name)
+        groups.enable(klass, groups_path)
+        try:
+            self.assertRaises(InvalidPermissions,
+                              self.repomanager.set_permissions, self.user,
+                              "@nobody", "r", self.repo_name)
+            self.repomanager.set_permissions(self.user, "*", "-r",
+                                             self.repo_name)
+            self.repomanager.set_permissions(self.user, "@team", "r",
+                                             self.repo_name)
+            repo = self.repomanager.get_repo_object(self.username,
+                                                    self.repo_name)
+            self.assert_(repo.has_permissions("friend", "r"))
+            self.assertFalse(repo.has_permissions("stranger", "r"))
+            self.assert_(Authorizer(self.manager_class.klass).has_permissions(
+                repo.repo_path, "friend", "r"))
+
+            manager = self.make_store_manager()
+            self.assertEquals(
+                [r.name for r in manager.repositories(readable_by="friend")],
+                [self.repo_name])
+            self.assertEquals(manager.repositories(readable_by="stranger"),
+                              [])
+        finally:
+            groups.disable(klass)
+
+    def test_sharded_layout(self):
+        manager = self.manager_class(self.tempdir, sharded=True)
+        flat_path = manager.real_path(self.repo_name)
+        admin = UserRequest(username=git.subssh.config.ADMIN)
+        manager.shard_repositories(admin)
+
+        repo = manager.get_repo_object(self.username, self.repo_name)
+        self.assertEquals(repo.repo_path,
+                          manager.layout.sharded_path(repo.name_on_fs))
+        self.assertEquals(os.path.islink(flat_path), manager.flat_links)
+        self.assertEquals([r.name for r in manager.index.repositories()],
+                          [self.repo_name])
+
+        manager.init(self.user, "newrepo")
+        manager.rename(self.user, "newrepo", "renamed")
+        renamed = manager.get_repo_object(self.username, "renamed")
+        self.assertEquals(renamed.repo_path,
+                          manager.layout.sharded_path(renamed.name_on_fs))
+
+        manager.delete(self.user, "renamed")
+        self.assertFalse(os.path.lexists(
+            os.path.join(self.tempdir, renamed.name_on_fs)))
+        self.assertEquals([r.name for r in manager.index.repositories()],
+                          [self.repo_name])
+
+    def test_authorizer_rejects_missing_repository(self):
+        authorizer = Authorizer(self.manager_class.klass)
+        self.assertRaises(InvalidRepository, authorizer.has_permissions,
+                          self.repomanager.real_path("nonexistent"),
+                          self.username, "r")
+
+
 class TestGitManager(RepoManagertMixIn, unittest.TestCase):
     manager_class = git.GitManager
 
+    def test_template_copy_has_server_options(self):
+        manager = self.manager_class(self.tempdir, templates=True)
+        manager.init(self.user, "first")
+        manager.init(self.user, "second")
+        repo = manager.get_repo_object(self.username, "second")
+        self.assertEquals(sorted(repo.get_server_options()),
+                          [("uploadpack.allowfilter", "true")])
+
+    def test_web_project_list_follows_permissions_and_description(self):
+        list_path = os.path.join(self.tempdir, "weblist", "projects")
+        manager = self.manager_class(self.tempdir,
+                                     web_project_list_path=list_path)
+        manager.web_enable(self.user, self.repo_name)
+
+        def rebuilt_by(command, *args):
+            os.remove(manager.web_projects.state_path)
+            os.remove(list_path)
+            command(self.user, *args)
+            self.assert_(manager.web_projects.exists())
+            self.assert_(self.repo_name in open(list_path).read())
+
+        rebuilt_by(manager.set_permissions, "other", "rw", self.repo_name)
+        rebuilt_by(manager.set_description, self.repo_name, "a", "project")
+
+        manager.set_permissions(self.user, "*", "", self.repo_name)
+        self.assertEquals(open(list_path).read(),
+                          manager.web_projects.render({}))
+
+    def test_usage_follows_nested_refs_and_repacks(self):
+        repo_path = self.repomanager.real_path(self.repo_name)
+
+        def age(seconds):
+            for dirpath, dirnames, filenames in os.walk(repo_path):
+                os.utime(dirpath, (time.time() - seconds,) * 2)
+
+        def usage():
+            repo, = self.repomanager.repositories()
+            (_, pushed, size), = self.repomanager.index.iter_usage([repo])
+            return pushed, size
+
+        age(3600)
+        pushed, size = usage()
+
+        # Push to a namespaced branch touches only its own directory
+        os.makedirs(os.path.join(repo_path, "refs", "heads", "feature"))
+        open(os.path.join(repo_path, "refs", "heads", "feature", "x"),
+             "w").close()
+        age(3600)
+        feature = os.path.join(repo_path, "refs", "heads", "feature")
+        os.utime(feature, (time.time() - 600,) * 2)
+        self.assertEquals(usage()[0], os.stat(feature).st_mtime)
+
+        # Repack writes only to objects/pack
+        pack = os.path.join(repo_path, "objects", "pack")
+        f = open(os.path.join(pack, "pack-x.pack"), "w")
+        f.write("x" * 1000)
+        f.close()
+        os.utime(pack, (time.time() - 300,) * 2)
+        self.assertEquals(usage()[1], size + 1000)
+
 
 class TestSubversionManager(RepoManagertMixIn, unittest.TestCase):
     manager_class = svn.SubversionManager
 
+    def test_template_copy_is_unique(self):
+        manager = self.manager_class(self.tempdir, templates=True)
+        manager.init(self.user, "first")
+        manager.init(UserRequest(username="other"), "second")
+
+        def info(name):
+            repo_path = manager.real_path(name)
+            return [subprocess.check_output(["svnlook", "uuid",
+                                             repo_path]).strip()] + \
+                   [subprocess.check_output(["svn", "propget", "--revprop",
+                                             "-r", "1", prop,
+                                             "file://" + repo_path]).strip()
+                    for prop in ("svn:author", "svn:date")]
+
+        first_uuid, first_author, first_date = info("first")
+        second_uuid, second_author, second_date = info("second")
+        self.assertNotEquals(first_uuid, second_uuid)
+        self.assertEquals(first_author, self.username)
+        self.assertEquals(second_author, "other")
+        self.assertNotEquals(first_date, second_date)
+
 
 class TestMercurialManager(RepoManagertMixIn, unittest.TestCase):
     manager_class = hg.MercurialManager
@@ -0,0 +1,101 @@
+'''
+Tests for the resident transport command server.
+'''
+
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+import subprocess
+
+
+SERVER = """
+import sys, types
+from revisioncask import plugins, zygote
+
+def echo(user, *args):
+    from revisioncask import git
+    sys.stdout.write("%%s %%s\\n" %% (user.username, git.config.REPOSITORIES))
+    sys.stdout.write(sys.stdin.read())
+    sys.stderr.write("error output\\n")
+    return int(args[0])
+
+commands = types.ModuleType("zygote_test_commands")
+commands.echo = echo
+commands.configure = lambda: None
+sys.modules["zygote_test_commands"] = commands
+plugins.VCS_MODULES["test"] = "zygote_test_commands"
+plugins.TRANSPORT_COMMANDS["echo"] = ("test", "echo")
+
+zygote.serve(%r, %r)
+"""
+
+
+def python_env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    return env
+
+
+class TestZygote(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="subuser_test_tmp_")
+        self.socket_path = os.path.join(self.tempdir, "zygote.sock")
+        self.repos = os.path.join(self.tempdir, "repos")
+
+        config_path = os.path.join(self.tempdir, "config")
+        f = open(config_path, "w")
+        f.write("[revisioncask.git]\nrepositories = %s\n" % self.repos)
+        f.close()
+
+        self.server = subprocess.Popen(
+            [sys.executable, "-c", SERVER % (self.socket_path, config_path)],
+            env=python_env())
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        os.kill(self.server.pid, signal.SIGTERM)
+        self.server.wait()
+        shutil.rmtree(self.tempdir)
+
+    def run_client(self, command, stdin="", fallback=()):
+        env = python_env()
+        env["SSH_ORIGINAL_COMMAND"] = command
+        client = subprocess.Popen([sys.executable, "-m", "revisioncask.zygote",
+                                   "client", self.socket_path, "tester"] +
+                                  list(fallback),
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, env=env)
+        stdout, stderr = client.communicate(stdin)
+        return client.returncode, stdout, stderr
+
+    def test_file_descriptors_are_passed_to_worker(self):
+        code, stdout, stderr = self.run_client("echo 0", stdin="input\n")
+        self.assertEquals(code, 0)
+        self.assertEquals(stdout, "tester %s\ninput\n" % self.repos)
+        self.assertEquals(stderr, "error output\n")
+
+    def test_exit_code_is_returned(self):
+        code, _, _ = self.run_client("echo 3")
+        self.assertEquals(code, 3)
+
+    def test_unknown_command_runs_fallback(self):
+        code, stdout, _ = self.run_client(
+            "unknown", fallback=("sh", "-c", "echo fallback; exit 5"))
+        self.assertEquals(code, 5)
+        self.assertEquals(stdout, "fallback\n")
+
+    def test_missing_socket_runs_fallback(self):
+        os.remove(self.socket_path)
+        code, stdout, _ = self.run_client(
+            "echo 0", fallback=("sh", "-c", 'echo "fallback $0"', "run"))
+        self.assertEquals(code, 0)
+        self.assertEquals(stdout, "fallback run\n")